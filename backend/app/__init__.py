@@ -22,6 +22,11 @@ def create_app():
 
     from .routes.core import core_bp
     app.register_blueprint(core_bp)
+
+    # Réserve de conteneurs de scan pré-chauffés (WARM_POOL_SIZE > 0), outillés pour tous les profils
+    from .services.container_pool import start_container_pool
+    from .services.mistest_no_user import scan_profile_tools
+    start_container_pool(scan_profile_tools("domain"))
     
     socketio.init_app(app) 
 
@@ -5,6 +5,11 @@ from reportlab.pdfgen import canvas
 import os
 from threading import Lock
 from app.services import pentral_rapide, pentral_no_user, pentral_user, mistest_no_user, mistest_user, mistest_rapide
+from app.services.stream_batcher import TokenBatcher, STREAM_WINDOW_MS, STREAM_MAX_BYTES
+from app.services.llm_telemetry import finish_scan_telemetry, get_scan_telemetry, start_scan_telemetry
+from app.services.agent_registry import AGENT_TTL, check_agent_token, get_agent_registry
+from app.services.container_pool import get_container_pool
+from app.services.scan_cancel import ScanCancelled, cancel_scan, run_cancellable
 import bcrypt
 from datetime import datetime, timedelta, timezone 
 import jwt
@@ -16,6 +21,7 @@ from flask_socketio import emit
 from jinja2 import Environment, FileSystemLoader
 import pdfkit
 import subprocess
+import uuid
 import nvdlib
 
 SECRET_KEY = "secret_secret"
@@ -49,6 +55,8 @@ status_lock = Lock()
 
 # Variable globale pour suivre les sessions socket actives
 active_socket_sessions = {}
+# Sortie des commandes en cours d'exécution, regroupée comme les tokens, par session Socket.IO
+active_output_sessions = {}
 
 # Gestionnaires Socket.IO
 @socketio.on('connect')
@@ -60,7 +68,10 @@ def handle_disconnect():
     print(f"[SOCKET] Client déconnecté: {request.sid}")
     # Nettoyage des sessions
     if request.sid in active_socket_sessions:
+        active_socket_sessions[request.sid].close()
         del active_socket_sessions[request.sid]
+    if request.sid in active_output_sessions:
+        active_output_sessions.pop(request.sid).close()
     # Réinitialiser le callback si c'était ce client
     if hasattr(mistest_rapide, 'streaming_callback'):
         mistest_rapide.streaming_callback = None
@@ -74,6 +85,9 @@ def handle_disconnect():
         mistest_no_user.scan_status_callback = None
     if hasattr(mistest_user, 'scan_status_callback'):
         mistest_user.scan_status_callback = None
+    for module in (mistest_rapide, mistest_no_user, mistest_user):
+        if hasattr(module, 'command_output_callback'):
+            module.command_output_callback = None
 
         
 @socketio.on('start_llm_query')
@@ -82,12 +96,34 @@ def start_llm_query(data):
     target = data.get('target', '')
     print(f"[SOCKET] Streaming activé pour {session_id}, cible: {target}")
 
-    def send_token(token):
+    def emit_tokens(chunk):
         try:
-            socketio.emit("llm_response", {"token": token}, room=session_id)
+            socketio.emit("llm_response", {"token": chunk}, room=session_id)
         except Exception as e:
             print(f"[ERREUR] Envoi WebSocket: {str(e)}")
             socketio.emit("llm_error", {"error": str(e)}, room=session_id)
+
+    # Les tokens sont regroupés (fenêtre de temps / seuil d'octets) avant émission
+    if session_id in active_socket_sessions:
+        active_socket_sessions[session_id].close()
+    send_token = TokenBatcher(
+        emit_tokens,
+        window_ms=float(data.get('stream_window_ms', STREAM_WINDOW_MS)),
+        max_bytes=int(data.get('stream_max_bytes', STREAM_MAX_BYTES)),
+        name=session_id
+    )
+    active_socket_sessions[session_id] = send_token
+
+    def emit_command_output(chunk):
+        try:
+            socketio.emit("command_output", {"chunk": chunk}, room=session_id)
+        except Exception as e:
+            print(f"[ERREUR] Envoi sortie commande WebSocket: {str(e)}")
+
+    if session_id in active_output_sessions:
+        active_output_sessions[session_id].close()
+    send_output = TokenBatcher(emit_command_output, name=f"{session_id}:commandes")
+    active_output_sessions[session_id] = send_output
             
     def send_scan_status(status_data):
         try:
@@ -102,30 +138,53 @@ def start_llm_query(data):
     mistest_rapide.scan_status_callback = send_scan_status 
     mistest_user.streaming_callback = send_token
     mistest_user.scan_status_callback = send_scan_status 
+    mistest_no_user.command_output_callback = send_output
+    mistest_rapide.command_output_callback = send_output
+    mistest_user.command_output_callback = send_output
     
 
     emit("streaming_ready", {"status": "ready"})
 
 
+@socketio.on('get_stream_stats')
+def get_stream_stats(data=None):
+    """Statistiques du regroupement des tokens (émissions/s) pour régler la fenêtre."""
+    batcher = active_socket_sessions.get(request.sid)
+    emit("stream_stats", batcher.get_stats() if batcher else {})
+
+
+def flush_token_stream(socket_id):
+    """Envoie les tokens encore en tampon avant le signal de fin, et journalise le débit."""
+    batcher = active_socket_sessions.get(socket_id)
+    if batcher:
+        batcher.flush()
+        print(f"[INFO] Streaming LLM {socket_id} : {batcher.get_stats()}")
+
+
 @core_bp.route("/api/run", methods=["POST"])
 def run_command():
     script_status["command"] = ""
     data = request.json
     target = data.get("target", "")    
     socket_id = data.get("socket_id") 
+    # Identifiant choisi par le client pour annuler l'exécution (/api/scans/<scan_id>/cancel)
+    run_id = data.get("scan_id") or uuid.uuid4().hex
     if not target:
         return jsonify({"error": "Commande invalide"}), 400
     
     try:
         print(f"[API] Exécution pour cible: {target}")
-        output = mistest_rapide.main(target)
+        output = run_cancellable(run_id, mistest_rapide.main, target)
         
         # Signal de fin optionnel (déjà envoyé dans la fonction patched_query_llm)
         # session_id = request.sid if hasattr(request, 'sid') else None
         if socket_id:
+            flush_token_stream(socket_id)
             socketio.emit("llm_end", {"final_text": output}, room=socket_id)
 
         return jsonify({"output": output})
+    except ScanCancelled:
+        return jsonify({"message": "Scan annulé"}), 200
     except Exception as e:
         print(f"[ERREUR] Exécution: {str(e)}")
         return jsonify({"error": f"Erreur: {str(e)}"}), 500
@@ -202,9 +261,14 @@ def validation_response():
 def run_command_no_user():
     data = request.json  # Vérifie que le frontend envoie bien du JSON
     target = data.get("target", "")
+    # Identifiant choisi par le client pour annuler l'exécution (/api/scans/<scan_id>/cancel)
+    run_id = data.get("scan_id") or uuid.uuid4().hex
     if target:
         script_status["command"].clear()
-        output = mistest_no_user.main(target)
+        try:
+            output = run_cancellable(run_id, mistest_no_user.main, target)
+        except ScanCancelled:
+            return jsonify({"message": "Scan annulé"}), 200
         return jsonify({"output": output})
     return jsonify({"error": "Commande invalide"}), 400
 
@@ -635,9 +699,12 @@ def start_scan(scan_id):
         # session_id = request.sid if hasattr(request, 'sid') else None
         if script_status["command"] :
             script_status["command"].clear()
-        output = mistest_no_user.main(target, iteration)
+        start_scan_telemetry(scan_id)
+        output = run_cancellable(scan_id, mistest_no_user.main, target, iteration)
+        save_scan_telemetry(scan_id)
         
         if socket_id:
+            flush_token_stream(socket_id)
             socketio.emit("llm_end", {"final_text": output}, room=socket_id)
 
 
@@ -688,31 +755,104 @@ def start_scan(scan_id):
             print(e.stderr.decode())
         
         # Update du scan
+        set_final_scan_status(scan_id, "completed", report_url=relative_url)
+
+        return jsonify({"message": "Scan terminé", "output": relative_url}), 200
+
+    except ScanCancelled:
+        save_scan_telemetry(scan_id)
         scans_collection.update_one(
             {"_id": ObjectId(scan_id)},
             {
                 "$set": {
-                    "report_url": relative_url,
-                    "status": "completed",
+                    "status": "cancelled",
                     "finished_at": datetime.utcnow()
                 }
             }
         )
-
-        return jsonify({"message": "Scan terminé", "output": relative_url}), 200
+        return jsonify({"message": "Scan annulé"}), 200
 
     except Exception as e:
+        save_scan_telemetry(scan_id)
+        set_final_scan_status(scan_id, "error")
+        return jsonify({"error": str(e)}), 500
+
+
+def save_scan_telemetry(scan_id):
+    """Enregistre la télémétrie LLM du scan (résumé par type de prompt et derniers appels)."""
+    telemetry = finish_scan_telemetry(scan_id)
+    if telemetry:
         scans_collection.update_one(
             {"_id": ObjectId(scan_id)},
-            {
-                "$set": {
-                    "status": "error",
-                    "finished_at": datetime.utcnow()
-                }
-            }
+            {"$set": {"llm_telemetry": telemetry}}
         )
-        return jsonify({"error": str(e)}), 500
 
+def set_final_scan_status(scan_id, status, **fields):
+    """
+    Statut final écrit par le thread du scan (completed, error). Une annulation déjà enregistrée par
+    la route d'annulation n'est pas écrasée, même si le moteur a terminé avant de voir le jeton.
+    """
+    scans_collection.update_one(
+        {"_id": ObjectId(scan_id), "status": {"$ne": "cancelled"}},
+        {"$set": dict(fields, status=status, finished_at=datetime.utcnow())}
+    )
+
+# Annulation d'un scan en cours : commande en cours tuée, flux LLM fermé, scan marqué « cancelled »
+@core_bp.route("/api/scans/<scan_id>/cancel", methods=["POST"])
+def cancel_running_scan(scan_id):
+    if not cancel_scan(scan_id):
+        return jsonify({"error": "Aucun scan en cours avec cet identifiant"}), 409
+    # Exécutions /api/run* sans document de scan : rien à enregistrer
+    if not ObjectId.is_valid(scan_id):
+        return jsonify({"message": "Annulation en cours"}), 202
+    # Sans effet si le thread du scan a déjà écrit son statut final
+    scans_collection.update_one(
+        {"_id": ObjectId(scan_id), "status": {"$nin": ["completed", "error"]}},
+        {"$set": {"status": "cancelled", "cancelled_at": datetime.utcnow()}}
+    )
+    return jsonify({"message": "Annulation en cours"}), 202
+
+# Inscription / battement de cœur d'un agent d'exécution (scan_agent.py)
+@core_bp.route("/api/agents/register", methods=["POST"])
+def register_agent():
+    if not check_agent_token(request.headers.get("X-Agent-Token")):
+        return jsonify({"error": "Jeton d'agent invalide"}), 401
+    try:
+        agent = get_agent_registry().register(request.get_json(silent=True) or {})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"name": agent.name, "ttl": AGENT_TTL}), 200
+
+# Agents d'exécution inscrits, avec leur charge et leurs outils
+@core_bp.route("/api/agents", methods=["GET"])
+def list_agents():
+    return jsonify(get_agent_registry().get_stats()), 200
+
+# État de la réserve de conteneurs de scan pré-chauffés
+@core_bp.route("/api/container_pool", methods=["GET"])
+def container_pool_stats():
+    pool = get_container_pool()
+    if pool is None:
+        return jsonify({"enabled": False}), 200
+    return jsonify(dict(pool.get_stats(), enabled=True)), 200
+
+# Télémétrie LLM d'un scan : en direct pendant le scan, sinon celle enregistrée sur le document
+@core_bp.route("/api/scans/<scan_id>/llm_telemetry", methods=["GET"])
+def get_scan_llm_telemetry(scan_id):
+    try:
+        live = get_scan_telemetry(scan_id)
+        if live:
+            return jsonify(dict(live.to_document(), running=True)), 200
+
+        scan = scans_collection.find_one({"_id": ObjectId(scan_id)}, {"llm_telemetry": 1})
+        if not scan:
+            return jsonify({"error": "Scan non trouvé"}), 404
+
+        telemetry = scan.get("llm_telemetry") or {"summary": {}, "calls": []}
+        return jsonify(dict(telemetry, running=False)), 200
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
 def get_scan_data(scan_id):
     scan = scans_collection.find_one({"_id": ObjectId(scan_id)})
@@ -758,8 +898,11 @@ def start_scan_reason(scan_id):
         if script_status["command"] :
             script_status["command"].clear()
         # session_id = request.sid if hasattr(request, 'sid') else None
-        output = mistest_user.main(target, iteration)
+        start_scan_telemetry(scan_id)
+        output = run_cancellable(scan_id, mistest_user.main, target, iteration)
+        save_scan_telemetry(scan_id)
         if socket_id:
+            flush_token_stream(socket_id)
             socketio.emit("llm_end", {"final_text": output}, room=socket_id)
 
         if not output:
@@ -808,28 +951,25 @@ def start_scan_reason(scan_id):
             print(e.stderr.decode())
         
         # Update du scan
-        scans_collection.update_one(
-            {"_id": ObjectId(scan_id)},
-            {
-                "$set": {
-                    "report_url": relative_url,
-                    "status": "completed",
-                    "finished_at": datetime.utcnow()
-                }
-            }
-        )
+        set_final_scan_status(scan_id, "completed", report_url=relative_url)
         return jsonify({"message": "Scan terminé", "output": relative_url}), 200
 
-    except Exception as e:
+    except ScanCancelled:
+        save_scan_telemetry(scan_id)
         scans_collection.update_one(
             {"_id": ObjectId(scan_id)},
             {
                 "$set": {
-                    "status": "error",
+                    "status": "cancelled",
                     "finished_at": datetime.utcnow()
                 }
             }
         )
+        return jsonify({"message": "Scan annulé"}), 200
+
+    except Exception as e:
+        save_scan_telemetry(scan_id)
+        set_final_scan_status(scan_id, "error")
         return jsonify({"error": str(e)}), 500
 
 
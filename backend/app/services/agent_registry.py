@@ -0,0 +1,278 @@
+import asyncio
+import hmac
+import json
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional
+
+import aiohttp
+
+from app.services.command_executor import (COMMAND_MAX_OUTPUT_BYTES, CommandResult, command_timeout,
+                                           global_command_slots)
+from app.services.llm_client import get_llm_loop
+from app.services.output_buffer import OutputBuffer
+from app.services.scan_cancel import wait_cancellable
+
+# Jeton partagé entre le backend et les agents d'exécution (vide : aucun agent accepté)
+AGENT_TOKEN = os.environ.get("AGENT_TOKEN", "")
+# Un agent sans battement de cœur depuis AGENT_TTL secondes n'est plus utilisé
+AGENT_TTL = int(os.environ.get("AGENT_TTL", "45"))
+AGENT_CONNECT_TIMEOUT = 5
+# Marge laissée à l'agent, au-delà du délai de la commande, pour arrêter le processus et répondre
+AGENT_TIMEOUT_GRACE = 15
+# Durée de conservation d'une connexion inutilisée vers un agent (secondes)
+AGENT_KEEPALIVE = 60
+
+
+def check_agent_token(token: Optional[str]) -> bool:
+    return bool(AGENT_TOKEN) and hmac.compare_digest(token or "", AGENT_TOKEN)
+
+
+class ScanAgent:
+    """Conteneur d'exécution enregistré : adresse, capacité, outils disponibles et charge."""
+
+    def __init__(self, name: str, url: str, capacity: int, tools: Iterable[str]):
+        self.name = name
+        self.url = url.rstrip("/")
+        self.capacity = max(capacity, 1)
+        self.tools = set(tools)
+        self.active = 0
+        self.reported_active = 0
+        self.commands = 0
+        self.failures = 0
+        self.last_seen = time.time()
+        # Conteneur loué par un scan (container_pool) : réservé aux commandes qui le demandent
+        self.reserved = False
+        # Connexions HTTP vers l'agent, réutilisées d'une commande à l'autre
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def session(self) -> aiohttp.ClientSession:
+        """Session de l'agent, créée à la première commande (dans la boucle partagée)."""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.capacity, keepalive_timeout=AGENT_KEEPALIVE),
+                headers={"X-Agent-Token": AGENT_TOKEN}
+            )
+        return self._session
+
+    def close(self) -> None:
+        """Ferme la session de l'agent (agent désinscrit ou remplacé), depuis n'importe quel thread."""
+        session, self._session = self._session, None
+        if session is not None and not session.closed:
+            asyncio.run_coroutine_threadsafe(session.close(), get_llm_loop())
+
+    @property
+    def alive(self) -> bool:
+        return time.time() - self.last_seen < AGENT_TTL
+
+    @property
+    def load(self) -> float:
+        return max(self.active, self.reported_active) / self.capacity
+
+    def to_dict(self) -> Dict:
+        return {
+            "name": self.name,
+            "url": self.url,
+            "capacity": self.capacity,
+            "active": self.active,
+            "load": round(self.load, 2),
+            "tools": sorted(self.tools),
+            "commands": self.commands,
+            "failures": self.failures,
+            "alive": self.alive,
+            "reserved": self.reserved,
+            "last_seen": self.last_seen
+        }
+
+
+class AgentRegistry:
+    """
+    Agents d'exécution inscrits auprès du backend (POST /api/agents/register, renouvelé par battement de cœur).
+    Une commande est confiée à l'agent vivant le moins chargé qui dispose de tous ses outils ;
+    la place est réservée à la sélection et rendue à la fin de la commande.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._agents: Dict[str, ScanAgent] = {}
+
+    def register(self, info: Dict) -> ScanAgent:
+        name = str(info.get("name") or "").strip()
+        url = str(info.get("url") or "").strip()
+        if not name or not url.startswith(("http://", "https://")):
+            raise ValueError("name et url (http/https) sont requis")
+        with self._lock:
+            agent = self._agents.get(name)
+            if agent is None or agent.url != url.rstrip("/"):
+                if agent is not None:
+                    agent.close()
+                agent = ScanAgent(name, url, int(info.get("capacity") or 1), info.get("tools") or [])
+                self._agents[name] = agent
+                print(f"[INFO] Agent d'exécution inscrit : {name} ({agent.url}, capacité {agent.capacity}, "
+                      f"{len(agent.tools)} outils)")
+            else:
+                agent.capacity = max(int(info.get("capacity") or agent.capacity), 1)
+                agent.tools = set(info.get("tools") or agent.tools)
+            agent.reported_active = int(info.get("active") or 0)
+            agent.last_seen = time.time()
+        return agent
+
+    def unregister(self, name: str) -> None:
+        with self._lock:
+            agent = self._agents.pop(name, None)
+        if agent is not None:
+            agent.close()
+
+    def _candidates(self, tools: Iterable[str]) -> List[ScanAgent]:
+        needed = set(tools)
+        return [agent for agent in self._agents.values()
+                if agent.alive and needed <= agent.tools and agent.active < agent.capacity]
+
+    def set_reserved(self, name: str, reserved: bool) -> None:
+        with self._lock:
+            agent = self._agents.get(name)
+            if agent is not None:
+                agent.reserved = reserved
+
+    def has_capable_agent(self, tools: Iterable[str]) -> bool:
+        needed = set(tools)
+        with self._lock:
+            return any(agent.alive and needed <= agent.tools for agent in self._agents.values())
+
+    def acquire(self, tools: Iterable[str], preferred: Optional[str] = None) -> Optional[ScanAgent]:
+        """
+        Réserve une place sur l'agent préféré s'il convient, sinon sur le moins chargé
+        (hors agents réservés à d'autres scans).
+        """
+        with self._lock:
+            candidates = [a for a in self._candidates(tools) if not a.reserved or a.name == preferred]
+            if not candidates:
+                return None
+            agent = next((a for a in candidates if a.name == preferred), None)
+            if agent is None:
+                agent = min(candidates, key=lambda a: (a.load, a.active, a.failures))
+            agent.active += 1
+            return agent
+
+    def release(self, agent: ScanAgent, failed: bool = False) -> None:
+        with self._lock:
+            agent.active = max(agent.active - 1, 0)
+            agent.commands += 1
+            if failed:
+                # Agent injoignable : écarté jusqu'à son prochain battement de cœur
+                agent.failures += 1
+                agent.last_seen = 0
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            agents = [agent.to_dict() for agent in self._agents.values()]
+        return {"agents": agents, "alive": sum(1 for a in agents if a["alive"])}
+
+
+class AgentUnavailable(Exception):
+    """L'agent n'a pas pu prendre la commande (injoignable, saturé, jeton refusé)."""
+
+
+async def _run_on_agent(agent: ScanAgent, command: str, timeout: float,
+                        on_line: Optional[Callable[[str, str], None]]) -> CommandResult:
+    """
+    Envoie la commande à l'agent (POST /run) et lit sa réponse NDJSON au fil de l'eau :
+    {"type": "output", "stream": ..., "data": ...} puis {"type": "exit", ...}.
+    """
+    stdout = OutputBuffer()
+    stderr = OutputBuffer()
+    sinks = {"stdout": stdout, "stderr": stderr}
+    kept = {"stdout": 0, "stderr": 0}
+    pending = {"stdout": "", "stderr": ""}
+    truncated = False
+    final: Dict = {}
+    started = time.monotonic()
+    client_timeout = aiohttp.ClientTimeout(total=timeout + AGENT_TIMEOUT_GRACE, sock_connect=AGENT_CONNECT_TIMEOUT)
+    try:
+        async with agent.session().post(f"{agent.url}/run", json={"command": command, "timeout": timeout},
+                                        timeout=client_timeout) as resp:
+            if resp.status != 200:
+                raise AgentUnavailable(f"HTTP {resp.status}")
+            async for raw in resp.content:
+                if not raw.strip():
+                    continue
+                message = json.loads(raw)
+                if message.get("type") == "exit":
+                    # Lecture poursuivie jusqu'à la fin de la réponse : la connexion peut alors être réutilisée
+                    final = message
+                    continue
+                name = message.get("stream")
+                if name not in sinks:
+                    continue
+                data = message.get("data", "").encode("utf-8")
+                part = data[:max(COMMAND_MAX_OUTPUT_BYTES - kept[name], 0)]
+                sinks[name].write(part)
+                kept[name] += len(part)
+                truncated = truncated or len(part) < len(data)
+                if on_line:
+                    pending[name] += message.get("data", "")
+                    *lines, pending[name] = pending[name].split("\n")
+                    for line in lines:
+                        on_line(name, line.rstrip("\r"))
+    except (aiohttp.ClientError, asyncio.TimeoutError, json.JSONDecodeError) as e:
+        if not final and stdout.size == 0 and stderr.size == 0:
+            raise AgentUnavailable(str(e)) from e
+        print(f"[AVERTISSEMENT] Flux de l'agent {agent.name} interrompu : {e}")
+    if on_line:
+        for name, rest in pending.items():
+            if rest:
+                on_line(name, rest.rstrip("\r"))
+    return CommandResult(
+        command,
+        stdout,
+        stderr,
+        final.get("exit_code"),
+        final.get("duration", time.monotonic() - started),
+        timeout,
+        timed_out=bool(final.get("timed_out")),
+        truncated=truncated,
+        cpu_time=final.get("cpu_time"),
+        max_rss_kb=final.get("max_rss_kb")
+    )
+
+
+_registry = AgentRegistry()
+
+
+def get_agent_registry() -> AgentRegistry:
+    return _registry
+
+
+def dispatch_command(command: str, tools: Iterable[str], timeout: Optional[float] = None,
+                     on_line: Optional[Callable[[str, str], None]] = None,
+                     preferred: Optional[str] = None) -> Optional[CommandResult]:
+    """
+    Exécute la commande sur un agent qui dispose des outils nécessaires.
+    Renvoie None si aucun agent ne convient ou si l'agent choisi ne répond pas : l'appelant
+    exécute alors la commande localement.
+    La commande occupe une des COMMAND_GLOBAL_LIMIT places, comme une commande locale : la limite
+    porte sur toutes les commandes des scans, où qu'elles s'exécutent.
+    """
+    if not _registry.has_capable_agent(tools):
+        return None
+    with global_command_slots():
+        agent = _registry.acquire(tools, preferred)
+        if agent is None:
+            return None
+        timeout = timeout or command_timeout(command)
+        print(f"[INFO] Commande confiée à l'agent {agent.name} (charge {agent.load:.2f}) : {command}")
+        failed = False
+        try:
+            # Annulation du scan : la connexion est fermée, l'agent arrête alors la commande
+            execution = wait_cancellable(asyncio.run_coroutine_threadsafe(
+                _run_on_agent(agent, command, timeout, on_line), get_llm_loop()
+            ))
+            execution.agent = agent.name
+            return execution
+        except AgentUnavailable as e:
+            failed = True
+            print(f"[AVERTISSEMENT] Agent {agent.name} indisponible ({e}), exécution locale")
+            return None
+        finally:
+            _registry.release(agent, failed)
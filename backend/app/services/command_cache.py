@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+import shlex
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from app.services.command_executor import CommandResult
+
+# Cache des résultats de commandes, partagé par les scans du processus (COMMAND_CACHE_ENABLED=0 pour le couper)
+COMMAND_CACHE_ENABLED = os.environ.get("COMMAND_CACHE_ENABLED", "1") == "1"
+# Durée de vie d'un résultat (secondes) : courte, l'état de la cible peut changer
+COMMAND_CACHE_TTL = int(os.environ.get("COMMAND_CACHE_TTL", "300"))
+# Taille totale des sorties gardées en mémoire, et taille maximale d'une entrée
+COMMAND_CACHE_MAX_BYTES = int(os.environ.get("COMMAND_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+COMMAND_CACHE_MAX_ENTRY_BYTES = int(os.environ.get("COMMAND_CACHE_MAX_ENTRY_BYTES", str(4 * 1024 * 1024)))
+
+
+def normalize_command(command: str) -> str:
+    """Forme canonique d'une commande : sans sudo ni backticks, espaces et guillemets normalisés."""
+    command = command.replace("`", "").strip()
+    try:
+        parts = shlex.split(command)
+    except ValueError:
+        return " ".join(command.split())
+    if parts and parts[0] == "sudo":
+        parts = parts[1:]
+    return shlex.join(parts)
+
+
+def make_command_key(command: str, target: Optional[str]) -> str:
+    material = {"command": normalize_command(command), "target": (target or "").strip().lower()}
+    return hashlib.sha256(json.dumps(material, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class CommandResultCache:
+    """
+    Résultats complets des commandes réussies, adressés par (commande normalisée, cible).
+    Expiration après ttl secondes, éviction LRU quand la taille totale des sorties dépasse max_bytes.
+    Seules les exécutions réussies sont gardées : une erreur (outil absent, délai dépassé) est
+    toujours rejouée.
+    """
+
+    def __init__(self, ttl: int = COMMAND_CACHE_TTL, max_bytes: int = COMMAND_CACHE_MAX_BYTES,
+                 max_entry_bytes: int = COMMAND_CACHE_MAX_ENTRY_BYTES):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, command: str, target: Optional[str] = None) -> Optional[CommandResult]:
+        key = make_command_key(command, target)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry["created_at"] > self.ttl:
+                self._drop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        execution = CommandResult(
+            command,
+            entry["stdout"],
+            entry["stderr"],
+            entry["exit_code"],
+            entry["duration"],
+            entry["timeout"],
+            truncated=entry["truncated"],
+            cpu_time=entry["cpu_time"],
+            max_rss_kb=entry["max_rss_kb"]
+        )
+        execution.cached = True
+        execution.cached_age = round(now - entry["created_at"], 1)
+        return execution
+
+    def put(self, command: str, target: Optional[str], execution: CommandResult) -> bool:
+        if not execution.ok or execution.cached:
+            return False
+        size = execution.stdout_buffer.size + execution.stderr_buffer.size
+        if size > self.max_entry_bytes:
+            return False
+        entry = {
+            "stdout": execution.stdout,
+            "stderr": execution.stderr,
+            "exit_code": execution.exit_code,
+            "duration": execution.duration,
+            "timeout": execution.timeout,
+            "truncated": execution.truncated,
+            "cpu_time": execution.cpu_time,
+            "max_rss_kb": execution.max_rss_kb,
+            "size": size,
+            "created_at": time.time()
+        }
+        key = make_command_key(command, target)
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = entry
+            self.size += size
+            while self.size > self.max_bytes and self._entries:
+                self._drop(next(iter(self._entries)))
+        return True
+
+    def _drop(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry["size"]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self.size, "hits": self.hits, "misses": self.misses}
+
+
+_command_cache = CommandResultCache()
+
+
+def get_command_cache() -> Optional[CommandResultCache]:
+    return _command_cache if COMMAND_CACHE_ENABLED else None
@@ -0,0 +1,657 @@
+import asyncio
+import contextvars
+import os
+import re
+import shlex
+import signal
+import tempfile
+import threading
+import time
+import uuid
+from typing import Callable, Dict, List, Optional, Set, Tuple, Union
+
+from app.services.llm_client import get_llm_loop
+from app.services.output_buffer import EXCERPT_BYTE_BUDGET, OutputBuffer, build_excerpt
+from app.services.scan_cancel import wait_cancellable
+
+# Délai maximal d'exécution d'une commande (secondes) quand l'outil n'a pas de délai propre
+DEFAULT_COMMAND_TIMEOUT = float(os.environ.get("COMMAND_TIMEOUT", "300"))
+# Délai laissé au groupe de processus entre SIGTERM et SIGKILL
+COMMAND_KILL_GRACE = 3
+# Taille maximale conservée par flux (stdout / stderr), mémoire et fichier temporaire compris ;
+# le reste est lu puis ignoré
+COMMAND_MAX_OUTPUT_BYTES = int(os.environ.get("COMMAND_MAX_OUTPUT_BYTES", str(64 * 1024 * 1024)))
+READ_CHUNK_SIZE = 65536
+# Commandes exécutées en parallèle pour une même cible (pool de phase2) et au total, tous scans confondus
+COMMAND_POOL_PER_TARGET = int(os.environ.get("COMMAND_POOL_PER_TARGET", "3"))
+COMMAND_GLOBAL_LIMIT = int(os.environ.get("COMMAND_GLOBAL_LIMIT", "6"))
+# Shell persistant par scan : les commandes y sont envoyées au lieu de lancer un /bin/sh par commande
+SHELL_SESSIONS_ENABLED = os.environ.get("SHELL_SESSIONS", "1") == "1"
+SCAN_SHELL = os.environ.get("SCAN_SHELL", "/bin/bash --noprofile --norc")
+# Limites appliquées à chaque commande et à ses processus (0 = sans limite) : temps CPU (s),
+# mémoire virtuelle (Mo), fichiers ouverts. La mémoire virtuelle n'est pas limitée par défaut :
+# les outils Go et Java (subfinder, dnsx...) réservent bien plus d'espace d'adressage qu'ils n'en utilisent
+COMMAND_CPU_LIMIT = int(os.environ.get("COMMAND_CPU_LIMIT", "900"))
+COMMAND_MEMORY_LIMIT_MB = int(os.environ.get("COMMAND_MEMORY_LIMIT_MB", "0"))
+COMMAND_NOFILE_LIMIT = int(os.environ.get("COMMAND_NOFILE_LIMIT", "4096"))
+# Priorité réduite des commandes pour que le processus Flask/eventlet garde la main
+COMMAND_NICE = int(os.environ.get("COMMAND_NICE", "10"))
+# Mesure du temps CPU et du pic de mémoire de chaque commande
+COMMAND_ACCOUNTING = os.environ.get("COMMAND_ACCOUNTING", "1") == "1"
+# Intervalle (s) des relevés du pic de mémoire résidente des processus de la commande
+COMMAND_RSS_SAMPLE_INTERVAL = float(os.environ.get("COMMAND_RSS_SAMPLE_INTERVAL", "0.2"))
+
+# Sortie du builtin `times` : "0m0.004s 0m0.000s" (sous-shell) puis la même ligne pour ses enfants
+TIMES_RE = re.compile(r"(\d+)m([\d.]+)s")
+# Pic de mémoire du sous-shell (VmHWM, ko), écrit après `times`
+USAGE_RSS_RE = re.compile(r"^rss (\d+)$", re.MULTILINE)
+
+# Délais par outil : les outils interactifs ou qui attendent une connexion sont coupés vite
+TOOL_TIMEOUTS = {
+    "ssh": 30,
+    "nc": 30,
+    "ncat": 30,
+    "netcat": 30,
+    "telnet": 30,
+    "curl": 60,
+    "wget": 60,
+    "whatweb": 120,
+    "dig": 30,
+    "host": 30,
+    "whois": 30,
+    "nmap": 900,
+    "masscan": 600,
+    "nikto": 900,
+    "gobuster": 900,
+    "dirb": 900,
+    "ffuf": 900,
+    "wpscan": 900,
+    "sslscan": 180,
+    "enum4linux": 600,
+}
+
+
+class CommandResult:
+    """
+    Résultat structuré d'une commande : sorties, code retour, durée, dépassement de délai, troncature.
+    Les sorties sont des OutputBuffer (bornés en mémoire) ; stdout / stderr les relisent en entier.
+    """
+
+    def __init__(self, command: str, stdout: Union[str, OutputBuffer], stderr: Union[str, OutputBuffer],
+                 exit_code: Optional[int], duration: float, timeout: float, timed_out: bool = False,
+                 truncated: bool = False, cpu_time: Optional[float] = None, max_rss_kb: Optional[int] = None):
+        self.command = command
+        self.stdout_buffer = OutputBuffer.from_text(stdout) if isinstance(stdout, str) else stdout
+        self.stderr_buffer = OutputBuffer.from_text(stderr) if isinstance(stderr, str) else stderr
+        self.exit_code = exit_code
+        self.duration = duration
+        self.timeout = timeout
+        self.timed_out = timed_out
+        self.truncated = truncated
+        self.cpu_time = cpu_time
+        # RSS maximal (Ko) : mesuré par les agents d'exécution (wait4), pas par le shell local
+        self.max_rss_kb = max_rss_kb
+        # Résultat servi par le cache de commandes (voir command_cache) et son âge en secondes
+        self.cached = False
+        self.cached_age: Optional[float] = None
+        # Agent d'exécution distant qui a exécuté la commande (None : exécution locale)
+        self.agent: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.exit_code == 0 and not self.timed_out
+
+    @property
+    def stdout(self) -> str:
+        return self.stdout_buffer.text()
+
+    @property
+    def stderr(self) -> str:
+        return self.stderr_buffer.text()
+
+    def stdout_excerpt(self, budget: int = EXCERPT_BYTE_BUDGET) -> str:
+        """Sortie standard complète si elle tient dans le budget, sinon extrait des lignes les plus utiles."""
+        return build_excerpt(self.stdout_buffer, budget)
+
+    def stderr_excerpt(self, budget: int = EXCERPT_BYTE_BUDGET) -> str:
+        return build_excerpt(self.stderr_buffer, budget)
+
+    def close(self) -> None:
+        """Supprime les fichiers temporaires des sorties."""
+        self.stdout_buffer.close()
+        self.stderr_buffer.close()
+
+    def summary(self) -> Dict:
+        """Métadonnées d'exécution, sans les sorties (pour l'historique du scan)."""
+        return {
+            "exit_code": self.exit_code,
+            "duration": round(self.duration, 2),
+            "cpu_time": self.cpu_time,
+            "max_rss_kb": self.max_rss_kb,
+            "timeout": self.timeout,
+            "timed_out": self.timed_out,
+            "truncated": self.truncated,
+            "stdout_bytes": self.stdout_buffer.size,
+            "spilled": self.stdout_buffer.spilled or self.stderr_buffer.spilled,
+            "cached": self.cached,
+            "cached_age": self.cached_age,
+            "agent": self.agent,
+        }
+
+    def to_dict(self) -> Dict:
+        return dict(self.summary(), command=self.command, stdout=self.stdout, stderr=self.stderr)
+
+
+def command_tool(command: str) -> str:
+    """Nom de l'outil lancé par la commande (sans sudo, timeout ni variables d'environnement)."""
+    try:
+        parts = shlex.split(command)
+    except ValueError:
+        parts = command.split()
+    skip_next = False
+    for part in parts:
+        if skip_next:
+            skip_next = False
+            continue
+        if part in ("sudo", "env", "nohup", "stdbuf") or "=" in part.split("/")[0]:
+            continue
+        if part == "timeout":
+            skip_next = True
+            continue
+        return os.path.basename(part)
+    return ""
+
+
+def command_timeout(command: str) -> float:
+    return float(TOOL_TIMEOUTS.get(command_tool(command), DEFAULT_COMMAND_TIMEOUT))
+
+
+def command_limits() -> List[str]:
+    limits = []
+    if COMMAND_CPU_LIMIT > 0:
+        limits.append(f"ulimit -t {COMMAND_CPU_LIMIT}")
+    if COMMAND_MEMORY_LIMIT_MB > 0:
+        limits.append(f"ulimit -v {COMMAND_MEMORY_LIMIT_MB * 1024}")
+    if COMMAND_NOFILE_LIMIT > 0:
+        limits.append(f"ulimit -n {COMMAND_NOFILE_LIMIT}")
+    return limits
+
+
+def limited_script(command: str, usage_path: Optional[str]) -> str:
+    """
+    Script shell exécutant la commande dans un sous-shell soumis aux limites (ulimit), héritées
+    par tous ses processus ; la commande est citée puis évaluée, une erreur de syntaxe reste confinée.
+    Avec usage_path, le sous-shell y écrit ensuite la sortie du builtin `times` (temps CPU du sous-shell
+    et des processus qu'il a attendus) puis son propre VmHWM, lu avec des builtins (sans lancer de
+    processus) : la mesure de mémoire des commandes trop brèves pour être relevées par _RssSampler.
+    Il sort ensuite avec le code de la commande.
+    """
+    steps = [f"{limit} 2>/dev/null" for limit in command_limits()]
+    steps.append(f"eval {shlex.quote(command)}")
+    if usage_path:
+        path = shlex.quote(usage_path)
+        steps.append(
+            f"__pentral_status=$?; times >{path}; "
+            f"while read -r key value unit; do [ \"$key\" = VmHWM: ] && echo \"rss $value\"; "
+            f"done </proc/self/status >>{path} 2>/dev/null; exit $__pentral_status"
+        )
+    return "( " + "\n".join(steps) + "\n) </dev/null"
+
+
+def _lower_priority() -> None:
+    """preexec_fn des shells de commande : priorité CPU réduite, héritée par les commandes."""
+    if COMMAND_NICE > 0:
+        os.nice(COMMAND_NICE)
+
+
+def _usage_file() -> Optional[str]:
+    if not COMMAND_ACCOUNTING:
+        return None
+    fd, path = tempfile.mkstemp(prefix="pentral-usage-")
+    os.close(fd)
+    return path
+
+
+def _read_usage(path: Optional[str]) -> Tuple[Optional[float], Optional[int]]:
+    """
+    Temps CPU (s, utilisateur et système) écrit par `times` et pic de mémoire du sous-shell (ko) ;
+    absents si la commande a quitté le sous-shell.
+    """
+    if not path:
+        return None, None
+    try:
+        with open(path) as f:
+            usage = f.read()
+        times = TIMES_RE.findall(usage)
+        rss = USAGE_RSS_RE.search(usage)
+        cpu_time = round(sum(int(minutes) * 60 + float(seconds) for minutes, seconds in times), 3) if times else None
+        return cpu_time, int(rss.group(1)) if rss else None
+    except (OSError, ValueError):
+        return None, None
+    finally:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+def _group_peaks(pgids: Set[int]) -> Dict[int, int]:
+    """
+    Plus grand pic de mémoire résidente (VmHWM, ko) des processus vivants de chaque groupe : même mesure
+    que ru_maxrss (processus le plus gourmand), lue dans /proc en un seul parcours, sans lancer de processus.
+    """
+    peaks: Dict[int, int] = {}
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return peaks
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "rb") as f:
+                stat = f.read()
+            # Le nom du processus, entre parenthèses, peut contenir des espaces : état, ppid puis pgrp
+            pgid = int(stat[stat.rindex(b")") + 2:].split()[2])
+            if pgid not in pgids:
+                continue
+            with open(f"/proc/{entry}/status", "rb") as f:
+                for line in f:
+                    if line.startswith(b"VmHWM:"):
+                        peaks[pgid] = max(peaks.get(pgid, 0), int(line.split()[1]))
+                        break
+        except (OSError, ValueError, IndexError):
+            continue
+    return peaks
+
+
+class _RssSampler:
+    """
+    Relevés du pic de mémoire des commandes en cours (state["max_rss_kb"]), dans la boucle partagée :
+    un seul parcours de /proc par intervalle, quel que soit le nombre de commandes simultanées.
+    """
+
+    def __init__(self):
+        self._watched: Dict[int, Dict] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def watch(self, pgid: int, state: Dict) -> None:
+        if not COMMAND_ACCOUNTING or COMMAND_RSS_SAMPLE_INTERVAL <= 0:
+            return
+        # Les commandes plus brèves que l'intervalle sont mesurées par le sous-shell (limited_script)
+        self._watched[pgid] = state
+        if self._task is None or self._task.done() or self._task.get_loop() is not asyncio.get_running_loop():
+            self._task = asyncio.ensure_future(self._run())
+
+    def unwatch(self, pgid: int) -> None:
+        self._watched.pop(pgid, None)
+
+    async def _run(self) -> None:
+        while self._watched:
+            await asyncio.sleep(COMMAND_RSS_SAMPLE_INTERVAL)
+            peaks = _group_peaks(set(self._watched))
+            for pgid, state in list(self._watched.items()):
+                if peaks.get(pgid, 0) > (state.get("max_rss_kb") or 0):
+                    state["max_rss_kb"] = peaks[pgid]
+
+
+_rss_sampler = _RssSampler()
+
+
+def _peak_rss(state: Dict, shell_rss: Optional[int]) -> Optional[int]:
+    peaks = [peak for peak in (state.get("max_rss_kb"), shell_rss) if peak]
+    return max(peaks) if peaks else None
+
+
+def _discard_result(future: asyncio.Future) -> None:
+    """Marque comme lu le résultat d'une lecture abandonnée (pas d'avertissement asyncio)."""
+    if not future.cancelled():
+        future.exception()
+
+
+def _kill_group(proc: asyncio.subprocess.Process, sig: int) -> None:
+    try:
+        os.killpg(proc.pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+async def _read_stream(stream: asyncio.StreamReader, name: str, sink: OutputBuffer, state: Dict,
+                       on_line: Optional[Callable[[str, str], None]]) -> None:
+    """Lit un flux par blocs, garde au plus COMMAND_MAX_OUTPUT_BYTES et transmet chaque ligne complète."""
+    pending = b""
+    kept = 0
+    while True:
+        chunk = await stream.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        if kept < COMMAND_MAX_OUTPUT_BYTES:
+            part = chunk[:COMMAND_MAX_OUTPUT_BYTES - kept]
+            sink.write(part)
+            kept += len(part)
+            if len(part) < len(chunk):
+                state["truncated"] = True
+        else:
+            state["truncated"] = True
+            continue
+        if on_line:
+            pending += part
+            *lines, pending = pending.split(b"\n")
+            for line in lines:
+                on_line(name, line.decode("utf-8", errors="replace").rstrip("\r"))
+    if on_line and pending:
+        on_line(name, pending.decode("utf-8", errors="replace").rstrip("\r"))
+
+
+async def run_command_async(command: str, timeout: Optional[float] = None,
+                            on_line: Optional[Callable[[str, str], None]] = None) -> CommandResult:
+    """
+    Exécute une commande shell dans son propre groupe de processus et diffuse sa sortie ligne par ligne
+    (on_line(flux, ligne), flux = "stdout" ou "stderr").
+    Au-delà du délai, tout le groupe reçoit SIGTERM puis SIGKILL : les processus enfants
+    (ssh, nc lancés via le shell) ne survivent pas à la commande. Si la coroutine est annulée
+    (scan annulé), le groupe est tué immédiatement.
+    """
+    timeout = timeout or command_timeout(command)
+    usage_path = _usage_file()
+    started = time.monotonic()
+    proc = await asyncio.create_subprocess_shell(
+        limited_script(command, usage_path),
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        start_new_session=True,
+        preexec_fn=_lower_priority
+    )
+    stdout = OutputBuffer()
+    stderr = OutputBuffer()
+    state = {"truncated": False}
+    _rss_sampler.watch(proc.pid, state)
+    readers = asyncio.gather(
+        _read_stream(proc.stdout, "stdout", stdout, state, on_line),
+        _read_stream(proc.stderr, "stderr", stderr, state, on_line)
+    )
+    timed_out = False
+    try:
+        await asyncio.wait_for(asyncio.shield(readers), timeout)
+        await proc.wait()
+    except asyncio.CancelledError:
+        _rss_sampler.unwatch(proc.pid)
+        _kill_group(proc, signal.SIGKILL)
+        readers.add_done_callback(_discard_result)
+        readers.cancel()
+        _read_usage(usage_path)
+        stdout.close()
+        stderr.close()
+        raise
+    except asyncio.TimeoutError:
+        timed_out = True
+        print(f"[AVERTISSEMENT] Délai de {timeout:.0f}s dépassé, arrêt du groupe de processus : {command}")
+        _kill_group(proc, signal.SIGTERM)
+        try:
+            await asyncio.wait_for(proc.wait(), COMMAND_KILL_GRACE)
+        except asyncio.TimeoutError:
+            _kill_group(proc, signal.SIGKILL)
+            await proc.wait()
+        try:
+            await asyncio.wait_for(readers, COMMAND_KILL_GRACE)
+        except asyncio.TimeoutError:
+            # Un petit-enfant détaché garde les tubes ouverts : on abandonne la lecture
+            readers.cancel()
+    _rss_sampler.unwatch(proc.pid)
+    cpu_time, shell_rss = _read_usage(usage_path)
+    return CommandResult(
+        command,
+        stdout,
+        stderr,
+        proc.returncode,
+        time.monotonic() - started,
+        timeout,
+        timed_out=timed_out,
+        truncated=state["truncated"],
+        cpu_time=cpu_time,
+        max_rss_kb=_peak_rss(state, shell_rss)
+    )
+
+
+async def _read_framed(stream: asyncio.StreamReader, name: str, sink: OutputBuffer, state: Dict,
+                       on_line: Optional[Callable[[str, str], None]], marker: bytes) -> Optional[int]:
+    """
+    Lit la sortie d'une commande du shell persistant jusqu'à la ligne sentinelle `marker [code]`.
+    Le shell écrit un saut de ligne avant la sentinelle : il n'est pas conservé dans la sortie.
+    Renvoie le code retour porté par la sentinelle (None sur stderr, ou si le shell s'est arrêté).
+    """
+    pending = b""
+    kept = 0
+    first = True
+    line_open = False
+
+    def keep(data: bytes) -> None:
+        nonlocal kept
+        if kept >= COMMAND_MAX_OUTPUT_BYTES:
+            state["truncated"] = True
+            return
+        part = data[:COMMAND_MAX_OUTPUT_BYTES - kept]
+        sink.write(part)
+        kept += len(part)
+        if len(part) < len(data):
+            state["truncated"] = True
+
+    while True:
+        chunk = await stream.read(READ_CHUNK_SIZE)
+        if not chunk:
+            return None
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            if not line_open and line.startswith(marker):
+                code = line[len(marker):].strip()
+                return int(code) if code.lstrip(b"-").isdigit() else None
+            keep(line if line_open or first else b"\n" + line)
+            first = False
+            line_open = False
+            if on_line:
+                on_line(name, line.decode("utf-8", errors="replace").rstrip("\r"))
+        # Ligne très longue sans fin de ligne : écrite au fur et à mesure
+        if len(pending) > READ_CHUNK_SIZE and not pending.startswith(marker):
+            keep(pending if line_open or first else b"\n" + pending)
+            first = False
+            line_open = True
+            pending = b""
+
+
+class ShellSession:
+    """
+    Shell bash non interactif (pas de contrôle de tâches, donc pas de messages parasites) réutilisé
+    pour plusieurs commandes. Chaque commande est passée via eval dans un sous-shell limité (fork, sans
+    nouveau démarrage de shell, voir limited_script) et suivie d'une sentinelle unique sur stdout et stderr, qui délimite
+    sa sortie et porte son code retour. En cas de délai dépassé, tout le groupe du shell est arrêté
+    et la session n'est plus réutilisée.
+    """
+
+    def __init__(self):
+        self.proc: Optional[asyncio.subprocess.Process] = None
+        self.commands = 0
+
+    @property
+    def alive(self) -> bool:
+        return self.proc is not None and self.proc.returncode is None
+
+    async def start(self) -> None:
+        self.proc = await asyncio.create_subprocess_exec(
+            *shlex.split(SCAN_SHELL),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            start_new_session=True,
+            preexec_fn=_lower_priority
+        )
+
+    async def run(self, command: str, timeout: float,
+                  on_line: Optional[Callable[[str, str], None]] = None) -> CommandResult:
+        if not self.alive:
+            await self.start()
+        marker = f"__PENTRAL_END_{uuid.uuid4().hex}__"
+        usage_path = _usage_file()
+        # La commande est citée puis évaluée : une erreur de syntaxe ne peut pas désynchroniser la session
+        script = (
+            f"{limited_script(command, usage_path)}\n"
+            f"printf '\\n%s %d\\n' '{marker}' \"$?\"\n"
+            f"printf '\\n%s\\n' '{marker}' >&2\n"
+        )
+        started = time.monotonic()
+        self.proc.stdin.write(script.encode("utf-8"))
+        await self.proc.stdin.drain()
+        self.commands += 1
+
+        stdout = OutputBuffer()
+        stderr = OutputBuffer()
+        state = {"truncated": False}
+        timed_out = False
+        exit_code = None
+        # Le sous-shell de la commande et ses processus restent dans le groupe du shell
+        _rss_sampler.watch(self.proc.pid, state)
+        readers = asyncio.gather(
+            _read_framed(self.proc.stdout, "stdout", stdout, state, on_line, marker.encode()),
+            _read_framed(self.proc.stderr, "stderr", stderr, state, on_line, marker.encode())
+        )
+        readers.add_done_callback(_discard_result)
+        try:
+            exit_code, _ = await asyncio.wait_for(readers, timeout)
+        except asyncio.CancelledError:
+            # Scan annulé : le shell et la commande en cours sont tués, la session n'est plus réutilisée
+            _kill_group(self.proc, signal.SIGKILL)
+            _read_usage(usage_path)
+            stdout.close()
+            stderr.close()
+            raise
+        except asyncio.TimeoutError:
+            timed_out = True
+            print(f"[AVERTISSEMENT] Délai de {timeout:.0f}s dépassé, arrêt du shell de la commande : {command}")
+            await self.close()
+        finally:
+            _rss_sampler.unwatch(self.proc.pid)
+        if exit_code is None and not timed_out:
+            # Le shell s'est arrêté pendant la commande (exit, kill) : son code retour en tient lieu
+            await self.proc.wait()
+            exit_code = self.proc.returncode
+        if timed_out:
+            exit_code = self.proc.returncode
+        cpu_time, shell_rss = _read_usage(usage_path)
+        return CommandResult(
+            command,
+            stdout,
+            stderr,
+            exit_code,
+            time.monotonic() - started,
+            timeout,
+            timed_out=timed_out,
+            truncated=state["truncated"],
+            cpu_time=cpu_time,
+            max_rss_kb=_peak_rss(state, shell_rss)
+        )
+
+    async def close(self) -> None:
+        if not self.alive:
+            return
+        _kill_group(self.proc, signal.SIGTERM)
+        try:
+            await asyncio.wait_for(self.proc.wait(), COMMAND_KILL_GRACE)
+        except asyncio.TimeoutError:
+            _kill_group(self.proc, signal.SIGKILL)
+            await self.proc.wait()
+
+
+class ShellSessionPool:
+    """
+    Shells persistants d'un scan. Une session n'exécute qu'une commande à la fois : les sondes
+    parallèles de phase2 empruntent chacune une session libre, au plus `size` sessions sont gardées.
+    """
+
+    def __init__(self, key: str, size: int = COMMAND_POOL_PER_TARGET):
+        self.key = key
+        self.size = max(size, 1)
+        self._lock = threading.Lock()
+        self._idle: List[ShellSession] = []
+        self.spawned = 0
+        self.commands = 0
+
+    def _acquire(self) -> ShellSession:
+        with self._lock:
+            while self._idle:
+                session = self._idle.pop()
+                if session.alive:
+                    return session
+            self.spawned += 1
+        return ShellSession()
+
+    def _release(self, session: ShellSession) -> None:
+        with self._lock:
+            if session.alive and len(self._idle) < self.size:
+                self._idle.append(session)
+                return
+        asyncio.run_coroutine_threadsafe(session.close(), get_llm_loop()).result()
+
+    def run(self, command: str, timeout: float,
+            on_line: Optional[Callable[[str, str], None]] = None) -> CommandResult:
+        session = self._acquire()
+        try:
+            return wait_cancellable(
+                asyncio.run_coroutine_threadsafe(session.run(command, timeout, on_line), get_llm_loop())
+            )
+        finally:
+            self.commands += 1
+            self._release(session)
+
+    def close(self) -> None:
+        with self._lock:
+            sessions, self._idle = self._idle, []
+        for session in sessions:
+            asyncio.run_coroutine_threadsafe(session.close(), get_llm_loop()).result()
+        print(f"[INFO] Shells du scan {self.key} fermés : {self.spawned} shell(s) pour {self.commands} commande(s)")
+
+
+# Shells du scan courant ; propagés aux threads de sonde avec le contexte du scan
+_shell_pool: contextvars.ContextVar = contextvars.ContextVar("scan_shell_pool", default=None)
+
+
+def open_shell_sessions(key: str) -> Optional[ShellSessionPool]:
+    """Ouvre les shells persistants du scan courant (sans effet si SHELL_SESSIONS=0)."""
+    if not SHELL_SESSIONS_ENABLED:
+        return None
+    pool = ShellSessionPool(key)
+    _shell_pool.set(pool)
+    return pool
+
+
+def close_shell_sessions() -> None:
+    pool = _shell_pool.get()
+    if pool is not None:
+        _shell_pool.set(None)
+        pool.close()
+
+
+_global_slots = threading.BoundedSemaphore(max(COMMAND_GLOBAL_LIMIT, 1))
+
+
+def global_command_slots() -> threading.BoundedSemaphore:
+    """Places des COMMAND_GLOBAL_LIMIT commandes simultanées, partagées par les exécutions locales et les agents."""
+    return _global_slots
+
+
+def run_command(command: str, timeout: Optional[float] = None,
+                on_line: Optional[Callable[[str, str], None]] = None) -> CommandResult:
+    """
+    Exécute une commande dans un shell persistant du scan courant s'il y en a un, sinon dans un
+    shell dédié (run_command_async), via la boucle asyncio partagée.
+    Au-delà de COMMAND_GLOBAL_LIMIT commandes simultanées, l'appel attend qu'une commande se termine.
+    L'annulation du scan courant tue le groupe de processus de la commande et lève ScanCancelled.
+    """
+    timeout = timeout or command_timeout(command)
+    with _global_slots:
+        pool = _shell_pool.get()
+        if pool is not None:
+            return pool.run(command, timeout, on_line)
+        return wait_cancellable(
+            asyncio.run_coroutine_threadsafe(run_command_async(command, timeout, on_line), get_llm_loop())
+        )
@@ -0,0 +1,298 @@
+import atexit
+import contextvars
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from typing import Dict, Iterable, List, Optional
+
+from app.services.agent_registry import AGENT_TOKEN, get_agent_registry
+from app.services.tool_inventory import tool_package
+
+# Nombre de conteneurs prêts (outils installés, agent inscrit) maintenus en réserve ; 0 = pool désactivé
+WARM_POOL_SIZE = int(os.environ.get("WARM_POOL_SIZE", "0"))
+# Conteneurs démarrés au-delà de la réserve pendant que des scans en louent : total plafonné à
+# WARM_POOL_SIZE + WARM_POOL_BURST, les conteneurs en trop sont supprimés à leur retour
+WARM_POOL_BURST = int(os.environ.get("WARM_POOL_BURST", "2"))
+WARM_POOL_BASE_IMAGE = os.environ.get("WARM_POOL_BASE_IMAGE", "kalilinux/kali-rolling")
+WARM_POOL_IMAGE = os.environ.get("WARM_POOL_IMAGE", "pentral-scanner")
+WARM_POOL_NETWORK = os.environ.get("WARM_POOL_NETWORK", "")
+# Adresse du backend vue depuis les conteneurs (inscription des agents)
+WARM_POOL_BACKEND_URL = os.environ.get("WARM_POOL_BACKEND_URL", "http://host.docker.internal:5000")
+# Nombre de scans servis par un conteneur avant son remplacement
+WARM_POOL_MAX_REUSE = int(os.environ.get("WARM_POOL_MAX_REUSE", "20"))
+WARM_POOL_CHECK_INTERVAL = 5
+# Délai d'attente d'un conteneur prêt quand la réserve est vide au démarrage d'un scan
+WARM_POOL_LEASE_WAIT = float(os.environ.get("WARM_POOL_LEASE_WAIT", "0"))
+
+AGENT_SCRIPT = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../scan_agent.py"))
+AGENT_PORT = 8701
+# Paquets nécessaires à l'agent lui-même
+BASE_PACKAGES = ["python3", "procps", "iproute2"]
+
+DOCKERFILE_TEMPLATE = """FROM {base}
+ENV DEBIAN_FRONTEND=noninteractive
+RUN apt-get update \\
+ && apt-get install -y --no-install-recommends {packages} \\
+ && rm -rf /var/lib/apt/lists/*
+COPY scan_agent.py /opt/pentral/scan_agent.py
+EXPOSE {port}
+CMD ["sh", "-c", "exec python3 /opt/pentral/scan_agent.py --port {port} --advertise http://$(hostname -i | cut -d' ' -f1):{port}"]
+"""
+
+
+def _docker(*args: str, timeout: float = 120) -> subprocess.CompletedProcess:
+    return subprocess.run(["docker", *args], capture_output=True, text=True, timeout=timeout)
+
+
+class WarmContainer:
+    def __init__(self, name: str):
+        self.name = name
+        self.created_at = time.time()
+        self.leased_by: Optional[str] = None
+        self.uses = 0
+
+    def to_dict(self) -> Dict:
+        return {"name": self.name, "leased_by": self.leased_by, "uses": self.uses, "created_at": self.created_at}
+
+
+class ContainerPool:
+    """
+    Réserve de conteneurs de scan pré-chauffés : l'image est construite une fois à partir du manifeste
+    d'outils (paquets apt de TOOL_MAP et du profil de scan), chaque conteneur lance scan_agent.py et
+    s'inscrit comme agent d'exécution. Un scan loue un conteneur (ses commandes y sont envoyées en
+    priorité), le rend en fin de scan ; le conteneur est réinitialisé (redémarré, /tmp vidé) avant
+    d'être reloué. Un thread de fond construit l'image et complète la réserve.
+    """
+
+    def __init__(self, tools: Iterable[str], size: int = WARM_POOL_SIZE, burst: int = WARM_POOL_BURST):
+        self.size = size
+        self.burst = max(burst, 0)
+        self.packages = sorted({tool_package(tool) for tool in tools} | set(BASE_PACKAGES))
+        self._lock = threading.Lock()
+        self._containers: Dict[str, WarmContainer] = {}
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.image: Optional[str] = None
+        self.leases = 0
+        self.misses = 0
+
+    # Manifeste et image
+
+    def manifest_tag(self) -> str:
+        with open(AGENT_SCRIPT, "rb") as f:
+            agent_source = f.read()
+        digest = hashlib.sha256(
+            "\n".join([WARM_POOL_BASE_IMAGE, *self.packages]).encode() + agent_source
+        ).hexdigest()[:12]
+        return f"{WARM_POOL_IMAGE}:{digest}"
+
+    def build_image(self) -> Optional[str]:
+        """Construit l'image du manifeste si elle n'existe pas encore (même tag = mêmes outils)."""
+        tag = self.manifest_tag()
+        if _docker("image", "inspect", tag).returncode == 0:
+            return tag
+        print(f"[INFO] Construction de l'image {tag} ({len(self.packages)} paquets) : {' '.join(self.packages)}")
+        with tempfile.TemporaryDirectory(prefix="pentral-image-") as context:
+            with open(os.path.join(context, "Dockerfile"), "w") as f:
+                f.write(DOCKERFILE_TEMPLATE.format(base=WARM_POOL_BASE_IMAGE, packages=" ".join(self.packages),
+                                                   port=AGENT_PORT))
+            shutil.copy(AGENT_SCRIPT, os.path.join(context, "scan_agent.py"))
+            result = _docker("build", "-t", tag, context, timeout=3600)
+        if result.returncode != 0:
+            print(f"[ERREUR] Construction de l'image {tag} impossible : {result.stderr.strip()[-500:]}")
+            return None
+        return tag
+
+    # Cycle de vie des conteneurs
+
+    def _start_container(self) -> Optional[WarmContainer]:
+        name = f"pentral-scanner-{uuid.uuid4().hex[:8]}"
+        args = ["run", "-d", "--name", name, "--label", "pentral.pool=1",
+                "--add-host", "host.docker.internal:host-gateway",
+                "-e", f"AGENT_NAME={name}", "-e", f"AGENT_BACKEND={WARM_POOL_BACKEND_URL}",
+                "-e", f"AGENT_TOKEN={AGENT_TOKEN}"]
+        if WARM_POOL_NETWORK:
+            args += ["--network", WARM_POOL_NETWORK]
+        result = _docker(*args, self.image)
+        if result.returncode != 0:
+            print(f"[ERREUR] Démarrage du conteneur {name} impossible : {result.stderr.strip()}")
+            return None
+        container = WarmContainer(name)
+        with self._lock:
+            self._containers[name] = container
+        print(f"[INFO] Conteneur de scan démarré : {name}")
+        return container
+
+    def _remove_container(self, name: str) -> None:
+        with self._lock:
+            self._containers.pop(name, None)
+        get_agent_registry().unregister(name)
+        _docker("rm", "-f", name)
+
+    def _reset_container(self, container: WarmContainer) -> None:
+        """Remise à zéro entre deux scans : fichiers temporaires supprimés, processus arrêtés par le redémarrage."""
+        name = container.name
+        get_agent_registry().unregister(name)
+        _docker("exec", name, "sh", "-c", "rm -rf /tmp/* /var/tmp/* /root/.*_history 2>/dev/null; true")
+        if _docker("restart", "-t", "2", name).returncode != 0:
+            print(f"[AVERTISSEMENT] Réinitialisation de {name} impossible, conteneur remplacé")
+            self._remove_container(name)
+            return
+        with self._lock:
+            container.leased_by = None
+
+    def _is_ready(self, container: WarmContainer) -> bool:
+        return container.leased_by is None and any(
+            agent["name"] == container.name and agent["alive"]
+            for agent in get_agent_registry().get_stats()["agents"]
+        )
+
+    def idle(self) -> List[WarmContainer]:
+        with self._lock:
+            containers = list(self._containers.values())
+        return [container for container in containers if self._is_ready(container)]
+
+    def _refill(self) -> None:
+        if self.image is None:
+            self.image = self.build_image()
+            if self.image is None:
+                return
+        with self._lock:
+            total = len(self._containers)
+            available = sum(1 for c in self._containers.values() if c.leased_by is None)
+        # Conteneurs loués ou en cours de recyclage compris dans le total
+        for _ in range(max(min(self.size - available, self.size + self.burst - total), 0)):
+            self._start_container()
+
+    def _remove_stale(self) -> None:
+        """Supprime les conteneurs laissés par une exécution précédente du backend."""
+        result = _docker("ps", "-aq", "--filter", "label=pentral.pool=1")
+        stale = result.stdout.split() if result.returncode == 0 else []
+        if stale:
+            print(f"[INFO] Suppression de {len(stale)} conteneur(s) de scan orphelin(s)")
+            _docker("rm", "-f", *stale)
+
+    def _run(self) -> None:
+        try:
+            self._remove_stale()
+        except Exception as e:
+            print(f"[AVERTISSEMENT] Nettoyage des conteneurs orphelins impossible : {e}")
+        while True:
+            try:
+                self._refill()
+            except Exception as e:
+                print(f"[ERREUR] Pool de conteneurs : {e}")
+            self._wakeup.wait(WARM_POOL_CHECK_INTERVAL)
+            self._wakeup.clear()
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="warm-container-pool", daemon=True)
+            self._thread.start()
+
+    # Location
+
+    def lease(self, scan_key: str, wait: float = WARM_POOL_LEASE_WAIT) -> Optional[str]:
+        """Loue un conteneur prêt pour le scan ; None si la réserve est vide (exécution sans conteneur dédié)."""
+        deadline = time.monotonic() + wait
+        while True:
+            with self._lock:
+                for container in self._containers.values():
+                    if self._is_ready(container):
+                        container.leased_by = scan_key
+                        container.uses += 1
+                        self.leases += 1
+                        break
+                else:
+                    container = None
+            if container is not None or time.monotonic() >= deadline:
+                break
+            time.sleep(0.5)
+        self._wakeup.set()
+        if container is None:
+            self.misses += 1
+            print(f"[AVERTISSEMENT] Aucun conteneur de scan prêt pour {scan_key}")
+            return None
+        get_agent_registry().set_reserved(container.name, True)
+        print(f"[INFO] Conteneur {container.name} loué par le scan {scan_key}")
+        return container.name
+
+    def release(self, name: str) -> None:
+        """Rend le conteneur en arrière-plan (voir _recycle)."""
+        with self._lock:
+            container = self._containers.get(name)
+        if container is None:
+            return
+        threading.Thread(target=self._recycle, args=(container,), name=f"recycle-{name}", daemon=True).start()
+
+    def _recycle(self, container: WarmContainer) -> None:
+        """
+        Conteneur rendu : supprimé après WARM_POOL_MAX_REUSE scans ou si la réserve est déjà pleine
+        (conteneur démarré en surplus), sinon réinitialisé pour le scan suivant.
+        """
+        with self._lock:
+            idle = sum(1 for c in self._containers.values() if c.leased_by is None)
+        if container.uses >= WARM_POOL_MAX_REUSE or idle >= self.size:
+            self._remove_container(container.name)
+        else:
+            self._reset_container(container)
+        self._wakeup.set()
+
+    def shutdown(self) -> None:
+        with self._lock:
+            names = list(self._containers)
+        for name in names:
+            self._remove_container(name)
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            containers = [c.to_dict() for c in self._containers.values()]
+        return {"size": self.size, "burst": self.burst, "image": self.image, "packages": self.packages, "leases": self.leases,
+                "misses": self.misses, "containers": containers}
+
+
+_pool: Optional[ContainerPool] = None
+# Conteneur loué par le scan courant ; propagé aux threads de sonde avec le contexte du scan
+_leased: contextvars.ContextVar = contextvars.ContextVar("scan_container", default=None)
+
+
+def start_container_pool(tools: Iterable[str]) -> Optional[ContainerPool]:
+    """Démarre la réserve de conteneurs (sans effet si WARM_POOL_SIZE=0 ou sans jeton d'agent)."""
+    global _pool
+    if _pool is not None or WARM_POOL_SIZE <= 0:
+        return _pool
+    if not AGENT_TOKEN:
+        print("[AVERTISSEMENT] WARM_POOL_SIZE défini sans AGENT_TOKEN : pool de conteneurs désactivé")
+        return None
+    _pool = ContainerPool(tools)
+    _pool.start()
+    atexit.register(_pool.shutdown)
+    return _pool
+
+
+def get_container_pool() -> Optional[ContainerPool]:
+    return _pool
+
+
+def lease_scan_container(scan_key: str) -> Optional[str]:
+    if _pool is None:
+        return None
+    name = _pool.lease(scan_key)
+    _leased.set(name)
+    return name
+
+
+def current_scan_container() -> Optional[str]:
+    return _leased.get()
+
+
+def release_scan_container() -> None:
+    name = _leased.get()
+    if name and _pool is not None:
+        _leased.set(None)
+        _pool.release(name)
@@ -0,0 +1,142 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterator, List, Optional
+
+# Cache des complétions LLM (désactivé par défaut, activer avec LLM_CACHE_ENABLED=1)
+LLM_CACHE_ENABLED = os.environ.get("LLM_CACHE_ENABLED", "0") == "1"
+LLM_CACHE_PATH = os.environ.get("LLM_CACHE_PATH", "llm_cache.sqlite3")
+# Taille maximale du cache sur disque (octets de réponses stockées)
+LLM_CACHE_MAX_BYTES = int(os.environ.get("LLM_CACHE_MAX_BYTES", str(50 * 1024 * 1024)))
+# Durée de vie d'une entrée (secondes)
+LLM_CACHE_TTL = int(os.environ.get("LLM_CACHE_TTL", str(7 * 24 * 3600)))
+
+# Paramètres du payload qui influencent la réponse générée. max_tokens n'en fait pas partie : le budget
+# appris (token_budget) change après chaque appel, et une réponse coupée par la limite n'est pas mise en cache.
+KEY_FIELDS = ("model", "temperature", "top_p", "seed", "stop", "grammar", "json_schema", "response_format", "n")
+
+
+def _normalize_text(text: str) -> str:
+    """Supprime l'indentation et les espaces superflus pour ne pas dépendre du formatage des f-strings."""
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def make_cache_key(payload: Dict) -> str:
+    """Hash normalisé du prompt, du modèle et des paramètres d'échantillonnage."""
+    messages = [
+        {"role": m.get("role", ""), "content": _normalize_text(m.get("content", ""))}
+        for m in payload.get("messages", [])
+    ]
+    material = {"messages": messages}
+    for field in KEY_FIELDS:
+        if field in payload:
+            material[field] = payload[field]
+    encoded = json.dumps(material, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+def split_tokens(text: str) -> List[str]:
+    """Découpe une réponse en pseudo-tokens (mot + espaces) pour rejouer le streaming."""
+    return re.findall(r"\S+\s*|\s+", text)
+
+
+class CompletionCache:
+    """
+    Cache disque (SQLite) des réponses LLM, adressé par le contenu de la requête.
+    Éviction LRU lorsque la taille totale dépasse max_bytes, expiration après ttl secondes.
+    """
+
+    def __init__(self, path: str = LLM_CACHE_PATH, max_bytes: int = LLM_CACHE_MAX_BYTES,
+                 ttl: int = LLM_CACHE_TTL):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS completions ("
+                " key TEXT PRIMARY KEY,"
+                " response TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " last_access REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON completions(last_access)")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=10)
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT response, created_at FROM completions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            response, created_at = row
+            if now - created_at > self.ttl:
+                conn.execute("DELETE FROM completions WHERE key = ?", (key,))
+                self.misses += 1
+                return None
+            conn.execute("UPDATE completions SET last_access = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return response
+
+    def put(self, key: str, response: str) -> None:
+        size = len(response.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO completions (key, response, size, created_at, last_access)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (key, response, size, now, now)
+            )
+            conn.execute("DELETE FROM completions WHERE created_at < ?", (now - self.ttl,))
+            self._evict(conn)
+
+    def _evict(self, conn: sqlite3.Connection) -> None:
+        """Supprime les entrées les moins récemment utilisées jusqu'à repasser sous la limite."""
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in conn.execute(
+            "SELECT key, size FROM completions ORDER BY last_access ASC"
+        ).fetchall():
+            conn.execute("DELETE FROM completions WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def replay(self, response: str) -> Iterator[str]:
+        """Rejoue une réponse en cache sous forme de fragments, comme un flux llama.cpp."""
+        for token in split_tokens(response):
+            yield token
+
+    def get_stats(self) -> Dict:
+        return {"hits": self.hits, "misses": self.misses}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_completion_cache() -> Optional[CompletionCache]:
+    """Retourne le cache partagé, ou None si le cache n'est pas activé."""
+    global _cache
+    if not LLM_CACHE_ENABLED:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = CompletionCache()
+    return _cache
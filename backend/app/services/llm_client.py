@@ -0,0 +1,502 @@
+import asyncio
+import json
+import os
+import threading
+from typing import Any, AsyncIterator, Awaitable, Dict, Iterator, List, Optional
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from app.services.llm_cache import get_completion_cache, make_cache_key
+from app.services.llm_router import LLM_ENDPOINTS, LLMEndpoint, LLMRouter, is_request_error
+from app.services.scan_cancel import wait_cancellable
+
+# Endpoint llama.cpp par défaut (format OpenAI-like)
+DEFAULT_API_URL = os.environ.get("LLM_API_URL", "http://host.docker.internal:8080/v1/chat/completions")
+# Timeouts (secondes) : établissement de la connexion / attente entre deux tokens
+LLM_CONNECT_TIMEOUT = float(os.environ.get("LLM_CONNECT_TIMEOUT", "5"))
+LLM_READ_TIMEOUT = float(os.environ.get("LLM_READ_TIMEOUT", "300"))
+# Nombre de connexions persistantes conservées par hôte
+LLM_POOL_SIZE = int(os.environ.get("LLM_POOL_SIZE", "4"))
+# Nombre de requêtes simultanées autorisées (= nombre de slots du serveur llama.cpp, option --parallel)
+LLM_SLOTS = int(os.environ.get("LLM_SLOTS", "2"))
+
+DEFAULT_HEADERS = {
+    "Content-Type": "application/json",
+    "Accept": "application/json"
+}
+
+
+def _parse_stream_line(line: bytes) -> Optional[str]:
+    """
+    Extrait le fragment de texte d'une ligne SSE llama.cpp.
+    Retourne None pour la fin de flux ([DONE]) et "" pour une ligne sans contenu.
+    """
+    raw = line[6:] if line.startswith(b"data: ") else line
+    if raw.strip() == b"[DONE]":
+        return None
+    try:
+        data = json.loads(raw)
+        choice = data["choices"][0]
+        if "delta" in choice:
+            return choice["delta"].get("content", "") or ""
+        return choice.get("message", {}).get("content", "") or ""
+    except Exception as e:
+        print(f"[ERREUR] Parsing stream : {e} - raw={raw}")
+        return ""
+
+
+def _parse_stream_timings(line: bytes) -> Optional[Dict]:
+    """Bloc "timings" (prompt_n, prompt_ms, cache_n...) envoyé par llama.cpp avec le dernier fragment."""
+    if b'"timings"' not in line:
+        return None
+    raw = line[6:] if line.startswith(b"data: ") else line
+    try:
+        return json.loads(raw).get("timings")
+    except Exception:
+        return None
+
+
+class _ConnectionCounter:
+    """
+    Compteur partagé des connexions TCP réellement ouvertes.
+    requests obtient la connexion dans le thread appelant : le thread sait donc si sa requête
+    en a ouvert une nouvelle ou réutilisé une connexion du pool.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.value = 0
+
+    def increment(self):
+        with self._lock:
+            self.value += 1
+        self._local.opened = True
+
+    def begin_request(self):
+        self._local.opened = False
+
+    def opened_by_request(self) -> bool:
+        return getattr(self._local, "opened", False)
+
+
+def _counting_pool(base_cls, counter: _ConnectionCounter):
+    """Sous-classe un pool urllib3 pour compter chaque nouvelle connexion."""
+
+    class CountingPool(base_cls):
+        def _new_conn(self):
+            counter.increment()
+            return super()._new_conn()
+
+    return CountingPool
+
+
+class _CountingAdapter(HTTPAdapter):
+    """Adaptateur requests dont les pools signalent les connexions créées."""
+
+    def __init__(self, counter: _ConnectionCounter, **kwargs):
+        self._counter = counter
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _counting_pool(HTTPConnectionPool, self._counter),
+            "https": _counting_pool(HTTPSConnectionPool, self._counter),
+        }
+
+
+class LLMClient:
+    """
+    Client HTTP partagé vers llama.cpp.
+    Conserve un pool de connexions keep-alive réutilisées d'une requête à l'autre
+    (et d'un scan à l'autre) au lieu d'ouvrir une connexion TCP par prompt.
+    """
+
+    def __init__(self, api_url: str = DEFAULT_API_URL,
+                 connect_timeout: float = LLM_CONNECT_TIMEOUT,
+                 read_timeout: float = LLM_READ_TIMEOUT,
+                 pool_size: int = LLM_POOL_SIZE):
+        self.api_url = api_url
+        self.timeout = (connect_timeout, read_timeout)
+        self._connections = _ConnectionCounter()
+        self._stats_lock = threading.Lock()
+        self._requests = 0
+        self._errors = 0
+        self._reused = 0
+
+        self.session = requests.Session()
+        adapter = _CountingAdapter(self._connections, pool_connections=pool_size,
+                                   pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _post(self, payload: Dict, api_url: Optional[str], stream: bool) -> requests.Response:
+        with self._stats_lock:
+            self._requests += 1
+        self._connections.begin_request()
+        try:
+            response = self.session.post(api_url or self.api_url, json=payload,
+                                         headers=DEFAULT_HEADERS, stream=stream,
+                                         timeout=self.timeout)
+            response.raise_for_status()
+            # Une requête en échec ne compte pas comme réutilisation
+            if not self._connections.opened_by_request():
+                with self._stats_lock:
+                    self._reused += 1
+            return response
+        except requests.exceptions.RequestException:
+            with self._stats_lock:
+                self._errors += 1
+            raise
+
+    def stream_chat(self, payload: Dict, api_url: Optional[str] = None,
+                    use_cache: bool = True) -> Iterator[str]:
+        """
+        Envoie une requête chat/completions en streaming et renvoie les fragments
+        de texte au fur et à mesure. Si le serveur répond sans streaming, le
+        message complet est renvoyé en un seul fragment.
+        Lorsque le cache est activé, une réponse connue est rejouée sans appel au LLM.
+        """
+        cache = get_completion_cache() if use_cache else None
+        key = make_cache_key(payload) if cache else None
+        if cache:
+            cached = cache.get(key)
+            if cached is not None:
+                print("[CACHE] Réponse LLM servie depuis le cache")
+                yield from cache.replay(cached)
+                return
+
+        chunks = []
+        state: Dict = {}
+        for delta in self._stream_remote(payload, api_url, state):
+            chunks.append(delta)
+            yield delta
+
+        # Une réponse coupée par max_tokens n'est pas gardée (max_tokens ne fait pas partie de la clé)
+        if cache and chunks and not state.get("truncated"):
+            cache.put(key, "".join(chunks))
+
+    def _stream_remote(self, payload: Dict, api_url: Optional[str], state: Dict) -> Iterator[str]:
+        response = self._post(payload, api_url, stream=True)
+        with response:
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                if b'"finish_reason":"length"' in line:
+                    state["truncated"] = True
+                delta = _parse_stream_line(line)
+                if delta is None:
+                    break
+                if delta:
+                    yield delta
+
+    def chat(self, payload: Dict, api_url: Optional[str] = None, use_cache: bool = True) -> str:
+        """Envoie une requête chat/completions sans streaming et renvoie le contenu."""
+        cache = get_completion_cache() if use_cache else None
+        key = make_cache_key(payload) if cache else None
+        if cache:
+            cached = cache.get(key)
+            if cached is not None:
+                print("[CACHE] Réponse LLM servie depuis le cache")
+                return cached
+
+        response = self._post(payload, api_url, stream=False)
+        data = response.json()
+        content = data["choices"][0]["message"]["content"].strip()
+        if cache and content and data["choices"][0].get("finish_reason") != "length":
+            cache.put(key, content)
+        return content
+
+    def get_stats(self) -> Dict:
+        """Compteurs de réutilisation des connexions du pool."""
+        with self._stats_lock:
+            stats = {
+                "requests": self._requests,
+                "errors": self._errors,
+                "connections_opened": self._connections.value,
+                "connections_reused": self._reused,
+            }
+        cache = get_completion_cache()
+        if cache:
+            stats["cache"] = cache.get_stats()
+        return stats
+
+    def close(self):
+        self.session.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_llm_client() -> LLMClient:
+    """Retourne le client LLM partagé par tous les moteurs de scan."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = LLMClient()
+    return _client
+
+
+class AsyncLLMClient:
+    """
+    Variante asyncio du client LLM (aiohttp).
+    Les requêtes sont réparties entre les serveurs de LLM_ENDPOINTS (LLM_API_URL par défaut)
+    par un LLMRouter ; pour chaque serveur, un sémaphore limite les générations simultanées
+    au nombre de slots llama.cpp : au-delà, les requêtes attendent leur tour au lieu de saturer le serveur.
+    Doit être utilisé depuis la boucle partagée (voir run_llm_coroutine).
+    """
+
+    def __init__(self, api_url: str = DEFAULT_API_URL,
+                 connect_timeout: float = LLM_CONNECT_TIMEOUT,
+                 read_timeout: float = LLM_READ_TIMEOUT,
+                 pool_size: int = LLM_POOL_SIZE,
+                 slots: int = LLM_SLOTS,
+                 endpoints: Optional[List[str]] = None):
+        self.api_url = api_url
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.pool_size = pool_size
+        self.slots = slots
+        self.router = LLMRouter(endpoints or LLM_ENDPOINTS or [api_url], slots)
+        self._session = None
+        self._requests = 0
+        self._errors = 0
+        self._opened = 0
+        self._reused = 0
+        self._in_flight = 0
+        self._waiting = 0
+        self._stop_reasons: Dict[str, int] = {}
+
+    async def _on_connection_create(self, session, ctx, params):
+        self._opened += 1
+
+    async def _on_connection_reuse(self, session, ctx, params):
+        self._reused += 1
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            trace = aiohttp.TraceConfig()
+            trace.on_connection_create_end.append(self._on_connection_create)
+            trace.on_connection_reuseconn.append(self._on_connection_reuse)
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(sock_connect=self.connect_timeout,
+                                              sock_read=self.read_timeout),
+                headers=DEFAULT_HEADERS,
+                trace_configs=[trace]
+            )
+        return self._session
+
+    async def stream_chat(self, payload: Dict, api_url: Optional[str] = None,
+                          use_cache: bool = True, meta: Optional[Dict] = None,
+                          prefer: Optional[str] = None) -> AsyncIterator[str]:
+        """
+        Équivalent asynchrone de LLMClient.stream_chat, borné par les slots llama.cpp.
+        Sans api_url, le serveur est choisi par le routeur (prefer : serveur épinglé par le scan,
+        conservé tant qu'il répond) ; si la connexion échoue avant le premier token, la requête
+        bascule sur un autre serveur. Une requête refusée (4xx) ne rend pas le serveur indisponible.
+        Si meta est fourni, il est complété avec les informations de l'appel
+        (cache_hit, completion_tokens : nombre de fragments streamés, un par token avec llama.cpp,
+        stop_reason : done, length, eof, cache, ou early_stop si l'appelant a fermé le flux,
+        timings : mesures de llama.cpp si le serveur les renvoie).
+        Fermer le générateur (aclose) coupe la connexion, ce qui arrête la génération côté llama.cpp.
+        Si l'appelant pose meta["block_complete"] avant de fermer le flux (réponse structurée déjà
+        complète), l'arrêt compte comme un succès et la réponse partielle est mise en cache.
+        """
+        if meta is None:
+            meta = {}
+        meta["cache_hit"] = False
+        meta["completion_tokens"] = 0
+        meta.pop("stop_reason", None)
+        meta.pop("timings", None)
+        cache = get_completion_cache() if use_cache else None
+        key = make_cache_key(payload) if cache else None
+        if cache:
+            cached = cache.get(key)
+            if cached is not None:
+                print("[CACHE] Réponse LLM servie depuis le cache")
+                meta["cache_hit"] = True
+                meta["stop_reason"] = "cache"
+                self._count_stop("cache")
+                for token in cache.replay(cached):
+                    yield token
+                return
+
+        chunks = []
+        completed = False
+        self.router.start_health_checks(self._get_session)
+        tried = set()
+        try:
+            while True:
+                endpoint = self.router.direct(api_url) if api_url else self.router.pick(tried, prefer)
+                if endpoint is None:
+                    raise aiohttp.ClientConnectionError("Aucun serveur LLM disponible")
+                tried.add(endpoint)
+                stream = self._stream_endpoint(endpoint, payload, meta, chunks)
+                try:
+                    async for delta in stream:
+                        yield delta
+                    self.router.mark_success(endpoint)
+                    completed = True
+                    break
+                except GeneratorExit:
+                    # Flux fermé par l'appelant : succès si la réponse structurée était complète
+                    if meta.get("block_complete"):
+                        self.router.mark_success(endpoint)
+                    raise
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if is_request_error(e):
+                        raise
+                    self.router.mark_failure(endpoint, e)
+                    # Bascule uniquement si rien n'a encore été transmis à l'appelant
+                    if api_url or chunks or self.router.pick(tried) is None:
+                        raise
+                    print("[INFO] Nouvel essai de la requête LLM sur un autre serveur")
+                    meta.pop("stop_reason", None)
+                finally:
+                    await stream.aclose()
+        finally:
+            # Aussi à la fermeture anticipée (aclose lève GeneratorExit au yield) : le bloc détecté
+            # est rejoué depuis le cache et l'appelant le détecte à nouveau
+            if cache and chunks and (completed or meta.get("block_complete")) \
+                    and meta.get("stop_reason") != "length":
+                cache.put(key, "".join(chunks))
+
+    async def _stream_endpoint(self, endpoint: LLMEndpoint, payload: Dict, meta: Dict,
+                               chunks: List[str]) -> AsyncIterator[str]:
+        """Flux d'une requête sur un serveur donné, dans la limite de ses slots."""
+        self._waiting += 1
+        endpoint.outstanding += 1
+        acquired = False
+        try:
+            async with endpoint.semaphore():
+                self._waiting -= 1
+                acquired = True
+                self._in_flight += 1
+                self._requests += 1
+                endpoint.requests += 1
+                try:
+                    async with self._get_session().post(endpoint.chat_url, json=payload) as response:
+                        response.raise_for_status()
+                        async for line in response.content:
+                            line = line.strip()
+                            if not line:
+                                continue
+                            if b'"finish_reason":"length"' in line:
+                                meta["stop_reason"] = "length"
+                            timings = _parse_stream_timings(line)
+                            if timings:
+                                meta["timings"] = timings
+                            delta = _parse_stream_line(line)
+                            if delta is None:
+                                meta.setdefault("stop_reason", "done")
+                                break
+                            if delta:
+                                chunks.append(delta)
+                                meta["completion_tokens"] += 1
+                                yield delta
+                    meta.setdefault("stop_reason", "eof")
+                except GeneratorExit:
+                    # Flux fermé par l'appelant avant la fin (réponse structurée déjà complète)
+                    meta.setdefault("stop_reason", "early_stop")
+                    raise
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    self._errors += 1
+                    meta.setdefault("stop_reason", "error")
+                    raise
+                finally:
+                    self._in_flight -= 1
+                    self._count_stop(meta.get("stop_reason", "error"))
+        finally:
+            if not acquired:
+                # Annulé avant l'obtention d'un slot
+                self._waiting -= 1
+            endpoint.outstanding -= 1
+
+    def _count_stop(self, reason: str) -> None:
+        self._stop_reasons[reason] = self._stop_reasons.get(reason, 0) + 1
+
+    async def chat(self, payload: Dict, api_url: Optional[str] = None, use_cache: bool = True) -> str:
+        """Renvoie la réponse complète (le streaming est consommé en interne)."""
+        parts = []
+        async for delta in self.stream_chat(dict(payload, stream=True), api_url, use_cache):
+            parts.append(delta)
+        return "".join(parts).strip()
+
+    def get_stats(self) -> Dict:
+        stats = {
+            "requests": self._requests,
+            "errors": self._errors,
+            "connections_opened": self._opened,
+            "connections_reused": self._reused,
+            "in_flight": self._in_flight,
+            "waiting": self._waiting,
+            "slots": self.slots,
+            "stop_reasons": dict(self._stop_reasons),
+            "endpoints": self.router.get_stats(),
+        }
+        cache = get_completion_cache()
+        if cache:
+            stats["cache"] = cache.get_stats()
+        return stats
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+_loop = None
+_loop_lock = threading.Lock()
+_async_client = None
+
+
+def get_llm_loop() -> asyncio.AbstractEventLoop:
+    """
+    Boucle asyncio dédiée aux appels LLM, démarrée à la demande dans un thread de fond.
+    Sous eventlet (run.py), ce thread est un greenlet et le sélecteur de la boucle attend via le hub :
+    les autres greenlets (Socket.IO) continuent de tourner (voir tests/test_eventlet_runtime.py).
+    """
+    global _loop
+    if _loop is None:
+        with _loop_lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=loop.run_forever, name="llm-loop", daemon=True)
+                thread.start()
+                _loop = loop
+    return _loop
+
+
+def get_async_llm_client() -> AsyncLLMClient:
+    """Retourne le client LLM asynchrone partagé (à utiliser dans la boucle get_llm_loop)."""
+    global _async_client
+    if _async_client is None:
+        with _loop_lock:
+            if _async_client is None:
+                _async_client = AsyncLLMClient()
+    return _async_client
+
+
+def run_llm_coroutine(coro: Awaitable) -> Any:
+    """
+    Exécute une coroutine LLM dans la boucle partagée et attend son résultat (appelants synchrones).
+    L'annulation du scan courant annule la coroutine, ce qui ferme le flux llama.cpp en cours.
+    """
+    return wait_cancellable(asyncio.run_coroutine_threadsafe(coro, get_llm_loop()))
+
+
+async def _gather(coros: List[Awaitable]) -> List[Any]:
+    return await asyncio.gather(*coros)
+
+
+def run_llm_batch(coros: List[Awaitable]) -> List[Any]:
+    """Lance plusieurs coroutines LLM en parallèle (dans la limite des slots) et renvoie leurs résultats dans l'ordre."""
+    if not coros:
+        return []
+    return run_llm_coroutine(_gather(list(coros)))
@@ -0,0 +1,147 @@
+import asyncio
+import os
+import time
+from typing import Callable, Dict, List, Optional, Set
+
+import aiohttp
+
+# Serveurs llama.cpp disponibles, séparés par des virgules (ex. "http://llm1:8080,http://llm2:8080")
+LLM_ENDPOINTS = [url.strip() for url in os.environ.get("LLM_ENDPOINTS", "").split(",") if url.strip()]
+# Intervalle entre deux vérifications de santé (secondes, 0 pour désactiver)
+LLM_HEALTH_INTERVAL = float(os.environ.get("LLM_HEALTH_INTERVAL", "10"))
+LLM_HEALTH_TIMEOUT = 3
+
+CHAT_PATH = "/v1/chat/completions"
+
+
+def _base_url(url: str) -> str:
+    url = url.rstrip("/")
+    if url.endswith(CHAT_PATH):
+        url = url[:-len(CHAT_PATH)]
+    return url
+
+
+def is_request_error(error: Exception) -> bool:
+    """
+    Erreur 4xx : la requête elle-même est refusée (ex. json_schema rejeté) ; le serveur reste sain
+    et un autre serveur la refuserait aussi. 429 (saturation) reste une erreur du serveur.
+    """
+    return isinstance(error, aiohttp.ClientResponseError) and 400 <= error.status < 500 and error.status != 429
+
+
+class LLMEndpoint:
+    """Un serveur llama.cpp : URL, état de santé et nombre de requêtes en cours ou en attente."""
+
+    def __init__(self, url: str, slots: int):
+        self.base_url = _base_url(url)
+        self.chat_url = self.base_url + CHAT_PATH
+        self.health_url = self.base_url + "/health"
+        self.slots = max(slots, 1)
+        self.healthy = True
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.last_error: Optional[str] = None
+        self.last_check: Optional[float] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def semaphore(self) -> asyncio.Semaphore:
+        """Limite les requêtes simultanées au nombre de slots du serveur."""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.slots)
+        return self._semaphore
+
+    def get_stats(self) -> Dict:
+        return {
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+            "last_error": self.last_error,
+        }
+
+
+class LLMRouter:
+    """
+    Répartit les requêtes entre plusieurs serveurs llama.cpp :
+    le serveur sain ayant le moins de requêtes en cours (rapporté à ses slots) est choisi,
+    un serveur en erreur est écarté jusqu'à ce que la vérification /health le déclare de nouveau prêt.
+    """
+
+    def __init__(self, urls: List[str], slots: int, health_interval: float = LLM_HEALTH_INTERVAL):
+        self.endpoints = [LLMEndpoint(url, slots) for url in urls]
+        self.slots = slots
+        self.health_interval = health_interval
+        self._direct: Dict[str, LLMEndpoint] = {}
+        self._health_task: Optional[asyncio.Task] = None
+
+    def pick(self, exclude: Optional[Set[LLMEndpoint]] = None,
+             prefer: Optional[str] = None) -> Optional[LLMEndpoint]:
+        """
+        prefer : serveur épinglé par le scan (cache KV de son slot), retenu tant qu'il est sain
+        et pas encore essayé ; sinon le serveur le moins chargé.
+        """
+        exclude = exclude or set()
+        candidates = [e for e in self.endpoints if e not in exclude]
+        healthy = [e for e in candidates if e.healthy]
+        if prefer:
+            base = _base_url(prefer)
+            for endpoint in healthy:
+                if endpoint.base_url == base:
+                    return endpoint
+        # Si aucun serveur n'est déclaré sain, on tente quand même les autres plutôt que d'échouer
+        pool = healthy or candidates
+        if not pool:
+            return None
+        return min(pool, key=lambda e: e.outstanding / e.slots)
+
+    def direct(self, url: str) -> LLMEndpoint:
+        """Serveur imposé par l'appelant (api_url explicite) : pas de routage ni de bascule."""
+        base = _base_url(url)
+        for endpoint in self.endpoints:
+            if endpoint.base_url == base:
+                return endpoint
+        if base not in self._direct:
+            self._direct[base] = LLMEndpoint(url, self.slots)
+        return self._direct[base]
+
+    def mark_failure(self, endpoint: LLMEndpoint, error: Exception) -> None:
+        endpoint.failures += 1
+        endpoint.healthy = False
+        endpoint.last_error = str(error) or type(error).__name__
+        print(f"[AVERTISSEMENT] Serveur LLM {endpoint.base_url} marqué indisponible : {endpoint.last_error}")
+
+    def mark_success(self, endpoint: LLMEndpoint) -> None:
+        endpoint.healthy = True
+
+    async def probe(self, endpoint: LLMEndpoint, session: aiohttp.ClientSession) -> bool:
+        """GET /health : 200 quand le modèle est chargé, 503 pendant le chargement."""
+        try:
+            async with session.get(endpoint.health_url,
+                                   timeout=aiohttp.ClientTimeout(total=LLM_HEALTH_TIMEOUT)) as response:
+                ok = response.status == 200
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            ok = False
+            endpoint.last_error = str(e) or type(e).__name__
+        if ok and not endpoint.healthy:
+            print(f"[INFO] Serveur LLM {endpoint.base_url} de nouveau disponible")
+        endpoint.healthy = ok
+        endpoint.last_check = time.time()
+        return ok
+
+    async def probe_all(self, session: aiohttp.ClientSession) -> None:
+        await asyncio.gather(*(self.probe(e, session) for e in self.endpoints))
+
+    async def _health_loop(self, get_session: Callable[[], aiohttp.ClientSession]) -> None:
+        while True:
+            await self.probe_all(get_session())
+            await asyncio.sleep(self.health_interval)
+
+    def start_health_checks(self, get_session: Callable[[], aiohttp.ClientSession]) -> None:
+        """Lance les vérifications périodiques dans la boucle courante (une seule fois)."""
+        if self.health_interval <= 0 or self._health_task is not None:
+            return
+        self._health_task = asyncio.ensure_future(self._health_loop(get_session))
+
+    def get_stats(self) -> Dict:
+        return {e.base_url: e.get_stats() for e in self.endpoints}
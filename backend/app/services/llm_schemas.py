@@ -0,0 +1,46 @@
+import json
+import os
+from typing import Dict, Optional
+
+import yaml
+
+# Décodage contraint par schéma (json_schema llama.cpp), désactivable avec LLM_CONSTRAINED_DECODING=0
+LLM_CONSTRAINED_DECODING = os.environ.get("LLM_CONSTRAINED_DECODING", "1") == "1"
+
+# Forme attendue des réponses de génération de commande
+TOOL_COMMAND_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "tool_name": {"type": "string", "minLength": 1},
+        "enumerate_command": {"type": "string", "minLength": 1},
+        "install_command": {"type": "string"}
+    },
+    "required": ["tool_name", "enumerate_command", "install_command"],
+    "additionalProperties": False
+}
+
+
+def apply_output_schema(payload: Dict, schema: Optional[Dict]) -> Dict:
+    """Ajoute le schéma de sortie au payload llama.cpp (la grammaire est dérivée côté serveur)."""
+    if schema and LLM_CONSTRAINED_DECODING:
+        payload["json_schema"] = schema
+    return payload
+
+
+def schema_response_to_yaml(response: str, schema: Optional[Dict]) -> str:
+    """
+    Convertit une réponse JSON contrainte en YAML "clé: valeur" sur une ligne,
+    le format attendu par clean_command / is_valid_tool_yaml.
+    Retourne la réponse inchangée si elle n'est pas du JSON (serveur sans support du schéma).
+    """
+    if not schema or not LLM_CONSTRAINED_DECODING or not response:
+        return response
+    try:
+        data = json.loads(response)
+    except ValueError:
+        return response
+    if not isinstance(data, dict):
+        return response
+    # Une valeur par ligne : pas de retour à la ligne ni de guillemets doubles (retirés par clean_query)
+    flat = {key: " ".join(str(value).split()) for key, value in data.items()}
+    return yaml.safe_dump(flat, sort_keys=False, allow_unicode=True, width=float("inf")).strip()
@@ -0,0 +1,130 @@
+import contextvars
+import threading
+import time
+from typing import Dict, List, Optional
+
+# Nombre maximal d'appels détaillés conservés par scan (le résumé couvre tous les appels)
+TELEMETRY_MAX_CALLS = 500
+
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(int(round(q / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+class ScanTelemetry:
+    """
+    Mesures de chaque appel LLM d'un scan (type de prompt, tokens, temps jusqu'au premier token,
+    latence totale, profondeur de réessai, cache) et leur agrégation par type de prompt.
+    """
+
+    def __init__(self, scan_id: str):
+        self.scan_id = scan_id
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        self._calls: List[Dict] = []
+        self._types: Dict[str, Dict] = {}
+        self.total_calls = 0
+
+    def record(self, call: Dict) -> Dict:
+        generation_ms = call.get("latency_ms", 0.0) - (call.get("ttft_ms") or 0.0)
+        tokens = call.get("completion_tokens", 0)
+        call["tokens_per_sec"] = round(tokens / (generation_ms / 1000), 1) if tokens and generation_ms > 0 else 0.0
+        call["timestamp"] = time.time()
+        with self._lock:
+            self.total_calls += 1
+            self._calls.append(call)
+            if len(self._calls) > TELEMETRY_MAX_CALLS:
+                self._calls.pop(0)
+            agg = self._types.setdefault(call.get("prompt_type") or "generic", {
+                "calls": 0, "errors": 0, "retries": 0, "max_retry_depth": 0, "cache_hits": 0,
+                "prompt_tokens": 0, "completion_tokens": 0, "generation_ms": 0.0,
+                "ttft_ms": [], "latency_ms": []
+            })
+            agg["calls"] += 1
+            agg["errors"] += 1 if call.get("error") else 0
+            agg["retries"] += 1 if call.get("retry_depth", 0) > 0 else 0
+            agg["max_retry_depth"] = max(agg["max_retry_depth"], call.get("retry_depth", 0))
+            agg["cache_hits"] += 1 if call.get("cache_hit") else 0
+            agg["prompt_tokens"] += call.get("prompt_tokens", 0)
+            agg["completion_tokens"] += tokens
+            agg["generation_ms"] += max(generation_ms, 0.0)
+            if call.get("ttft_ms") is not None:
+                agg["ttft_ms"].append(call["ttft_ms"])
+            agg["latency_ms"].append(call.get("latency_ms", 0.0))
+        return call
+
+    def summary(self) -> Dict:
+        with self._lock:
+            by_type = {}
+            for prompt_type, agg in self._types.items():
+                by_type[prompt_type] = {
+                    "calls": agg["calls"],
+                    "errors": agg["errors"],
+                    "retries": agg["retries"],
+                    "max_retry_depth": agg["max_retry_depth"],
+                    "cache_hits": agg["cache_hits"],
+                    "prompt_tokens": agg["prompt_tokens"],
+                    "completion_tokens": agg["completion_tokens"],
+                    "ttft_ms_avg": round(sum(agg["ttft_ms"]) / len(agg["ttft_ms"]), 1) if agg["ttft_ms"] else 0.0,
+                    "ttft_ms_p95": round(_percentile(agg["ttft_ms"], 95), 1),
+                    "latency_ms_total": round(sum(agg["latency_ms"]), 1),
+                    "latency_ms_avg": round(sum(agg["latency_ms"]) / len(agg["latency_ms"]), 1),
+                    "latency_ms_p95": round(_percentile(agg["latency_ms"], 95), 1),
+                    "tokens_per_sec": round(agg["completion_tokens"] / (agg["generation_ms"] / 1000), 1)
+                    if agg["generation_ms"] > 0 else 0.0
+                }
+            return {
+                "calls": self.total_calls,
+                "llm_time_ms": round(sum(t["latency_ms_total"] for t in by_type.values()), 1),
+                "wall_time_ms": round((time.time() - self.started_at) * 1000, 1),
+                "by_prompt_type": by_type
+            }
+
+    def to_document(self) -> Dict:
+        """Forme enregistrée sur le document du scan (scans_collection)."""
+        summary = self.summary()
+        with self._lock:
+            calls = list(self._calls)
+        return {"summary": summary, "calls": calls}
+
+
+# Télémétrie du scan en cours : une ContextVar plutôt qu'un thread-local, car les appels
+# s'exécutent dans la boucle LLM et run_coroutine_threadsafe propage le contexte de l'appelant.
+_current: contextvars.ContextVar = contextvars.ContextVar("llm_scan_telemetry", default=None)
+_active: Dict[str, ScanTelemetry] = {}
+_active_lock = threading.Lock()
+
+
+def start_scan_telemetry(scan_id: str) -> ScanTelemetry:
+    """Ouvre la télémétrie du scan ; les appels LLM lancés ensuite depuis ce contexte y sont rattachés."""
+    telemetry = ScanTelemetry(scan_id)
+    with _active_lock:
+        _active[scan_id] = telemetry
+    _current.set(telemetry)
+    return telemetry
+
+
+def finish_scan_telemetry(scan_id: str) -> Optional[Dict]:
+    """Ferme la télémétrie du scan et renvoie le document à enregistrer (None si déjà fermée)."""
+    with _active_lock:
+        telemetry = _active.pop(scan_id, None)
+    if _current.get() is telemetry:
+        _current.set(None)
+    return telemetry.to_document() if telemetry else None
+
+
+def get_scan_telemetry(scan_id: str) -> Optional[ScanTelemetry]:
+    """Télémétrie d'un scan encore en cours."""
+    with _active_lock:
+        return _active.get(scan_id)
+
+
+def record_llm_call(**call) -> None:
+    """Enregistre un appel LLM dans la télémétrie du scan courant (sans effet hors d'un scan)."""
+    telemetry = _current.get()
+    if telemetry is not None:
+        telemetry.record(call)
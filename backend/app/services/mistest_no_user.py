@@ -1,3 +1,7 @@
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ThreadPoolExecutor, wait
 import requests
 import subprocess
 import re
@@ -12,6 +16,26 @@ from jinja2 import Environment, FileSystemLoader
 import pdfkit
 from datetime import datetime
 import smtplib
+from app.services.llm_client import LLM_SLOTS, get_async_llm_client, run_llm_batch, run_llm_coroutine
+from app.services.stream_batcher import flush_stream
+from app.services.llm_schemas import TOOL_COMMAND_SCHEMA, apply_output_schema, schema_response_to_yaml
+from app.services.token_budget import get_token_budgets
+from app.services.yaml_stream import YamlBlockDetector
+from app.services.prompt_context import build_history_context, build_list_context, get_prompt_stats
+from app.services.llm_telemetry import record_llm_call
+from app.services.output_buffer import EXCERPT_BYTE_BUDGET, build_excerpt
+from app.services.command_cache import get_command_cache
+from app.services.agent_registry import dispatch_command, get_agent_registry
+from app.services.container_pool import current_scan_container, lease_scan_container, release_scan_container
+from app.services.scan_cancel import check_cancelled
+from app.services.target_limiter import command_host, get_target_limiter
+from app.services.tool_inventory import command_tools, get_tool_inventory
+from app.services.package_installer import install_packages, parse_install_command
+from app.services.command_executor import (COMMAND_MAX_OUTPUT_BYTES, COMMAND_POOL_PER_TARGET, CommandResult,
+                                           close_shell_sessions, command_timeout, open_shell_sessions, run_command)
+from app.services.prompt_cache import (apply_prompt_cache, current_scan_endpoint, current_scan_slot,
+                                      get_prefill_stats,
+                                      pin_scan_slot, release_scan_slot)
 import sys
 sys.path.insert(0, "/root/nvdlib")
 import nvdlib
@@ -19,6 +43,8 @@ from typing import List
 import time
 
 scan_status_callback = print
+streaming_callback = None
+command_output_callback = None
 
 def emit_scan_status(status, message="", data=None):
     """Émet un statut de scan vers le back"""
@@ -46,6 +72,7 @@ def get_user_response():
         data = response.json()
         if data["status"] == "ready" and data["user_response"] is not None:
             return data["user_response"], data["user_command"]
+        check_cancelled()
         time.sleep(1)  # Attendre 1 seconde avant de réessayer
         
 def send_validation(command, is_valid):
@@ -61,6 +88,7 @@ def get_user_validation():
         print("Réponse script : ", data["user_response"])
         if data["status"] == "ready" and data["user_response"] is not None:
             return data["user_response"], data["user_command"]
+        check_cancelled()
         time.sleep(1)  # Attendre 1 seconde avant de réessayer
         
 def send_command(command):
@@ -76,6 +104,7 @@ def get_unpause():
         print("Réponse script : ", data["status"])
         if data["status"] == "ready" :
             return
+        check_cancelled()
         time.sleep(1)
         
 
@@ -88,6 +117,35 @@ MAX_RETRY_ATTEMPTS = 3
 DEFAULT_TOKEN_LIMIT = 800  # Augmenté par défaut
 ANALYSIS_TOKEN_LIMIT = 800
 REPORT_TOKEN_LIMIT = 800
+# Budgets par défaut par type de prompt, utilisés tant que le budget appris (p99) n'est pas disponible
+PROMPT_TYPE_TOKEN_LIMITS = {
+    "command": DEFAULT_TOKEN_LIMIT * 1.5,
+    "analysis": ANALYSIS_TOKEN_LIMIT,
+    "report": REPORT_TOKEN_LIMIT,
+}
+# Clés attendues dans les réponses structurées (arrêt du flux dès qu'elles sont complètes)
+COMMAND_REQUIRED_KEYS = ["tool_name", "enumerate_command"]
+ANALYSIS_REQUIRED_KEYS = ["tool_name", "status", "services_discovered"]
+# Nombre de commandes candidates générées en parallèle pour un service (1 = génération unique)
+COMMAND_CANDIDATES = int(os.environ.get("LLM_COMMAND_CANDIDATES", "1"))
+# Échantillonnage des candidates supplémentaires, pour qu'elles diffèrent de la première
+CANDIDATE_TEMPERATURE = 0.7
+# Requêtes simultanées vers l'API NVD, toutes sondes parallèles confondues (limite de débit de l'API)
+NVD_CONCURRENCY = int(os.environ.get("NVD_CONCURRENCY", "1"))
+_nvd_slots = threading.BoundedSemaphore(max(NVD_CONCURRENCY, 1))
+
+def detect_prompt_type(prompt: str, output_schema=None) -> str:
+    """Déduit le type d'un prompt lorsque l'appelant ne le précise pas."""
+    lowered = prompt.lower()
+    if output_schema:
+        return "command"
+    if "analyse des resultats" in lowered:
+        return "analysis"
+    if "rapport" in lowered:
+        return "report"
+    if "commande d'énumération" in lowered or "enumerate_command" in lowered:
+        return "command"
+    return "generic"
 
 def clean_recommendation_block(block: str) -> str:
     """
@@ -289,12 +347,16 @@ def format_llm_yaml_response(yaml_str: str) -> dict:
 
 
 
-def clean_and_analyze_result(analyzed_result: str) -> dict:
+def clean_and_analyze_result(analyzed_result) -> dict:
     """
     Nettoie et analyse le résultat du LLM de manière robuste
+    (accepte aussi le dictionnaire déjà analysé pendant le streaming)
     """
     try:
-        formatted_data = format_llm_yaml_response(analyzed_result)
+        if isinstance(analyzed_result, dict):
+            formatted_data = analyzed_result
+        else:
+            formatted_data = format_llm_yaml_response(analyzed_result)
         
         result = {
             "tool_name": formatted_data.get("tool_name", "unknown"),
@@ -392,11 +454,28 @@ def save_command_validation(validation: Dict) -> None:
     with open(COMMAND_VALIDATION_FILE, 'w') as f:
         json.dump(validation, f, indent=2)
 
-def query_llm(prompt, api_url="http://host.docker.internal:8080/v1/chat/completions",
-              max_tokens_override=None, retry_count=0, emit_callback=None):
+async def aquery_llm(prompt, api_url=None,
+                     max_tokens_override=None, retry_count=0, emit_callback=None, output_schema=None,
+                     prompt_type=None, stop_on_keys=None, stop_parser=None, result_meta=None, id_slot=None,
+                     sampling=None, endpoint=None):
     """
     Envoie une requête à l'API REST de llama.cpp (format OpenAI-like) avec gestion
     améliorée des tokens et des erreurs.
+    Version asynchrone : plusieurs appels peuvent être lancés ensemble, le client
+    partagé les limite au nombre de slots du serveur.
+    api_url : serveur imposé ; par défaut, la requête est répartie entre les serveurs
+    de LLM_ENDPOINTS (LLM_API_URL si non défini), avec bascule en cas d'erreur.
+    output_schema : schéma JSON imposé au décodage (ex. TOOL_COMMAND_SCHEMA), la réponse
+    est alors renvoyée au format YAML habituel.
+    prompt_type : type du prompt pour le budget de tokens appris (déduit du prompt si absent),
+    max_tokens_override devient alors un plafond.
+    stop_on_keys : clés requises ; le flux est coupé dès qu'un bloc YAML (ou l'objet JSON imposé par
+    output_schema) les contenant est complet.
+    L'objet analysé (stop_parser, yaml.safe_load par défaut) et la raison d'arrêt sont
+    renvoyés dans result_meta si fourni.
+    id_slot : slot llama.cpp réservé au scan (réutilisation du cache KV du préfixe commun).
+    endpoint : serveur de ce slot, préféré par le routeur tant qu'il répond.
+    sampling : paramètres d'échantillonnage remplaçant ceux par défaut (temperature, seed...).
     """
     global streaming_callback
     
@@ -407,21 +486,18 @@ def query_llm(prompt, api_url="http://host.docker.internal:8080/v1/chat/completi
         callback_to_use = print
     
     try:
-        # Déterminer le nombre approprié de tokens pour la réponse
-        max_tokens = DEFAULT_TOKEN_LIMIT
-        
-        # Ajustements spécifiques selon le type de requête
+        # Déterminer le nombre approprié de tokens pour la réponse :
+        # p99 des tokens produits pour ce type de prompt + marge, sinon budget par défaut du type
+        prompt_type = prompt_type or detect_prompt_type(prompt, output_schema)
         if max_tokens_override:
-            max_tokens = max_tokens_override
-        elif "analyse des resultats" in prompt.lower():
-            max_tokens = ANALYSIS_TOKEN_LIMIT
-        elif "rapport" in prompt.lower():
-            max_tokens = REPORT_TOKEN_LIMIT
-        elif "commande d'énumération" in prompt.lower() or "enumerate_command" in prompt.lower():
-            max_tokens = DEFAULT_TOKEN_LIMIT * 1.5  # Augmentation pour les commandes
+            max_tokens = get_token_budgets().budget(prompt_type, max_tokens_override, cap=max_tokens_override)
+        else:
+            max_tokens = get_token_budgets().budget(
+                prompt_type, PROMPT_TYPE_TOKEN_LIMITS.get(prompt_type, DEFAULT_TOKEN_LIMIT))
             
         # Log pour le débogage
-        print(f"[DEBUG] Requête avec {max_tokens} tokens maximum")
+        prompt_tokens = get_prompt_stats().record(prompt_type, prompt)
+        print(f"[DEBUG] Requête ({prompt_type}) : prompt ~{prompt_tokens} tokens, {max_tokens} tokens maximum")
             
         # Payload compatible avec l'API de llama.cpp
         payload = {
@@ -436,47 +512,53 @@ def query_llm(prompt, api_url="http://host.docker.internal:8080/v1/chat/completi
             "stream": True,
             "echo": False
         }
+        if sampling:
+            payload.update(sampling)
+        # Décodage contraint : la réponse respecte forcément le schéma demandé
+        apply_output_schema(payload, output_schema)
+        # Préfixe commun déjà calculé dans le slot du scan : seul le suffixe est recalculé
+        apply_prompt_cache(payload, id_slot)
         
         # echo = si le prompt en renvoyer par le llm 
         # ctx_size = taille memoire
         # batch_size = vitesse 
         # repeat_penalty # penaliter pour les reponses repetitives
         
-        # En-têtes nécessaires
-        headers = {
-            "Content-Type": "application/json",
-            "Accept": "application/json"
-        }
-
         print("[QUERY] Envoi de la requête à l'API...")
-        response = requests.post(api_url, json=payload, headers=headers)
-        response.raise_for_status()
-        
         buffer = ""
-        for line in response.iter_lines():
-            if line:
-                if line.startswith(b"data: "):
-                    raw = line[6:]
-                else:
-                    raw = line
-
-                if raw.strip() == b"[DONE]":
-                    break
-                try:
-                    data = json.loads(raw)
-                    delta = data["choices"][0]["delta"].get("content", "")
-                    buffer += delta
-                    callback_to_use(delta)  # Utilise le callback approprié
-                except Exception as e:
-                    print(f"[ERREUR] Parsing stream : {e} - raw={raw}")
-                    continue
-        
-        if buffer:
-            llm_response = buffer
-        else:
-            # Récupère la réponse (format OpenAI)
-            data = response.json()
-            llm_response = data["choices"][0]["message"]["content"].strip()
+        stream_meta = {}
+        detector = YamlBlockDetector(stop_on_keys, stop_parser) if stop_on_keys else None
+        started = time.perf_counter()
+        first_token_at = None
+        stream = get_async_llm_client().stream_chat(payload, api_url, meta=stream_meta, prefer=endpoint)
+        async for delta in stream:
+            if first_token_at is None:
+                first_token_at = time.perf_counter()
+            buffer += delta
+            callback_to_use(delta)  # Utilise le callback approprié
+            if detector and detector.feed(delta):
+                stream_meta["block_complete"] = True  # Mis en cache malgré l'arrêt anticipé
+                break
+        await stream.aclose()  # Coupe la connexion si le bloc est complet avant la fin du flux
+        latency_ms = (time.perf_counter() - started) * 1000
+        flush_stream(callback_to_use)  # Fin de flux : envoie les tokens encore en tampon
+        if detector and detector.block is not None:
+            print(f"[INFO] Réponse structurée complète, flux interrompu après {stream_meta.get('completion_tokens', 0)} tokens")
+            buffer = detector.block
+        if stream_meta.get("timings"):
+            prefill = get_prefill_stats().record(stream_meta["timings"], prompt_tokens)
+            print(f"[DEBUG] Prefill (slot {id_slot}) : {prefill}")
+        if result_meta is not None:
+            result_meta["stop_reason"] = stream_meta.get("stop_reason")
+            result_meta["parsed"] = detector.parsed if detector else None
+        if not stream_meta.get("cache_hit"):
+            get_token_budgets().record(prompt_type, stream_meta.get("completion_tokens", 0))
+        record_llm_call(prompt_type=prompt_type, prompt_tokens=prompt_tokens,
+                        completion_tokens=stream_meta.get("completion_tokens", 0),
+                        ttft_ms=round((first_token_at - started) * 1000, 1) if first_token_at else None,
+                        latency_ms=round(latency_ms, 1), retry_depth=retry_count,
+                        cache_hit=stream_meta.get("cache_hit", False), stop_reason=stream_meta.get("stop_reason"))
+        llm_response = schema_response_to_yaml(buffer, output_schema)
         
         print("fin de reponse version complete", llm_response)
         
@@ -491,7 +573,8 @@ def query_llm(prompt, api_url="http://host.docker.internal:8080/v1/chat/completi
                 if retry_count < MAX_RETRY_ATTEMPTS:
                     # Reformuler le prompt pour insister sur le format YAML complet
                     enhanced_prompt = prompt + "\n\nCRITIQUE: Ta réponse précédente était incorrecte ou incomplète. Tu DOIS répondre UNIQUEMENT avec un YAML valide contenant AU MINIMUM 'tool_name:' et 'enumerate_command:' clairement définis. Vérifie la syntaxe YAML. Et sans texte supplémentaire"
-                    return query_llm(enhanced_prompt, api_url, max_tokens_override, retry_count + 1)
+                    return await aquery_llm(enhanced_prompt, api_url, max_tokens_override, retry_count + 1, emit_callback, output_schema, prompt_type,
+                                      stop_on_keys, stop_parser, result_meta, id_slot, sampling, endpoint)
                 else:
                     print(f"[ERREUR] Échec après {MAX_RETRY_ATTEMPTS} tentatives. Dernière réponse: {llm_response}")
                     
@@ -500,6 +583,7 @@ def query_llm(prompt, api_url="http://host.docker.internal:8080/v1/chat/completi
     except Exception as e:
         error_msg = f"[ERREUR CRITIQUE] dans query_llm: {str(e)}"
         print(error_msg)
+        record_llm_call(prompt_type=prompt_type, retry_depth=retry_count, error=str(e))
         if callback_to_use and callback_to_use != print:
             callback_to_use(f"\n{error_msg}\n")
         return error_msg
@@ -513,14 +597,108 @@ def query_llm(prompt, api_url="http://host.docker.internal:8080/v1/chat/completi
         if retry_count < MAX_RETRY_ATTEMPTS:
             wait_time = 2 ** retry_count
             print(f"[INFO] Nouvel essai dans {wait_time} secondes...")
-            time.sleep(wait_time)
-            return query_llm(prompt, api_url, max_tokens_override, retry_count + 1)
+            await asyncio.sleep(wait_time)
+            return await aquery_llm(prompt, api_url, max_tokens_override, retry_count + 1, emit_callback, output_schema, prompt_type,
+                                      stop_on_keys, stop_parser, result_meta, id_slot, sampling, endpoint)
         return None
         
     except Exception as e:
         print(f"[ERREUR] Erreur inattendue: {e}")
         return None
 
+def query_llm(prompt, api_url=None,
+              max_tokens_override=None, retry_count=0, emit_callback=None, output_schema=None,
+              prompt_type=None, stop_on_keys=None, stop_parser=None, result_meta=None, id_slot=None,
+              sampling=None, endpoint=None):
+    """
+    Version synchrone de aquery_llm, conservée pour les appelants existants.
+    Par défaut la requête est épinglée sur le serveur et le slot llama.cpp réservés au scan en cours.
+    """
+    if id_slot is None:
+        id_slot = current_scan_slot()
+        endpoint = endpoint or current_scan_endpoint()
+    return run_llm_coroutine(aquery_llm(prompt, api_url, max_tokens_override, retry_count, emit_callback,
+                                        output_schema, prompt_type, stop_on_keys, stop_parser, result_meta,
+                                        id_slot, sampling, endpoint))
+
+def _silent_callback(token):
+    """Callback muet : les générations parallèles ne sont pas streamées en direct."""
+    return None
+
+def emit_deferred(response):
+    """Transmet d'un bloc une réponse générée sans streaming (sonde parallèle), sans entrelacer les tokens."""
+    if response and streaming_callback:
+        streaming_callback(response)
+        flush_stream(streaming_callback)
+
+def query_llm_batch(prompts: List[str], max_tokens_overrides: Optional[List] = None,
+                    replay_deferred: bool = True, output_schema: Optional[Dict] = None,
+                    prompt_types: Optional[List[str]] = None, stop_on_keys: Optional[List[str]] = None) -> List[str]:
+    """
+    Envoie plusieurs prompts indépendants en parallèle, dans la limite des slots llama.cpp.
+    Seul le premier prompt est streamé en direct vers l'interface ; les réponses des autres
+    sont transmises d'un bloc une fois terminées (replay_deferred) pour ne pas entrelacer les tokens.
+    Seul le premier prompt utilise le slot du scan, les autres prennent un slot libre.
+    """
+    if not prompts:
+        return []
+    overrides = max_tokens_overrides or [None] * len(prompts)
+    types = prompt_types or [None] * len(prompts)
+    coros = [aquery_llm(prompts[0], max_tokens_override=overrides[0], output_schema=output_schema,
+                        prompt_type=types[0], stop_on_keys=stop_on_keys, id_slot=current_scan_slot(),
+                        endpoint=current_scan_endpoint())]
+    coros += [aquery_llm(p, max_tokens_override=o, emit_callback=_silent_callback, output_schema=output_schema,
+                         prompt_type=t, stop_on_keys=stop_on_keys)
+              for p, o, t in zip(prompts[1:], overrides[1:], types[1:])]
+    responses = run_llm_batch(coros)
+    if replay_deferred and streaming_callback:
+        for response in responses[1:]:
+            if response:
+                streaming_callback(response)
+        flush_stream(streaming_callback)
+    return responses
+
+def query_llm_candidates(prompt: str, n: int) -> List[str]:
+    """
+    Génère n commandes candidates pour le même prompt en une seule vague de requêtes parallèles.
+    llama.cpp n'accepte qu'un choix par requête (pas de n>1) : chaque candidate occupe un slot,
+    avec une graine et une température différentes pour ne pas obtenir n fois la même réponse.
+    Seule la première candidate est streamée en direct et utilise le slot du scan.
+    """
+    coros = [aquery_llm(prompt, output_schema=TOOL_COMMAND_SCHEMA, stop_on_keys=COMMAND_REQUIRED_KEYS,
+                        id_slot=current_scan_slot(), endpoint=current_scan_endpoint())]
+    coros += [aquery_llm(prompt, emit_callback=_silent_callback, output_schema=TOOL_COMMAND_SCHEMA,
+                         stop_on_keys=COMMAND_REQUIRED_KEYS,
+                         sampling={"temperature": CANDIDATE_TEMPERATURE, "seed": index})
+              for index in range(1, n)]
+    return run_llm_batch(coros)
+
+def select_command_candidate(candidates: List[str], history: List[Dict]) -> Optional[str]:
+    """
+    Passe les candidates, dans l'ordre, par les contrôles habituels de phase2 (YAML valide,
+    doublon, options de la commande) et renvoie la première acceptable, None si aucune ne l'est.
+    """
+    for index, candidate in enumerate(candidates, 1):
+        if not candidate or candidate.startswith("[ERREUR") or not is_valid_tool_yaml(candidate):
+            print(f"[DEBUG] Candidate #{index} rejetée : YAML invalide")
+            continue
+        yaml_data = yaml.safe_load(clean_command(candidate))
+        command = yaml_data.get("enumerate_command")
+        if not isinstance(command, str) or not command.strip():
+            print(f"[DEBUG] Candidate #{index} rejetée : commande vide")
+            continue
+        if is_duplicate_command(command, history):
+            print(f"[DEBUG] Candidate #{index} rejetée : doublon ({command})")
+            continue
+        is_valid, message = validate_command(str(yaml_data.get("tool_name")), command)
+        if not is_valid:
+            print(f"[DEBUG] Candidate #{index} rejetée : {message}")
+            continue
+        print(f"[INFO] Candidate #{index}/{len(candidates)} retenue : {command}")
+        return candidate
+    print(f"[AVERTISSEMENT] Aucune des {len(candidates)} candidates n'est valide, correction séquentielle")
+    return None
+
 def validate_command(tool_name: str, command: str, container_name = "kali-pentest") -> Tuple[bool, str]:
     """
     Valide une commande d'énumération pour s'assurer qu'elle utilise des arguments valides.
@@ -734,43 +912,12 @@ def update_command_errors(tool_name: str, command: str, error_msg: str) -> None:
     
     # save_command_validation(validation_db)
 
-def analyze_result_with_llm(raw_result, target, enumerate_command):
-    """
-    Envoie le résultat brut à llm pour analyse et extraction des informations essentielles.
-    Version améliorée avec meilleur traitement des erreurs et focus sur les CPE/CVE.
-    """
-    try:
-        # Extraire la commande réelle à partir du YAML si possible
-        cmd_to_show = ""
-        try:
-            yaml_data = yaml.safe_load(enumerate_command)
-            if yaml_data and 'enumerate_command' in yaml_data:
-                cmd_to_show = yaml_data['enumerate_command']
-            elif isinstance(enumerate_command, str):
-                cmd_to_show = enumerate_command
-        except:
-            cmd_to_show = enumerate_command
-            
-        # Détection des erreurs dans le résultat
-        error_detected = False
-        if not isinstance(raw_result, str) or any(
-            kw in raw_result.lower() for kw in ["error", "usage:", "command not found", "failed"]
-        ):
-            error_detected = True
-    
-        # Construis le prompt pour demander à llm d'analyser le résultat
-        prompt = f"""
+# Partie fixe du prompt d'analyse des résultats (préfixe réutilisable par le cache de prompt)
+ANALYSIS_PROMPT_PREFIX = """
         <s>[INST]
         ### ANALYSE DE RÉSULTATS DE PENTEST
 
-        En tant qu'expert en tests d'intrusion, analysez précisément ces résultats :
-
-        Cible : {target}
-        Commande exécutée : {cmd_to_show}
-        Résultat {"contient des erreurs" if error_detected else "brut"} :
-        
-        {raw_result}
-        
+        En tant qu'expert en tests d'intrusion, analysez précisément les résultats fournis en fin de message.
 
         ### FORMAT DE RÉPONSE STRICTEMENT REQUIS (YAML UNIQUEMENT)
         ```yaml
@@ -796,15 +943,67 @@ def analyze_result_with_llm(raw_result, target, enumerate_command):
         - IDENTIFIER les CPE (Common Platform Enumeration) quand possible
 
         Si la commande a échoué ou contient des erreurs, indiquez clairement status: ERROR et expliquez la raison de l'échec dans les points d'intérêt.
+"""
+
+def analyze_result_with_llm(raw_result, target, enumerate_command, deferred=False):
+    """
+    Envoie le résultat brut à llm pour analyse et extraction des informations essentielles.
+    Version améliorée avec meilleur traitement des erreurs et focus sur les CPE/CVE.
+    """
+    try:
+        # Extraire la commande réelle à partir du YAML si possible
+        cmd_to_show = ""
+        try:
+            yaml_data = yaml.safe_load(enumerate_command)
+            if yaml_data and 'enumerate_command' in yaml_data:
+                cmd_to_show = yaml_data['enumerate_command']
+            elif isinstance(enumerate_command, str):
+                cmd_to_show = enumerate_command
+        except:
+            cmd_to_show = enumerate_command
+            
+        # Sortie trop longue pour le contexte : extrait des lignes les plus utiles
+        if isinstance(raw_result, str):
+            raw_result = build_excerpt(raw_result)
 
+        # Détection des erreurs dans le résultat
+        error_detected = False
+        if not isinstance(raw_result, str) or any(
+            kw in raw_result.lower() for kw in ["error", "usage:", "command not found", "failed"]
+        ):
+            error_detected = True
+    
+        # Construis le prompt pour demander à llm d'analyser le résultat (préfixe fixe puis données variables)
+        prompt = ANALYSIS_PROMPT_PREFIX + f"""
+        ### RÉSULTATS À ANALYSER
+        Cible : {target}
+        Commande exécutée : {cmd_to_show}
+        Résultat {"contient des erreurs" if error_detected else "brut"} :
+        
+        {raw_result}
+        
         Répondez UNIQUEMENT avec le YAML structuré, sans introduction ni conclusion.
         [/INST]</s>
         """
         # Interroge llm pour analyser le résultat avec un token limit augmenté pour l'analyse
-        response = query_llm(prompt, max_tokens_override=ANALYSIS_TOKEN_LIMIT)
+        # Le flux s'arrête dès que le bloc YAML d'analyse est complet ; l'objet analysé est renvoyé directement
+        analysis_meta = {}
+        response = query_llm(
+            prompt, max_tokens_override=ANALYSIS_TOKEN_LIMIT, prompt_type="analysis",
+            stop_on_keys=ANALYSIS_REQUIRED_KEYS,
+            stop_parser=lambda block: format_llm_yaml_response(
+                block.replace("\\_", "_").replace("<ip_address>", target)),
+            result_meta=analysis_meta,
+            # Sondes parallèles : réponse transmise d'un bloc une fois terminée
+            emit_callback=_silent_callback if deferred else None
+        )
         if not response:
             print("[DEBUG] Impossible de communiquer avec llm pour analyser le résultat.")
             return None
+        if deferred:
+            emit_deferred(response)
+        if analysis_meta.get("parsed"):
+            return analysis_meta["parsed"]
         
         # Nettoyage des caractères échappés (\_ → _)
         response = response.replace("\\_", "_")
@@ -916,6 +1115,11 @@ CPE_MAP = {
     "netbios-ssn": ("samba", "samba"),
 }
 
+def nvd_get(base_url: str, params: Dict, headers: Dict) -> requests.Response:
+    """Requête à l'API NVD, au plus NVD_CONCURRENCY à la fois entre les sondes parallèles."""
+    with _nvd_slots:
+        return requests.get(base_url, params=params, headers=headers)
+
 def guess_and_validate_cpe(technologie: str, version: str, api_key: str = None) -> list[str]:
     """
     Génère des CPE candidats à partir du mapping et teste leur existence réelle
@@ -963,7 +1167,7 @@ def guess_and_validate_cpe(technologie: str, version: str, api_key: str = None)
 
         try:
             params = {"cpeMatchString": convert_to_cpe23(cpe), "resultsPerPage": 1}
-            response = requests.get(base_url, params=params, headers=headers)
+            response = nvd_get(base_url, params, headers)
             response.raise_for_status()
             data = response.json()
 
@@ -1042,7 +1246,7 @@ def enrich_report_with_cve(results_nested: list[list[dict]], nist_api_key: str =
                     base_url = "https://services.nvd.nist.gov/rest/json/cves/2.0"
                     params = {"cpeName": cpe23, "resultsPerPage": 100}
                     headers = {"apiKey": nist_api_key} if nist_api_key else {}
-                    response = requests.get(base_url, params=params, headers=headers)
+                    response = nvd_get(base_url, params, headers)
                     response.raise_for_status()
                     data = response.json()
                     vulnerabilities = data.get("vulnerabilities", [])
@@ -1072,6 +1276,7 @@ def enrich_report_with_cve(results_nested: list[list[dict]], nist_api_key: str =
                             criticite = "Haute"
                         elif severity == "MEDIUM" and criticite != "Haute":
                             criticite = "Moyenne"
+                    check_cancelled()
                     time.sleep(1)
 
                 except Exception as e:
@@ -1159,46 +1364,77 @@ def remove_duplicates_keep_best(entries: List[dict]) -> List[dict]:
     return best_entries
 
 
-def execute_command_docker(command, container_name="kali-pentest"):
+def _emit_command_line(stream, line):
+    """Diffuse une ligne de sortie de la commande en cours vers la room Socket.IO du scan."""
+    if command_output_callback:
+        command_output_callback(line + "\n")
+
+def run_scan_command(command, container_name="kali-pentest", target=None) -> CommandResult:
     """
-    Exécute une commande Linux dans un conteneur Docker.
-    Gère les cas de sortie vide, erreur système, ou succès normal.
+    Exécute une commande d'énumération avec le délai propre à l'outil, dans un shell persistant
+    du scan ; la sortie est diffusée ligne par ligne pendant l'exécution. Renvoie un résultat structuré (code retour, durée,
+    dépassement de délai, troncature) ; une erreur de lancement donne un code retour None.
+    Une commande identique réussie récemment sur la même cible est servie par le cache
+    (execution.cached, reporté dans l'historique). Si des agents d'exécution sont inscrits, la commande
+    est confiée au moins chargé qui dispose de ses outils (container_name : agent préféré),
+    sinon elle est exécutée localement. Dans les deux cas, elle passe par le limiteur de l'hôte
+    visé (débit, concurrence par hôte et par protocole, ralenti si la cible sature).
+    """
+    check_cancelled()
+    full_command = command.replace("sudo ", "", 1).replace("`", "").strip()
+    print(f"[DEBUG] Commande complète à exécuter : {full_command}")
+    cache = get_command_cache()
+    execution = cache.get(full_command, target) if cache else None
+    if execution is not None:
+        print(f"[CACHE] Résultat réutilisé (exécuté il y a {execution.cached_age:.0f}s) : {full_command}")
+        if command_output_callback:
+            command_output_callback(f"[CACHE] Résultat d'une exécution d'il y a {execution.cached_age:.0f}s\n")
+            command_output_callback(execution.stdout)
+            flush_stream(command_output_callback)
+        return execution
+    with get_target_limiter().slot(target or command_host(full_command), full_command) as outcome:
+        try:
+            execution = dispatch_command(full_command, command_tools(full_command), on_line=_emit_command_line,
+                                         preferred=current_scan_container() or container_name)
+            if execution is None:
+                execution = run_command(full_command, on_line=_emit_command_line)
+        except Exception as e:
+            print(f"[DEBUG] Erreur générale lors de l'exécution : {e}")
+            execution = CommandResult(full_command, "", str(e), None, 0.0, command_timeout(full_command))
+        outcome["execution"] = execution
+    if cache:
+        cache.put(full_command, target, execution)
+    if command_output_callback:
+        flush_stream(command_output_callback)
+    print(f"[DEBUG] Exécution : {execution.summary()}")
+    return execution
+
+def format_command_result(execution: CommandResult) -> str:
+    """
+    Texte transmis à l'analyse LLM et à la boucle de correction :
+    sortie de la commande, ou marqueur [ERREUR] / [VIDE] / [EXCEPTION] selon le résultat.
+    Une sortie volumineuse est réduite à un extrait des lignes utiles (versions, bannières, CPE).
     """
     try:
-        full_command = command.replace("sudo ", "", 1).replace("`", "").strip()
-        full_command = full_command.replace("`", "").strip()
-        print(f"[DEBUG] Commande complète à exécuter : {full_command}")
+        if execution.exit_code is None and not execution.timed_out:
+            return f"[EXCEPTION] {execution.stderr}"
 
-        result = subprocess.run(
-            [full_command],
-            capture_output=True,
-            text=True,
-            shell=True
-        )
-        stdout = result.stdout.strip()
-        # 🔍 Filtrage des lignes parasites de l'environnement Exegol
-        noise_filters = [
-            "Your version of Exegol wrapper is not up-to-date!",
-            "bash: cannot set terminal process group",
-            "inappropriate ioctl",
-            "no job control",
-            "bash: no job control in this shell"
-        ]
-
-        # Supprime les lignes parasites du stdout
+        # Le shell de session n'est pas interactif : pas de lignes parasites de contrôle de tâches à filtrer
+        stdout = execution.stdout_excerpt().strip()
+        stderr = execution.stderr_excerpt().strip()
 
-        stdout = "\n".join([
-            line for line in result.stdout.splitlines()
-            if all(noise.lower() not in line.lower() for noise in noise_filters)
-        ]).strip()
+        code = execution.exit_code
 
+        if execution.stdout_buffer.size > EXCERPT_BYTE_BUDGET:
+            print(f"[DEBUG] Sortie de {execution.stdout_buffer.size} octets réduite à un extrait de {len(stdout)} caractères")
+        if execution.truncated:
+            stdout += f"\n[TRONQUÉ] Sortie limitée à {COMMAND_MAX_OUTPUT_BYTES} octets par flux"
 
-        stderr = "\n".join([
-            line for line in result.stderr.splitlines()
-            if all(noise not in line.lower() for noise in noise_filters)
-        ]).strip()
-
-        code = result.returncode
+        # Délai dépassé : la sortie partielle reste exploitable
+        if execution.timed_out:
+            note = f"Délai de {execution.timeout:.0f}s dépassé, commande arrêtée"
+            print(f"[AVERTISSEMENT] {note}")
+            return f"{stdout}\n[INTERROMPU] {note}" if stdout else f"[ERREUR] {note}"
 
         #print("Résultat :")
         print("Résultat :", flush=True)
@@ -1231,25 +1467,44 @@ def execute_command_docker(command, container_name="kali-pentest"):
     except Exception as e:
         print(f"[DEBUG] Erreur générale lors de l'exécution : {e}")
         return f"[EXCEPTION] {str(e)}"
+    finally:
+        # Les sorties ne sont plus relues : suppression des fichiers temporaires
+        execution.close()
+
+def execute_command_docker(command, container_name="kali-pentest", target=None):
+    """
+    Exécute une commande Linux dans un conteneur Docker.
+    Gère les cas de sortie vide, erreur système, ou succès normal.
+    """
+    return format_command_result(run_scan_command(command, container_name, target=target))
 
 def execute_install_docker(command, container_name="kali-pentest"):
     """
     Exécute une commande Linux dans un conteneur Docker.
     Retire automatiquement 'sudo' car nous sommes en tant que root.
+    Les installations apt passent par la file d'installation groupée (une transaction pour
+    toutes les demandes en attente, résultat partagé entre les scans).
     """
+    packages = parse_install_command(command) if command else None
+    if packages:
+        status = install_packages(packages)
+        get_tool_inventory(container_name).invalidate()
+        failed = [package for package, ok in status.items() if not ok]
+        if failed:
+            print(f"[ERREUR] Paquets non installés : {', '.join(failed)}")
+            return False
+        return f"Paquets installés : {', '.join(packages)}"
     try:
         full_command = command.replace("sudo ", "", 1)  # Retire 'sudo' si présent
         full_command = full_command.replace("`", "").strip()  # Supprime les backticks et les espaces inutiles
         full_command = full_command + " -y" 
         print(f"[DEBUG] Commande complète à exécuter : {full_command}")
 
-        # Exécute la commande dans le conteneur
-        result = subprocess.run(
-            [full_command],
-            capture_output=True,
-            text=True,
-            shell=True
-        )
+        # Exécute la commande dans le conteneur (shell persistant du scan)
+        result = run_command(full_command)
+
+        # L'installation change l'inventaire du conteneur : il sera sondé à nouveau
+        get_tool_inventory(container_name).invalidate()
 
         # Affiche le résultat brut pour le debug
         print("Résultat :")
@@ -1260,8 +1515,8 @@ def execute_install_docker(command, container_name="kali-pentest"):
             print(f"[DEBUG] Erreur lors de l'exécution : {result.stderr.strip()}")
             return result.stderr.strip()
         #vérifie si la cmnd a réussi
-        if result.returncode != 0 :
-            print(f"([DEBUG]La commande '{command}'a échoué avec le code {result.returncode}.")
+        if result.exit_code != 0 :
+            print(f"([DEBUG]La commande '{command}'a échoué avec le code {result.exit_code}.")
             return False
         
         return result.stdout  # Retourne les résultats de la commande
@@ -1338,7 +1593,7 @@ def generate_command_validation_prompt(command, target, phase, results):
     - Aucune autre réponse ne sera accépter sauf celle sous le format yaml n'ajoute aucun autre texte sauf le yaml contenant la commande modifier ou garder
 
     """
-    response = query_llm(prompt)
+    response = query_llm(prompt, output_schema=TOOL_COMMAND_SCHEMA, stop_on_keys=COMMAND_REQUIRED_KEYS)
 
     return response
 
@@ -1506,7 +1761,8 @@ def phase1_initiale(target):
     
  
     print(f"[INFO] Scan -sV avec vulners : {sV_command}")
-    result_vulners = execute_command_docker(sV_command)
+    sV_execution = run_scan_command(sV_command, target=target)
+    result_vulners = format_command_result(sV_execution)
 
     if not result_vulners:
         print("[ERREUR] Le scan -sV --script vulners a échoué.")
@@ -1534,7 +1790,7 @@ def phase1_initiale(target):
 
     print("results :", results)
 
-    history.append({"command": sV_command, "result": result_vulners})
+    history.append({"command": sV_command, "result": result_vulners, "execution": sV_execution.summary()})
     return results, [
         {
             "tool_name": "nmap",
@@ -1544,6 +1800,157 @@ def phase1_initiale(target):
     ], history
     #return [],[],[]
 
+# Outils recommandés (ok) et interdits (ban) par technologie ; sert aussi à préparer l'inventaire d'outils du scan
+TOOL_MAP = {
+    "ftp": {
+        "ok": [
+            "nmap --script ftp-anon",
+            "nmap --script ftp-bounce",
+            "nmap --script ftp-syst",
+            "echo | nc {target} 21"
+        ],
+        "ban": ["enum4linux", "smbclient", "rpcclient", "http", "ssh", "telnet"]
+    },
+    "http": {
+        "ok": [
+            "whatweb {target}",
+            "curl -I http://{target}",
+            "nmap --script http-title -p 80 {target}"
+        ],
+        "ban": ["ftp", "ssh", "enum4linux", "telnet", "smtp"]
+    },
+    "https": {
+        "ok": [
+            "curl -Ik https://{target}",
+            "nmap --script ssl-cert -p 443 {target}",
+            "nmap --script ssl-enum-ciphers -p 443 {target}"
+        ],
+        "ban": ["ftp", "rpcclient", "smbclient", "telnet"]
+    },
+    "smtp": {
+        "ok": [
+            "openssl s_client -connect {target}:25 -starttls smtp",
+            "nmap --script smtp-commands -p 25 {target}"
+        ],
+        "ban": ["ftp", "telnet", "http", "rpcclient"]
+    },
+    "smb": {
+        "ok": [
+            "enum4linux -a {target}",
+            "smbclient -L {target} -N",
+            "rpcclient -U '' {target} -c 'enumdomusers'"
+        ],
+        "ban": ["ftp", "http", "curl", "ssh", "snmp"]
+    },
+    "snmp": {
+        "ok": [
+            "snmpwalk -v2c -c public {target}",
+            "snmp-check {target}",
+            "nmap --script snmp-info -p 161 {target}"
+        ],
+        "ban": ["ftp", "ssh", "http", "rpcclient"]
+    },
+    "ssh": {
+        "ok": [
+            "ssh -v {target}",
+            "nmap --script ssh2-enum-algos -p 22 {target}",
+            "nmap --script ssh-hostkey -p 22 {target}"
+        ],
+        "ban": ["ftp", "http", "rpcclient", "smbclient"]
+    },
+    "domain": {
+        "ok": [
+            "dig {target}",
+            "nslookup {target}",
+            "nmap --script dns-recursion {target}",
+            "nmap --script dns-nsid {target}"
+        ],
+        "ban": ["ftp", "ssh", "http", "smbclient"]
+    },
+    "telnet": {
+        "ok": [
+            "echo | nc {target} 23",
+            "nmap --script telnet-encryption -p 23 {target}"
+        ],
+        "ban": ["ftp", "ssh", "enum4linux", "http"]
+    },
+    "rpcbind": {
+        "ok": [
+            "rpcinfo -p {target}",
+            "nmap --script rpcinfo -p 111 {target}"
+        ],
+        "ban": ["ftp", "ssh", "http", "enum4linux"]
+    },
+    "exec": {
+        "ok": [
+            "nmap --script rsh-rexec -p 512 {target}",
+            "rusers {target}"
+        ],
+        "ban": ["ftp", "ssh", "smbclient", "http", "rpcclient"]
+    },
+    "login?": {
+        "ok": [
+            "nmap --script rusers -p 513 {target}",
+            "finger {target}"
+        ],
+        "ban": ["ftp", "http", "rpcclient", "ssh"]
+    }
+}
+
+# Outils utilisés hors TOOL_MAP selon le type de cible (phase 1, sous-domaines, WHOIS, DNS)
+SCAN_PROFILE_TOOLS = {
+    "ip": ["nmap"],
+    "domain": ["nmap", "subfinder", "dnsx", "whois", "dig"],
+}
+
+
+def scan_profile_tools(target_type: str) -> List[str]:
+    """Outils que le scan peut lancer : ceux du profil de la cible et ceux recommandés par TOOL_MAP."""
+    tools = list(SCAN_PROFILE_TOOLS.get(target_type, SCAN_PROFILE_TOOLS["ip"]))
+    for constraints in TOOL_MAP.values():
+        for command in constraints["ok"]:
+            for tool in command_tools(command):
+                if tool not in tools:
+                    tools.append(tool)
+    return tools
+
+
+def prepare_scan_tools(target_type: str) -> List[str]:
+    """
+    Planification avant le scan : sonde l'inventaire du conteneur (en cache) et installe d'un coup
+    les outils absents, pour qu'aucune commande n'ait à échouer avant l'installation de son outil.
+    """
+    emit_scan_status("preparing tools", "Vérification des outils disponibles...")
+    if current_scan_container():
+        # Conteneur pré-chauffé loué : l'image contient déjà les outils du profil
+        return []
+    try:
+        missing = get_tool_inventory().ensure(scan_profile_tools(target_type))
+    except Exception as e:
+        print(f"[AVERTISSEMENT] Préparation des outils impossible : {e}")
+        return []
+    if missing:
+        print(f"[AVERTISSEMENT] Outils indisponibles pour ce scan : {', '.join(missing)}")
+    return missing
+
+
+def ensure_command_tools(command: str, install_command: Optional[str] = None) -> bool:
+    """
+    Vérifie avant exécution que les outils de la commande sont présents (inventaire en cache) ;
+    les absents sont installés d'abord, via install_command proposé par le LLM en dernier recours.
+    """
+    tools = command_tools(command)
+    if get_agent_registry().has_capable_agent(tools):
+        # Un agent d'exécution dispose déjà des outils : rien à installer localement
+        return True
+    inventory = get_tool_inventory()
+    missing = inventory.ensure(tools)
+    if missing and install_command:
+        execute_install_docker(install_command)
+        missing = inventory.missing(missing)
+    return not missing
+
+
 def is_service_incomplete(service: Dict, history: List[Dict]) -> bool:
     tech = service.get("technologie", "").lower()
     port = str(service.get("port", ""))
@@ -1565,101 +1972,7 @@ def is_service_incomplete(service: Dict, history: List[Dict]) -> bool:
         return False
 
     # 3. Vérifie si un outil autorisé a déjà été testé
-    tool_map = {
-        "ftp": {
-            "ok": [
-                "nmap --script ftp-anon",
-                "nmap --script ftp-bounce",
-                "nmap --script ftp-syst",
-                "echo | nc {target} 21"
-            ],
-            "ban": ["enum4linux", "smbclient", "rpcclient", "http", "ssh", "telnet"]
-        },
-        "http": {
-            "ok": [
-                "whatweb {target}",
-                "curl -I http://{target}",
-                "nmap --script http-title -p 80 {target}"
-            ],
-            "ban": ["ftp", "ssh", "enum4linux", "telnet", "smtp"]
-        },
-        "https": {
-            "ok": [
-                "curl -Ik https://{target}",
-                "nmap --script ssl-cert -p 443 {target}",
-                "nmap --script ssl-enum-ciphers -p 443 {target}"
-            ],
-            "ban": ["ftp", "rpcclient", "smbclient", "telnet"]
-        },
-        "smtp": {
-            "ok": [
-                "openssl s_client -connect {target}:25 -starttls smtp",
-                "nmap --script smtp-commands -p 25 {target}"
-            ],
-            "ban": ["ftp", "telnet", "http", "rpcclient"]
-        },
-        "smb": {
-            "ok": [
-                "enum4linux -a {target}",
-                "smbclient -L {target} -N",
-                "rpcclient -U '' {target} -c 'enumdomusers'"
-            ],
-            "ban": ["ftp", "http", "curl", "ssh", "snmp"]
-        },
-        "snmp": {
-            "ok": [
-                "snmpwalk -v2c -c public {target}",
-                "snmp-check {target}",
-                "nmap --script snmp-info -p 161 {target}"
-            ],
-            "ban": ["ftp", "ssh", "http", "rpcclient"]
-        },
-        "ssh": {
-            "ok": [
-                "ssh -v {target}",
-                "nmap --script ssh2-enum-algos -p 22 {target}",
-                "nmap --script ssh-hostkey -p 22 {target}"
-            ],
-            "ban": ["ftp", "http", "rpcclient", "smbclient"]
-        },
-        "domain": {
-            "ok": [
-                "dig {target}",
-                "nslookup {target}",
-                "nmap --script dns-recursion {target}",
-                "nmap --script dns-nsid {target}"
-            ],
-            "ban": ["ftp", "ssh", "http", "smbclient"]
-        },
-        "telnet": {
-            "ok": [
-                "echo | nc {target} 23",
-                "nmap --script telnet-encryption -p 23 {target}"
-            ],
-            "ban": ["ftp", "ssh", "enum4linux", "http"]
-        },
-        "rpcbind": {
-            "ok": [
-                "rpcinfo -p {target}",
-                "nmap --script rpcinfo -p 111 {target}"
-            ],
-            "ban": ["ftp", "ssh", "http", "enum4linux"]
-        },
-        "exec": {
-            "ok": [
-                "nmap --script rsh-rexec -p 512 {target}",
-                "rusers {target}"
-            ],
-            "ban": ["ftp", "ssh", "smbclient", "http", "rpcclient"]
-        },
-        "login?": {
-            "ok": [
-                "nmap --script rusers -p 513 {target}",
-                "finger {target}"
-            ],
-            "ban": ["ftp", "http", "rpcclient", "ssh"]
-        }
-    }
+    tool_map = TOOL_MAP
 
     outils_autorises = tool_map.get(tech, {}).get("ok", [])
 
@@ -1839,7 +2152,11 @@ def merge_enriched_entry(results: list[dict], new_entry: dict) -> None:
         print(f"[SKIP] ❌ Aucun gain utile pour {tech}:{port}, ligne ignorée.")
 
 def format_commandes(commandes_executées: List[Dict]) -> str:
-    lignes = []
+    """
+    Bloc "commandes déjà testées" des prompts, borné en tokens :
+    dernières commandes telles quelles, anciennes regroupées par outil et port.
+    """
+    normalisees = []
     for cmd in commandes_executées:
         # Parser YAML si c’est une chaîne
         if isinstance(cmd, str):
@@ -1851,122 +2168,19 @@ def format_commandes(commandes_executées: List[Dict]) -> str:
         if not isinstance(cmd, dict):
             continue  # ignorer les entrées inutilisables
 
-        outil = cmd.get("tool_name", "Inconnu")
-        commande = cmd.get("enumerate_command", "").strip()
-        statut = cmd.get("status", "Inconnu")
-
-        port_info = ""
-        if "-p" in commande:
-            try:
-                index = commande.index("-p")
-                ports = commande[index:].split()[1]
-                port_info = f" (Ports: {ports})"
-            except Exception:
-                pass
-
-        lignes.append(f"- {outil}{port_info} : {statut}\n  → {commande}")
+        normalisees.append({
+            "tool_name": cmd.get("tool_name", "Inconnu"),
+            "enumerate_command": cmd.get("enumerate_command", "").strip(),
+            "status": cmd.get("status", "Inconnu")
+        })
 
-    return "\n".join(lignes) if lignes else "Aucune commande exécutée."
+    return build_history_context(normalisees)
 
 def get_constraints_for_tech(tech: str) -> Tuple[str, str]:
     """
     Retourne les blocs 'Outils Recommandés' et 'Interdits' pour une technologie donnée.
     """
-    tool_map = {
-        "ftp": {
-            "ok": [
-                "nmap --script ftp-anon",
-                "nmap --script ftp-bounce",
-                "nmap --script ftp-syst",
-                "echo | nc {target} 21"
-            ],
-            "ban": ["enum4linux", "smbclient", "rpcclient", "http", "ssh", "telnet"]
-        },
-        "http": {
-            "ok": [
-                "whatweb {target}",
-                "curl -I http://{target}",
-                "nmap --script http-title -p 80 {target}"
-            ],
-            "ban": ["ftp", "ssh", "enum4linux", "telnet", "smtp"]
-        },
-        "https": {
-            "ok": [
-                "curl -Ik https://{target}",
-                "nmap --script ssl-cert -p 443 {target}",
-                "nmap --script ssl-enum-ciphers -p 443 {target}"
-            ],
-            "ban": ["ftp", "rpcclient", "smbclient", "telnet"]
-        },
-        "smtp": {
-            "ok": [
-                "openssl s_client -connect {target}:25 -starttls smtp",
-                "nmap --script smtp-commands -p 25 {target}"
-            ],
-            "ban": ["ftp", "telnet", "http", "rpcclient"]
-        },
-        "smb": {
-            "ok": [
-                "enum4linux -a {target}",
-                "smbclient -L {target} -N",
-                "rpcclient -U '' {target} -c 'enumdomusers'"
-            ],
-            "ban": ["ftp", "http", "curl", "ssh", "snmp"]
-        },
-        "snmp": {
-            "ok": [
-                "snmpwalk -v2c -c public {target}",
-                "snmp-check {target}",
-                "nmap --script snmp-info -p 161 {target}"
-            ],
-            "ban": ["ftp", "ssh", "http", "rpcclient"]
-        },
-        "ssh": {
-            "ok": [
-                "ssh -v {target}",
-                "nmap --script ssh2-enum-algos -p 22 {target}",
-                "nmap --script ssh-hostkey -p 22 {target}"
-            ],
-            "ban": ["ftp", "http", "rpcclient", "smbclient"]
-        },
-        "domain": {
-            "ok": [
-                "dig {target}",
-                "nslookup {target}",
-                "nmap --script dns-recursion {target}",
-                "nmap --script dns-nsid {target}"
-            ],
-            "ban": ["ftp", "ssh", "http", "smbclient"]
-        },
-        "telnet": {
-            "ok": [
-                "echo | nc {target} 23",
-                "nmap --script telnet-encryption -p 23 {target}"
-            ],
-            "ban": ["ftp", "ssh", "enum4linux", "http"]
-        },
-        "rpcbind": {
-            "ok": [
-                "rpcinfo -p {target}",
-                "nmap --script rpcinfo -p 111 {target}"
-            ],
-            "ban": ["ftp", "ssh", "http", "enum4linux"]
-        },
-        "exec": {
-            "ok": [
-                "nmap --script rsh-rexec -p 512 {target}",
-                "rusers {target}"
-            ],
-            "ban": ["ftp", "ssh", "smbclient", "http", "rpcclient"]
-        },
-        "login?": {
-            "ok": [
-                "nmap --script rusers -p 513 {target}",
-                "finger {target}"
-            ],
-            "ban": ["ftp", "http", "rpcclient", "ssh"]
-        }
-    }
+    tool_map = TOOL_MAP
 
 
     tech = tech.lower()
@@ -1983,49 +2197,53 @@ def get_constraints_for_tech(tech: str) -> Tuple[str, str]:
 
     return ok_block, ban_block
 
-def phase2(target: str, results: List, history: List, log: List, max_iterations) -> Tuple[List, List, List]:
-    iteration = 0
-    
-    while iteration < max_iterations:
-        emit_scan_status("command generation", f"Commande #{iteration} générée avec succès")
+# Partie fixe des prompts de génération de commande : placée en tête pour que llama.cpp
+# réutilise son cache KV (cache_prompt) d'un appel à l'autre, seule la suite est recalculée.
+GENERATION_PROMPT_PREFIX = """
+            <s>[INST]
+            Tu es un assistant pentester intelligent spécialisé dans la collecte de version de services.
 
-        print("\n=== Phase 2 : Boucle dynamique d'exploration ===")
+            ⛔ N’invente jamais un script Nmap ou une option qui n’existe pas dans `/usr/share/nmap/scripts/`.
+            ⚠️ Tu ne peux **PAS proposer de script qui n’existe pas dans `/usr/share/nmap/scripts/`**.
+            Tu dois choisir **littéralement** un des outils autorisés listés plus bas.
 
-        print(f"\n[INFO] Début de l’itération {iteration + 1}/{max_iterations}")
+            ### 📦 FORMAT YAML STRICT ATTENDU :
+            ```yaml
+            tool_name: <nom précis de l’outil utilisé>
+            enumerate_command: <commande complète utilisable immédiatement avec l'adresse cible>
+            install_command: <commande apt-get ou pip install pour installer cet outil>
+           ```
 
+            ### ⚠️ CONTRAINTES CRITIQUES À RESPECTER ABSOLUMENT :
 
-        services_incomplets = extract_incomplete_services_structured(results,history)
-        commandes_executées = extract_executed_commands_checked(history)
-        
-        
-        if not services_incomplets:
-            print("[INFO] Tous les services sont complets.")
-            print("resultss : ", results)
-            return results, history, log  
-        else:
-            print("les services incomplets sont :    ",services_incomplets)
-            print("\n[INFO] Commandes déjà exécutées :")
-            for cmd in commandes_executées:
-                print(f"- Outil : {cmd['tool_name']} | Commande : {cmd['enumerate_command']} | Statut : {cmd['status']}")
-
-            # Ciblage d’un seul service par itération
-            service = services_incomplets[0]
-            tech = service.get("technologie", "").lower()
-            port = service.get("port", "??")
-            version = service.get("version", "N/A")
-            cpe = service.get("cpe", "—")
-            cve = service.get("cve", "—")
-
-            print(f"[DEBUG] ➤ Service ciblé : {tech}:{port} (version: {version})")
-
-            # Contraintes dynamiques
-            ok_block, ban_block = get_constraints_for_tech(tech)
-            
-            
-            prompt_loop = f"""
-            <s>[INST]
-            Tu es un assistant pentester intelligent spécialisé dans la collecte de version de services.
+            - ✅ UNE SEULE commande dans `enumerate_command` (pas de `&&`, `;`, `|`)
+            - ✅ UNE SEULE commande d'installation propre dans `install_command` (pas de `&&`, `;`, `apt update &&`, etc.)
+            - ❌ Ne pas mélanger commande d'installation et d'énumération dans une même ligne
+            - ❌ AUCUN placeholder : pas de `<ip>`, `<host>`, `<target>`, `<port>` → tu dois utiliser la **vraie cible** et le **vrai port** indiqués dans CIBLE À ANALYSER
+            - ❌ AUCUNE redirection de sortie : pas de `>`, `>>`, `tee`, `--output`, etc.
+            - ❌ Ne pas proposer une commande ou un outil déjà utilisé dans les commandes précédentes
+            - ❌ Ne pas utiliser d'options comme `--interactive`, `-i`, `-A`, `-oN`, `-oG`
+            - ❌ Ne pas proposer d'outil nécessitant une interaction manuelle ou un shell
+            - ❌ Ne pas utiliser d’outil d’exploitation, de fuzzing ou de bruteforce
+            - ❌ **NE JAMAIS proposer un outil en dehors de la liste AUTORISÉE** pour cette technologie
+            - ✅ Tu dois choisir **UN SEUL outil** dans la liste autorisée, et ne proposer **AUCUN AUTRE**
+            - ✅ La commande doit être compatible Kali Linux, exécutable directement sans interaction
+            - ✅ Tout doit s'exécuter en moins de 2 minutes et produire une sortie exploitable dans le terminal
+"""
 
+def build_generation_prompt(target: str, service: Dict, commandes_executées: List[Dict]) -> str:
+    """
+    Construit le prompt de génération de commande pour un service incomplet.
+    """
+    tech = service.get("technologie", "").lower()
+    port = service.get("port", "??")
+    version = service.get("version", "N/A")
+    cpe = service.get("cpe", "—")
+    cve = service.get("cve", "—")
+    ok_block, ban_block = get_constraints_for_tech(tech)
+
+    # Préfixe fixe puis partie variable (cible, outils, historique)
+    prompt_loop = GENERATION_PROMPT_PREFIX + f"""
             ### 🎯 CIBLE À ANALYSER :
             - Adresse cible : {target}
             - Port : {port}
@@ -2034,27 +2252,17 @@ def phase2(target: str, results: List, history: List, log: List, max_iterations)
             - CPE : {cpe}
             - CVE : {cve}
 
-            
-
             ### ✅ OUTILS STRICTEMENT AUTORISÉS POUR {tech}
             Tu dois obligatoirement choisir l’un **et un seul** des outils suivants :
 
             {ok_block}
 
             ⛔ Tu n’as le droit d’utiliser **aucun autre outil ou script**, même s’il semble pertinent.  
-            ⛔ N’invente jamais un script Nmap ou une option qui n’existe pas dans `/usr/share/nmap/scripts/`.
             ❌ Toute commande non listée ci-dessus sera automatiquement rejetée.
 
-            
-
-            ⚠️ Tu ne peux **PAS proposer de script qui n’existe pas dans `/usr/share/nmap/scripts/`**.
-            Tu dois choisir **littéralement** un des outils listés ci-dessous.
-
-            
             ###❌ OUTILS STRICTEMENT INTERDITS POUR {tech}
             {ban_block}
 
-
             ### 📜 COMMANDES DÉJÀ TESTÉES :
             {format_commandes(commandes_executées)}
 
@@ -2062,52 +2270,329 @@ def phase2(target: str, results: List, history: List, log: List, max_iterations)
 
             ### 🛠️ OBJECTIF CLAIR :
             Tu dois générer **une seule commande** qui vise à obtenir une **version plus précise** du service `{tech}` sur le port `{port}`.
+            La commande doit être utilisable immédiatement avec {target}.
 
             Cette commande servira à deviner un CPE plus précis et détecter des vulnérabilités (CVE) associées.
 
-            ---
+            [/INST]</s>
+            """
+    return prompt_loop
 
-            ### 📦 FORMAT YAML STRICT ATTENDU :
-            ```yaml
-            tool_name: <nom précis de l’outil utilisé>
-            enumerate_command: <commande complète utilisable immédiatement avec {target}>
-            install_command: <commande apt-get ou pip install pour installer cet outil>
-           ```
+def _service_key(service: Dict) -> Tuple[str, str]:
+    return (service.get("technologie", "").lower(), service.get("port", "??"))
 
-            ### ⚠️ CONTRAINTES CRITIQUES À RESPECTER ABSOLUMENT :
+def wait_for_probes(in_flight: Dict, return_when=FIRST_COMPLETED, timeout: Optional[float] = None) -> None:
+    """Attend la fin de sondes du pool de phase2 (par défaut la première) et retire celles qui sont terminées."""
+    if not in_flight:
+        return
+    done, _ = wait(list(in_flight), timeout=timeout, return_when=return_when)
+    for future in done:
+        tech, port = in_flight.pop(future)
+        try:
+            future.result()
+        except Exception as e:
+            print(f"[ERREUR] Échec de la sonde {tech}:{port} : {e}")
 
-            - ✅ UNE SEULE commande dans `enumerate_command` (pas de `&&`, `;`, `|`)
-            - ✅ UNE SEULE commande d'installation propre dans `install_command` (pas de `&&`, `;`, `apt update &&`, etc.)
-            - ❌ Ne pas mélanger commande d'installation et d'énumération dans une même ligne
-            - ❌ AUCUN placeholder : pas de `<ip>`, `<host>`, `<target>`, `<port>` → tu dois utiliser la **vraie cible** `{target}` et le **vrai port** `{port}`
-            - ❌ AUCUNE redirection de sortie : pas de `>`, `>>`, `tee`, `--output`, etc.
-            - ❌ Ne pas proposer une commande ou un outil déjà utilisé dans les commandes précédentes
-            - ❌ Ne pas utiliser d'options comme `--interactive`, `-i`, `-A`, `-oN`, `-oG`
-            - ❌ Ne pas proposer d'outil nécessitant une interaction manuelle ou un shell
-            - ❌ Ne pas utiliser d’outil d’exploitation, de fuzzing ou de bruteforce
-            - ❌ **NE JAMAIS proposer un outil en dehors de la liste AUTORISÉE** pour cette technologie
-            - ✅ Tu dois choisir **UN SEUL outil** dans la liste autorisée, et ne proposer **AUCUN AUTRE**
-            - ✅ La commande doit être compatible Kali Linux, exécutable directement sans interaction
-            - ✅ Tout doit s'exécuter en moins de 2 minutes et produire une sortie exploitable dans le terminal
+def submit_probe(pool: ThreadPoolExecutor, *args):
+    """
+    Soumet probe_service au pool en conservant le contexte du scan : télémétrie LLM (ContextVar),
+    jeton d'annulation et slot llama.cpp réservé par le scan. Une sonde en attente d'un thread libre
+    ne démarre pas si le scan a été annulé entre-temps.
+    """
+    context = contextvars.copy_context()
 
-            [/INST]</s>
-            """
-            print("les outils autorisés :",{ok_block})
-            response = query_llm(prompt_loop)    
-            if not response:
-                print("Impossible de communiquer avec llm ou réponse invalide.")
-                iteration += 1
-                print(f"[INFO] Nombre d'itérations effectuées : {iteration}/{max_iterations}")
+    def run():
+        context.run(check_cancelled)
+        return context.run(probe_service, *args)
+
+    return pool.submit(run)
+
+
+def probe_service(target: str, response: str, tool_name: str, command: str, insall_command: Optional[str],
+                  iteration: int, results: List, history: List, log: List, state_lock: threading.Lock) -> None:
+    """
+    Exécute la commande retenue pour un service (installation et corrections comprises), puis analyse
+    le résultat et le fusionne. Appelée par le pool de phase2 : plusieurs services sont sondés en même temps,
+    les mises à jour de results / history / log se font sous state_lock, dans l'ordre de fin des commandes.
+    Les réponses du LLM de la sonde ne sont pas streamées : chacune est transmise d'un bloc (emit_deferred).
+    """
+    execution = None
+    result = None
+    if command:
+        if len(command) < 150 :
+            if not ensure_command_tools(command, insall_command):
+                print(f"[AVERTISSEMENT] Outil '{tool_name}' absent de l'inventaire, exécution tentée malgré tout.")
+            emit_scan_status("executing command", f"Exécution de la commande #{iteration} : {command}")
+
+            execution = run_scan_command(command, target=target)
+            result = format_command_result(execution)
+        else :
+            print("[AVERTISSEMENT] La commande est trop longue (>50 caractères).")
+            result = "error : commande trop longue"
+            emit_scan_status("error too long", f"La commande est trop longue")
+        if isinstance(result, str) and "not found" in result.lower(): 
+                emit_scan_status("tool installation", f"Installation en cours de {tool_name} ...")
+                print("[DEBUG] L'outil requis est absent.Tentative d'installation...")
+                install_success = execute_install_docker(insall_command)
+                if not install_success:
+                    print(f"[ERREUR] Impossible d'installer l'outil '{tool_name}',ne plus proposer de commandes avec.")
+                    with state_lock:
+                        history.append({"command": command, "result": f"[ERREUR] L'outil '{tool_name}' n'a pas pu être installé."})
+                    
+                
+                # Réexécute la commande après installation
+                print(f"[INFO] Réexécution de la commande après installation de l'outil '{tool_name}'.")
+                emit_scan_status("executing command", f"Réexécution de la commande #{iteration} : {command} aprés installation de l'outil {tool_name}")
+                execution = run_scan_command(command, target=target)
+                result = format_command_result(execution)
+
+                if not result:  # Vérifie simplement si la commande a échoué (pas de "not found")
+                    print(f"[ERREUR] La commande a échoué après installation de l'outil '{tool_name}'.")
+                    with state_lock:
+                        history.append({"command": command, "result": "[ERREUR] La commande a échoué après installation de l'outil."})
+        if  not isinstance(result, str) or "error" in result.lower() or "failed" in result.lower() or "not found" in result.lower() or result.strip() == "":
+            MAX_RETRIES = 2
+            retry_count = 0
+
+            while (
+                not isinstance(result, str)
+                or "error" in result.lower()
+                or "failed" in result.lower()
+                or "not found" in result.lower()
+                or result.strip() == ""
+            ) and retry_count < MAX_RETRIES:
+                emit_scan_status("error detected", f"Erreur détectée dans {command}, correction en cours")
+                print(f"[DEBUG] Erreur détectée dans la commande. Tentative de correction #{retry_count + 1}.")
+
+                prompt_error = f"""
+                veuillez corriger cette commande :
+                {command}
+
+                Voici l'erreur retournée après exécution :
+                {result}
+
+                Veuillez proposer une version CORRIGÉE de la commande qui :
+                1. Utilise le même outil ({tool_name})
+                2. Corrige les arguments problématiques
+                3. Conserve la même fonction/objectif
+                4. Fournit une seule et unique commande d'installation valide sans caractères spéciaux
+
+                Répondez UNIQUEMENT avec le format YAML suivant, sans aucun texte supplémentaire :
+                ```yaml
+                tool_name: {tool_name}
+                enumerate_command: <commande_corrigée>
+                install_command: <commande_installation>
+                ```
+                """
+
+                corrected_response = query_llm(prompt_error, output_schema=TOOL_COMMAND_SCHEMA, stop_on_keys=COMMAND_REQUIRED_KEYS,
+                                               emit_callback=_silent_callback)
+                emit_deferred(corrected_response)
+                corrected_response = clean_command(corrected_response)
+                print(f"[DEBUG] Réponse corrigée du LLM :\n{corrected_response}")
+
+                try:
+                    formated_response = yaml.safe_load(corrected_response)
+                    if formated_response and is_valid_tool_yaml(corrected_response):
+                        command = formated_response['enumerate_command']
+                        execution = run_scan_command(command, target=target)
+                        result = format_command_result(execution)
+                    else:
+                        print("[AVERTISSEMENT] Format YAML invalide. Tentative suivante...")
+                        result = "error : YAML invalide"
+                except Exception as e:
+                    print(f"[ERREUR] Exception YAML : {e}")
+                    result = "error : exception de parsing"
+
+                retry_count += 1
+
+                    
+    print("[DEBUG] Analyse des résultats...")
+    if result:
+        emit_scan_status("analyzing results", f"Analyse des résultats de la commande #{iteration} : {command}")
+        analyzed_result = analyze_result_with_llm(result, target, response, deferred=True)
+        if analyzed_result:
+            print("[INFO] Analyse réussie")
+            print("[DEBUG] Résultat brut de l'analyse : ", analyzed_result)
+            
+            # Vérifier si l'analyse indique une erreur
+            try:
+                print("[DEBUG] Analyse du statut de la commande...", analyzed_result)
+                result_yaml = clean_and_analyze_result(analyzed_result)
+                # 🚫 Sécurité anti-hallucination : suppression forcée du CPE s'il vient du LLM
+                if isinstance(result_yaml, dict):
+                    if "cpe" in result_yaml:
+                        print(f"[WARN] CPE halluciné détecté → supprimé : {result_yaml['cpe']}")
+                        result_yaml["cpe"] = "—"
+                    if "cpes" in result_yaml:
+                        print(f"[WARN] Liste CPE halluciné → supprimée : {result_yaml['cpes']}")
+                        result_yaml["cpes"] = []
+                elif isinstance(result_yaml, list):
+                    for entry in result_yaml:
+                        if "cpe" in entry:
+                            print(f"[WARN] CPE halluciné détecté → supprimé : {entry['cpe']}")
+                            entry["cpe"] = "—"
+                        if "cpes" in entry:
+                            print(f"[WARN] Liste CPE halluciné → supprimée : {entry['cpes']}")
+                            entry["cpes"] = []
+                with state_lock:
+                    log.append(result_yaml)
+                print("[DEBUG] Analyse de llm step 234... : ", result_yaml)
+                if result_yaml :
+                    if result_yaml["status"] == "ERROR":
+                        error_msg = "Erreur détectée dans l'exécution de la commande"
+                        if "analysis" in result_yaml and "points_d_intérêt" in result_yaml["analysis"]:
+                            error_msg = result_yaml["analysis"]["points_d_intérêt"]
+                        
+                        print(f"[AVERTISSEMENT] {error_msg}")
+                        # Enregistrer l'erreur pour futures références
+                        with state_lock:
+                            update_command_errors(tool_name, command, error_msg)
+                    else:
+                        print("[INFO] Analyse réussie, pas d'erreurs détectées.")
+                        if isinstance(result_yaml, dict):
+                            new_entries = [result_yaml]
+                        elif isinstance(result_yaml, list):
+                            new_entries = result_yaml
+                        else:
+                            new_entries = []
+
+                        # 🔍 Enrichissement CVE uniquement sur les nouveaux résultats
+                        try:
+                            emit_scan_status("gathering cve", "Recueil des CVE en cours...")
+                            enriched_new_entries = enrich_report_with_cve([new_entries])[0]
+                        except Exception as e:
+                            print(f"[WARNING] Échec de l'enrichissement CVE pour cette commande : {e}")
+                            enriched_new_entries = new_entries
+
+                        with state_lock:
+                            for new_entry in enriched_new_entries:
+                                merge_enriched_entry(results, new_entry)
+
+                        print("[INFO] Résultats enrichis avec les CVE (nouveaux services) :", enriched_new_entries)
+                            
+                with state_lock:
+                    history.append({"command": response, "result": analyzed_result,
+                                    "execution": execution.summary() if execution else None})
+                        #print("[INFO] Résultats enrichis avec les CVE.", results)
+                        #iteration += 1
+                        #print(f"[INFO] Nombre d'itérations effectuées : {iteration}/{max_iterations}")
+
+            except Exception as e:
+                print(f"[DEBUG] Erreur lors de la vérification du statut d'analyse: {e}")
+            
+                with state_lock:
+                    history.append({"command": response, "result": analyzed_result,
+                                    "execution": execution.summary() if execution else None})
+        else:
+            print("[INFO] Analyse impossible. Ajout du résultat brut à l'historique.")
+            with state_lock:
+                history.append({"command": response, "result": result,
+                                "execution": execution.summary() if execution else None})
+    else:
+        print("La commande d'énumération a échoué. Vérifiez la cible ou les permissions.")
+    
+        with state_lock:
+            history.append({"command": response, "result": "[ERREUR] La commande a échoué.",
+                            "execution": execution.summary() if execution else None})
+
+def phase2(target: str, results: List, history: List, log: List, max_iterations) -> Tuple[List, List, List]:
+    iteration = 0
+    prefetched = {}
+    # Commandes des services incomplets exécutées en parallèle (COMMAND_POOL_PER_TARGET pour la cible,
+    # COMMAND_GLOBAL_LIMIT au total) : la génération de la commande suivante continue pendant leur exécution
+    pool = ThreadPoolExecutor(max_workers=max(COMMAND_POOL_PER_TARGET, 1), thread_name_prefix="phase2")
+    try:
+        in_flight = {}
+        state_lock = threading.Lock()
+    
+        while iteration < max_iterations:
+            check_cancelled()
+            emit_scan_status("command generation", f"Commande #{iteration} générée avec succès")
+
+            print("\n=== Phase 2 : Boucle dynamique d'exploration ===")
+
+            print(f"\n[INFO] Début de l’itération {iteration + 1}/{max_iterations}")
+
+
+            wait_for_probes(in_flight, timeout=0)
+            with state_lock:
+                # Un service dont la sonde est en cours n'est pas reproposé
+                services_incomplets = [s for s in extract_incomplete_services_structured(results,history)
+                                       if _service_key(s) not in in_flight.values()]
+                commandes_executées = extract_executed_commands_checked(history)
+        
+        
+            if not services_incomplets and in_flight:
+                # Les sondes en cours peuvent encore compléter des services ou en révéler de nouveaux
+                print(f"[INFO] En attente de {len(in_flight)} commande(s) en cours...")
+                wait_for_probes(in_flight)
                 continue
+            if not services_incomplets:
+                print("[INFO] Tous les services sont complets.")
+                print("resultss : ", results)
+                return results, history, log  
+            else:
+                print("les services incomplets sont :    ",services_incomplets)
+                print("\n[INFO] Commandes déjà exécutées :")
+                for cmd in commandes_executées:
+                    print(f"- Outil : {cmd['tool_name']} | Commande : {cmd['enumerate_command']} | Statut : {cmd['status']}")
+
+                # Ciblage d’un seul service par itération
+                service = services_incomplets[0]
+                tech = service.get("technologie", "").lower()
+                port = service.get("port", "??")
+                version = service.get("version", "N/A")
+                cpe = service.get("cpe", "—")
+                cve = service.get("cve", "—")
+
+                print(f"[DEBUG] ➤ Service ciblé : {tech}:{port} (version: {version})")
+
+                # Contraintes dynamiques
+                ok_block, ban_block = get_constraints_for_tech(tech)
+                print("les outils autorisés :",{ok_block})
+
+                # Les commandes des prochains services incomplets sont générées en même temps
+                # (dans la limite des slots llama.cpp) et gardées pour les itérations suivantes.
+                service_key = (tech, port)
+                preselected = False
+                if COMMAND_CANDIDATES > 1:
+                    # Mode multi-candidates : les slots servent aux candidates du service courant (pas de
+                    # pré-génération) ; la première qui passe les contrôles évite les allers-retours de correction.
+                    candidates = query_llm_candidates(build_generation_prompt(target, service, commandes_executées),
+                                                      COMMAND_CANDIDATES)
+                    response = select_command_candidate(candidates, history)
+                    preselected = response is not None
+                    if not preselected:
+                        response = next((c for c in candidates if c and not c.startswith("[ERREUR")), None)
+                elif service_key in prefetched:
+                    response = prefetched.pop(service_key)
+                    print(f"[INFO] Commande pré-générée utilisée pour {tech}:{port}")
+                    if streaming_callback:
+                        streaming_callback(response)
+                        flush_stream(streaming_callback)
+                else:
+                    batch = services_incomplets[:LLM_SLOTS]
+                    prompts = [build_generation_prompt(target, s, commandes_executées) for s in batch]
+                    responses = query_llm_batch(prompts, replay_deferred=False, output_schema=TOOL_COMMAND_SCHEMA, stop_on_keys=COMMAND_REQUIRED_KEYS)
+                    response = responses[0]
+                    for other, other_response in zip(batch[1:], responses[1:]):
+                        if other_response and not other_response.startswith("[ERREUR"):
+                            prefetched[(other.get("technologie", "").lower(), other.get("port", "??"))] = other_response
+                if not response:
+                    print("Impossible de communiquer avec llm ou réponse invalide.")
+                    iteration += 1
+                    print(f"[INFO] Nombre d'itérations effectuées : {iteration}/{max_iterations}")
+                    continue
             
 
-            # Validation YAML et extraction des informations
-            if not is_valid_tool_yaml(response):
-                print("[AVERTISSEMENT] Format YAML invalide. Tentative de correction...")
-                emit_scan_status("format error", f"Format YAML invalide. Tentative de correction...")
+                # Validation YAML et extraction des informations
+                if not preselected and not is_valid_tool_yaml(response):
+                    print("[AVERTISSEMENT] Format YAML invalide. Tentative de correction...")
+                    emit_scan_status("format error", f"Format YAML invalide. Tentative de correction...")
 
-                # Prompt pour corriger le format YAML
-                fix_prompt = f"""
+                    # Prompt pour corriger le format YAML
+                    fix_prompt = f"""
                 <s>[INST]
                 La réponse précédente n'était pas un YAML valide ou était incomplète. 
                 
@@ -2142,26 +2627,26 @@ def phase2(target: str, results: List, history: List, log: List, max_iterations)
                 [/INST]</s>
                 """
                 
-                response = query_llm(fix_prompt)
-                if not is_valid_tool_yaml(response):
-                    print("[ERREUR] Impossible de générer un YAML valide. Passons à l'étape suivante.")
-                    iteration += 1
-                    print(f"[INFO] Nombre d'itérations effectuées : {iteration}/{max_iterations}")
-                    continue
-
-            response = clean_command(response)  # Nettoyage de la réponse
-            # Extraction du nom de l'outil et de la commande
-            yaml_data = yaml.safe_load(response)
-            tool_name = yaml_data['tool_name']
-            command = yaml_data['enumerate_command']
+                    response = query_llm(fix_prompt, output_schema=TOOL_COMMAND_SCHEMA, stop_on_keys=COMMAND_REQUIRED_KEYS)
+                    if not is_valid_tool_yaml(response):
+                        print("[ERREUR] Impossible de générer un YAML valide. Passons à l'étape suivante.")
+                        iteration += 1
+                        print(f"[INFO] Nombre d'itérations effectuées : {iteration}/{max_iterations}")
+                        continue
+
+                response = clean_command(response)  # Nettoyage de la réponse
+                # Extraction du nom de l'outil et de la commande
+                yaml_data = yaml.safe_load(response)
+                tool_name = yaml_data['tool_name']
+                command = yaml_data['enumerate_command']
             
-            # Vérifier si c'est un doublon
-            if is_duplicate_command(command, history):
-                print("[AVERTISSEMENT] Cette commande est similaire à une commande précédente. Génération d'une alternative...")
-                emit_scan_status("duplicate detected", f"Erreur la commande {command} est similaire à une commande précédente, génération d'une alternative")
+                # Vérifier si c'est un doublon
+                if not preselected and is_duplicate_command(command, history):
+                    print("[AVERTISSEMENT] Cette commande est similaire à une commande précédente. Génération d'une alternative...")
+                    emit_scan_status("duplicate detected", f"Erreur la commande {command} est similaire à une commande précédente, génération d'une alternative")
 
-                # Prompt pour générer une commande alternative
-                alt_prompt = f"""
+                    # Prompt pour générer une commande alternative
+                    alt_prompt = f"""
                 <s>[INST]
                 La commande suivante est similaire à une commande déjà exécutée:
                 
@@ -2184,30 +2669,33 @@ def phase2(target: str, results: List, history: List, log: List, max_iterations)
                 [/INST]</s>
                 """
                 
-                response = query_llm(alt_prompt)
-                if is_valid_tool_yaml(response):
-                    response = clean_command(response)  # Nettoyage de la réponse
-                    yaml_data = yaml.safe_load(response)
-                    tool_name = yaml_data['tool_name']
-                    command = yaml_data['enumerate_command']
-                    print(f"[INFO] Commande alternative générée: {command}")
-                else:
-                    emit_scan_status("generating error", "Impossible de générer une commande alternative")
+                    response = query_llm(alt_prompt, output_schema=TOOL_COMMAND_SCHEMA, stop_on_keys=COMMAND_REQUIRED_KEYS)
+                    if is_valid_tool_yaml(response):
+                        response = clean_command(response)  # Nettoyage de la réponse
+                        yaml_data = yaml.safe_load(response)
+                        tool_name = yaml_data['tool_name']
+                        command = yaml_data['enumerate_command']
+                        print(f"[INFO] Commande alternative générée: {command}")
+                    else:
+                        emit_scan_status("generating error", "Impossible de générer une commande alternative")
 
-                    print("[ERREUR] Impossible de générer une commande alternative valide.")
-                    iteration += 1
-                    print(f"[INFO] Nombre d'itérations effectuées : {iteration}/{max_iterations}")
-                    continue
+                        print("[ERREUR] Impossible de générer une commande alternative valide.")
+                        iteration += 1
+                        print(f"[INFO] Nombre d'itérations effectuées : {iteration}/{max_iterations}")
+                        continue
             
                 
-            # Validation et nettoyage de la commande
-            is_valid, validated_command = validate_command(tool_name, command)
-            if not is_valid:
-                print(f"[AVERTISSEMENT] {validated_command}")
-                emit_scan_status("error detected", f"Erreur détectée dans {command}, correction en cours")
+                # Validation et nettoyage de la commande
+                if preselected:
+                    is_valid, validated_command = True, command
+                else:
+                    is_valid, validated_command = validate_command(tool_name, command)
+                if not is_valid:
+                    print(f"[AVERTISSEMENT] {validated_command}")
+                    emit_scan_status("error detected", f"Erreur détectée dans {command}, correction en cours")
 
-                # Tenter de corriger la commande
-                prompt_correction = f"""
+                    # Tenter de corriger la commande
+                    prompt_correction = f"""
                 <s>[INST]
                 ### CORRECTION DE COMMANDE REQUISE
                 
@@ -2235,220 +2723,75 @@ def phase2(target: str, results: List, history: List, log: List, max_iterations)
                 [/INST]</s>
                 """
                 
-                corrected_response = query_llm(prompt_correction)
-                if corrected_response and is_valid_tool_yaml(corrected_response):
-                    response = corrected_response
-                    response = clean_command(response)  # Nettoyage de la réponse
-                    yaml_data = yaml.safe_load(response)
-                    command = yaml_data['enumerate_command']
+                    corrected_response = query_llm(prompt_correction, output_schema=TOOL_COMMAND_SCHEMA, stop_on_keys=COMMAND_REQUIRED_KEYS)
+                    if corrected_response and is_valid_tool_yaml(corrected_response):
+                        response = corrected_response
+                        response = clean_command(response)  # Nettoyage de la réponse
+                        yaml_data = yaml.safe_load(response)
+                        command = yaml_data['enumerate_command']
                     
-                    print(f"[INFO] Commande corrigée: {command}")
-                else:
-                    emit_scan_status("correcting error", "Impossible de corriger la commande. Utilisation de la version originale.")
+                        print(f"[INFO] Commande corrigée: {command}")
+                    else:
+                        emit_scan_status("correcting error", "Impossible de corriger la commande. Utilisation de la version originale.")
 
-                    print("[AVERTISSEMENT] Impossible de corriger la commande. Utilisation de la version originale.")
+                        print("[AVERTISSEMENT] Impossible de corriger la commande. Utilisation de la version originale.")
 
-            # Affichage de la commande finale
-            print(f"\n[COMMANDE À EXÉCUTER]: {command}")
+                # Affichage de la commande finale
+                print(f"\n[COMMANDE À EXÉCUTER]: {command}")
             
-            # Si une commande d'installation est fournie, l'afficher
-            if 'install_command' in yaml_data and yaml_data['install_command']:
-                insall_command = yaml_data['install_command']
-                print(f"[INSTALLATION SI NÉCESSAIRE]: {yaml_data['install_command']}")
+                # Si une commande d'installation est fournie, l'afficher
+                insall_command = None
+                if 'install_command' in yaml_data and yaml_data['install_command']:
+                    insall_command = yaml_data['install_command']
+                    print(f"[INSTALLATION SI NÉCESSAIRE]: {yaml_data['install_command']}")
               
-            enumerate_command = command
-            send_command(enumerate_command)
-            user_confirmation = 'o'        
-            user_alternative = None 
-            get_unpause()
+                enumerate_command = command
+                send_command(enumerate_command)
+                user_confirmation = 'o'        
+                user_alternative = None 
+                get_unpause()
             
-            print(f"Réponse reçue : {user_confirmation}")
-            print(f"Commande alternative reçue : {user_alternative}")
+                print(f"Réponse reçue : {user_confirmation}")
+                print(f"Commande alternative reçue : {user_alternative}")
 
-            if user_confirmation == 'o':
-                # L'utilisateur confirme, on garde la commande initiale
-                print("La commande d'énumération a été confirmée.")
+                if user_confirmation == 'o':
+                    # L'utilisateur confirme, on garde la commande initiale
+                    print("La commande d'énumération a été confirmée.")
                 
                 
-            elif user_confirmation == 'n':  # L'utilisateur refuse, proposer une alternative            
-                if user_alternative:
-                    print("Remplacement de la commande d'énumération par celle de l'utilisateur...")
-                    enumerate_command = user_alternative
-                else:
-                    # Aucune commande alternative fournie
-                    print("Programme arrêté par l'utilisateur.")
-
-                    return
-                    exit()  # Arrêter le programme si aucune commande n'est fournie
-            else:
-                # Réponse invalide
-                print("Réponse non reconnue. Le programme va passer à la prochaine itération.")
-                # Passage à la phase suivante en cas de réponse invalide
-            
-            
-            if command:
-                if len(command) < 150 :
-                    emit_scan_status("executing command", f"Exécution de la commande #{iteration} : {command}")
-
-                    result = execute_command_docker(command)
-                else :
-                    print("[AVERTISSEMENT] La commande est trop longue (>50 caractères).")
-                    result = "error : commande trop longue"
-                    emit_scan_status("error too long", f"La commande est trop longue")
-                if isinstance(result, str) and "not found" in result.lower(): 
-                        emit_scan_status("tool installation", f"Installation en cours de {tool_name} ...")
-                        print("[DEBUG] L'outil requis est absent.Tentative d'installation...")
-                        install_success = execute_install_docker(insall_command)
-                        if not install_success:
-                            print(f"[ERREUR] Impossible d'installer l'outil '{tool_name}',ne plus proposer de commandes avec.")
-                            history.append({"command": command, "result": f"[ERREUR] L'outil '{tool_name}' n'a pas pu être installé."})
-                            
-                        
-                        # Réexécute la commande après installation
-                        print(f"[INFO] Réexécution de la commande après installation de l'outil '{tool_name}'.")
-                        emit_scan_status("executing command", f"Réexécution de la commande #{iteration} : {command} aprés installation de l'outil {tool_name}")
-                        result = execute_command_docker(command)
-
-                        if not result:  # Vérifie simplement si la commande a échoué (pas de "not found")
-                            print(f"[ERREUR] La commande a échoué après installation de l'outil '{tool_name}'.")
-                            history.append({"command": command, "result": "[ERREUR] La commande a échoué après installation de l'outil."})
-                if  not isinstance(result, str) or "error" in result.lower() or "failed" in result.lower() or "not found" in result.lower() or result.strip() == "":
-                    MAX_RETRIES = 2
-                    retry_count = 0
-
-                    while (
-                        not isinstance(result, str)
-                        or "error" in result.lower()
-                        or "failed" in result.lower()
-                        or "not found" in result.lower()
-                        or result.strip() == ""
-                    ) and retry_count < MAX_RETRIES:
-                        emit_scan_status("error detected", f"Erreur détectée dans {command}, correction en cours")
-                        print(f"[DEBUG] Erreur détectée dans la commande. Tentative de correction #{retry_count + 1}.")
-
-                        prompt_error = f"""
-                        veuillez corriger cette commande :
-                        {command}
-
-                        Voici l'erreur retournée après exécution :
-                        {result}
-
-                        Veuillez proposer une version CORRIGÉE de la commande qui :
-                        1. Utilise le même outil ({tool_name})
-                        2. Corrige les arguments problématiques
-                        3. Conserve la même fonction/objectif
-                        4. Fournit une seule et unique commande d'installation valide sans caractères spéciaux
-
-                        Répondez UNIQUEMENT avec le format YAML suivant, sans aucun texte supplémentaire :
-                        ```yaml
-                        tool_name: {tool_name}
-                        enumerate_command: <commande_corrigée>
-                        install_command: <commande_installation>
-                        ```
-                        """
-
-                        corrected_response = query_llm(prompt_error)
-                        corrected_response = clean_command(corrected_response)
-                        print(f"[DEBUG] Réponse corrigée du LLM :\n{corrected_response}")
-
-                        try:
-                            formated_response = yaml.safe_load(corrected_response)
-                            if formated_response and is_valid_tool_yaml(corrected_response):
-                                command = formated_response['enumerate_command']
-                                result = execute_command_docker(command)
-                            else:
-                                print("[AVERTISSEMENT] Format YAML invalide. Tentative suivante...")
-                                result = "error : YAML invalide"
-                        except Exception as e:
-                            print(f"[ERREUR] Exception YAML : {e}")
-                            result = "error : exception de parsing"
-
-                        retry_count += 1
+                elif user_confirmation == 'n':  # L'utilisateur refuse, proposer une alternative            
+                    if user_alternative:
+                        print("Remplacement de la commande d'énumération par celle de l'utilisateur...")
+                        enumerate_command = user_alternative
+                    else:
+                        # Aucune commande alternative fournie
+                        print("Programme arrêté par l'utilisateur.")
 
-                            
-            print("[DEBUG] Analyse des résultats...")
-            if result:
-                emit_scan_status("analyzing results", f"Analyse des résultats de la commande #{iteration} : {command}")
-                analyzed_result = analyze_result_with_llm(result, target, response)
-                if analyzed_result:
-                    print("[INFO] Analyse réussie")
-                    print("[DEBUG] Résultat brut de l'analyse : ", analyzed_result)
-                    
-                    # Vérifier si l'analyse indique une erreur
-                    try:
-                        print("[DEBUG] Analyse du statut de la commande...", analyzed_result)
-                        result_yaml = clean_and_analyze_result(analyzed_result)
-                        # 🚫 Sécurité anti-hallucination : suppression forcée du CPE s'il vient du LLM
-                        if isinstance(result_yaml, dict):
-                            if "cpe" in result_yaml:
-                                print(f"[WARN] CPE halluciné détecté → supprimé : {result_yaml['cpe']}")
-                                result_yaml["cpe"] = "—"
-                            if "cpes" in result_yaml:
-                                print(f"[WARN] Liste CPE halluciné → supprimée : {result_yaml['cpes']}")
-                                result_yaml["cpes"] = []
-                        elif isinstance(result_yaml, list):
-                            for entry in result_yaml:
-                                if "cpe" in entry:
-                                    print(f"[WARN] CPE halluciné détecté → supprimé : {entry['cpe']}")
-                                    entry["cpe"] = "—"
-                                if "cpes" in entry:
-                                    print(f"[WARN] Liste CPE halluciné → supprimée : {entry['cpes']}")
-                                    entry["cpes"] = []
-                        log.append(result_yaml)
-                        print("[DEBUG] Analyse de llm step 234... : ", result_yaml)
-                        if result_yaml :
-                            if result_yaml["status"] == "ERROR":
-                                error_msg = "Erreur détectée dans l'exécution de la commande"
-                                if "analysis" in result_yaml and "points_d_intérêt" in result_yaml["analysis"]:
-                                    error_msg = result_yaml["analysis"]["points_d_intérêt"]
-                                
-                                print(f"[AVERTISSEMENT] {error_msg}")
-                                # Enregistrer l'erreur pour futures références
-                                update_command_errors(tool_name, command, error_msg)
-                            else:
-                                print("[INFO] Analyse réussie, pas d'erreurs détectées.")
-                                if isinstance(result_yaml, dict):
-                                    new_entries = [result_yaml]
-                                elif isinstance(result_yaml, list):
-                                    new_entries = result_yaml
-                                else:
-                                    new_entries = []
-
-                                # 🔍 Enrichissement CVE uniquement sur les nouveaux résultats
-                                try:
-                                    emit_scan_status("gathering cve", "Recueil des CVE en cours...")
-                                    enriched_new_entries = enrich_report_with_cve([new_entries])[0]
-                                except Exception as e:
-                                    print(f"[WARNING] Échec de l'enrichissement CVE pour cette commande : {e}")
-                                    enriched_new_entries = new_entries
-
-                                for new_entry in enriched_new_entries:
-                                    merge_enriched_entry(results, new_entry)
-
-                                print("[INFO] Résultats enrichis avec les CVE (nouveaux services) :", enriched_new_entries)
-                                    
-                        history.append({"command": response, "result": analyzed_result})
-                                #print("[INFO] Résultats enrichis avec les CVE.", results)
-                                #iteration += 1
-                                #print(f"[INFO] Nombre d'itérations effectuées : {iteration}/{max_iterations}")
-
-                    except Exception as e:
-                        print(f"[DEBUG] Erreur lors de la vérification du statut d'analyse: {e}")
-                    
-                        history.append({"command": response, "result": analyzed_result})
+                        return
+                        exit()  # Arrêter le programme si aucune commande n'est fournie
                 else:
-                    print("[INFO] Analyse impossible. Ajout du résultat brut à l'historique.")
-                    history.append({"command": response, "result": result})
-            else:
-                print("La commande d'énumération a échoué. Vérifiez la cible ou les permissions.")
+                    # Réponse invalide
+                    print("Réponse non reconnue. Le programme va passer à la prochaine itération.")
+                    # Passage à la phase suivante en cas de réponse invalide
+            
             
-                history.append({"command": response, "result": "[ERREUR] La commande a échoué."})
+                # Sonde lancée dans le pool ; si toutes les places de la cible sont prises, on attend qu'une se libère
+                while len(in_flight) >= max(COMMAND_POOL_PER_TARGET, 1):
+                    wait_for_probes(in_flight)
+                future = submit_probe(pool, target, response, tool_name, command, insall_command,
+                                      iteration, results, history, log, state_lock)
+                in_flight[future] = service_key
 
-            iteration += 1
-            print(f"[INFO] Nombre d'itérations effectuées : {iteration}/{max_iterations}")
+                iteration += 1
+                print(f"[INFO] Nombre d'itérations effectuées : {iteration}/{max_iterations}")
 
-    print("results:",results)
-    return results, log, history
+        # Dernière itération atteinte : on attend les commandes encore en cours avant de rendre les résultats
+        wait_for_probes(in_flight, ALL_COMPLETED)
+        print("results:",results)
+        return results, log, history
+    finally:
+        # Aussi après une annulation ou une erreur : les sondes en attente ne partent pas
+        pool.shutdown(cancel_futures=True)
 
 def generate_final_report(target: str, results: List, history: List) -> None:
     from datetime import datetime
@@ -2481,10 +2824,10 @@ def generate_final_report(target: str, results: List, history: List) -> None:
     cve_recos = []
 
     if cve_items:
-        prompt_cve_block = "\n".join(
+        prompt_cve_block = build_list_context([
             f"- CVE : {item['cve']} | Service : {item['tech']} | Port : {item['port']} | Description : {item['description']}"
             for item in cve_items
-        )
+        ], label="CVE")
 
         cve_prompt = f"""
         <s>[INST]
@@ -2505,7 +2848,7 @@ def generate_final_report(target: str, results: List, history: List) -> None:
         [/INST]</s>
         """
 
-        cve_response = query_llm(cve_prompt, max_tokens_override=800)
+        cve_response = query_llm(cve_prompt, max_tokens_override=800, prompt_type="cve_reco")
         if cve_response:
             current = []
             for line in cve_response.strip().splitlines():
@@ -2519,10 +2862,10 @@ def generate_final_report(target: str, results: List, history: List) -> None:
 
     elif results_filtered:
         # Pas de CVE mais services présents
-        services_detectes = "\n".join(
+        services_detectes = build_list_context([
             f"- Port {entry.get('port', '??')} : {entry.get('technologie', '??')} {entry.get('version', '')}"
             for entry in results_filtered
-        )
+        ], label="services")
 
         fallback_prompt = f"""
         <s>[INST]
@@ -2542,7 +2885,7 @@ def generate_final_report(target: str, results: List, history: List) -> None:
         - Respectes le format de sortie
         [/INST]</s>
         """
-        fallback_response = query_llm(fallback_prompt, max_tokens_override=400)
+        fallback_response = query_llm(fallback_prompt, max_tokens_override=400, prompt_type="fallback_reco")
         if fallback_response:
             cve_recos = [fallback_response.strip()]
     # path_to_wkhtmltopdf = "/root/Pentral/wkhtmltopdf/bin/wkhtmltopdf.exe"
@@ -3233,148 +3576,157 @@ def main(cible, iteration):
     print("cible : ", cible)
     print("iteration : ", iteration)
     emit_scan_status("analyzing target", "Analyse de la cible en cours...")
+    try:
+        pin_scan_slot(cible)
+        open_shell_sessions(cible)
+        lease_scan_container(cible)
 
     
-    if is_valid_ip(cible):
-        print(f"[INFO] IP valide détectée : {cible}")
-        target = cible
-        target_type = "ip"
-    elif is_valid_domain(cible) and resolve_domain(cible):
-        print(f"[INFO] Domaine valide résolu avec succès : {cible}")
-        target = cible
-        target_type = "domain"
-    else:
-        print("[ERREUR] Cible invalide. Veuillez réessayer.\n")
-
-    history = []  # Liste pour stocker les commandes et leurs résultats
-    results = []  # Liste pour stocker les résultats d'analyse
-    log = []
-
-    print(f"Cible: {target}")
-    # traitement selon le type de cible
-    if target_type == "ip":
-        print(f" Traitement spécifique pour l’adresse IP : {target}")
-        print(f"\n Cible analysée : {target}")
-        print("=== Phase 1 : Scan initial -sS + -sV + enrichissement ===")
-
-        # Phase 1 : Scan et enrichissement
-        results, log, history = phase1_initiale(target)
-        max_iterations=iteration-2
-        phase2(target, results, history, log, max_iterations)
-        output = generate_final_report(target, results, history)
+        if is_valid_ip(cible):
+            print(f"[INFO] IP valide détectée : {cible}")
+            target = cible
+            target_type = "ip"
+        elif is_valid_domain(cible) and resolve_domain(cible):
+            print(f"[INFO] Domaine valide résolu avec succès : {cible}")
+            target = cible
+            target_type = "domain"
+        else:
+            print("[ERREUR] Cible invalide. Veuillez réessayer.\n")
+
+        history = []  # Liste pour stocker les commandes et leurs résultats
+        results = []  # Liste pour stocker les résultats d'analyse
+        log = []
+
+        print(f"Cible: {target}")
+        prepare_scan_tools(target_type)
+        check_cancelled()
+        # traitement selon le type de cible
+        if target_type == "ip":
+            print(f" Traitement spécifique pour l’adresse IP : {target}")
+            print(f"\n Cible analysée : {target}")
+            print("=== Phase 1 : Scan initial -sS + -sV + enrichissement ===")
+
+            # Phase 1 : Scan et enrichissement
+            results, log, history = phase1_initiale(target)
+            max_iterations=iteration-2
+            phase2(target, results, history, log, max_iterations)
+            output = generate_final_report(target, results, history)
         
 
 
-    elif target_type == "domain":
-        emit_scan_status("scanning", f"Début du scan de domaine pour {target}")
+        elif target_type == "domain":
+            emit_scan_status("scanning", f"Début du scan de domaine pour {target}")
 
-        print(f" Traitement spécifique pour le domaine : {target}")
-
-        # 1. Résolution du domaine principal
-        ip_to_names = {}
-        resolved_ips_raw = resolve_domain(target)
-        resolved_ips = [ip for ip in resolved_ips_raw if is_valid_ip(ip)]
-
-        ipv4_map = {}
-        ipv6_map = {}
-        if not resolved_ips:
-            print("[ERREUR] Aucune IP valide résolue pour le domaine principal.")
-        else:
-            print(f"[INFO] IPs valides résolues pour le domaine principal : {', '.join(resolved_ips)}")
-            for ip in resolved_ips:
-                # Ajoute le domaine dans ip_to_names (mappage IP → noms)
-                if ip in ip_to_names:
-                    if target not in ip_to_names[ip]:
-                        ip_to_names[ip].append(target)
-                else:
-                    ip_to_names[ip] = [target]
+            print(f" Traitement spécifique pour le domaine : {target}")
 
-                # Ajoute le domaine dans ipv4_map (pour usage dans le rapport)
-                if ip in ipv4_map:
-                    if target not in ipv4_map[ip]:
-                        ipv4_map[ip].append(target)
-                else:
-                    ipv4_map[ip] = [target]
+            # 1. Résolution du domaine principal
+            ip_to_names = {}
+            resolved_ips_raw = resolve_domain(target)
+            resolved_ips = [ip for ip in resolved_ips_raw if is_valid_ip(ip)]
 
-        # 2. Recherche des sous-domaines avec filtrage IPv4/IPv6
-        subs = enumerate_subdomains(target)
-        if not subs["success"]:
-            print("[ERREUR] Énumération échouée :", subs["errors"])
             ipv4_map = {}
             ipv6_map = {}
-        else:
-            print(f"[INFO] {len(subs['resolved'])} sous-domaines résolus activement.")
-            print(f"[INFO] IPv4 uniques à scanner : {len(subs['ipv4_map'])}")
-            print(f"[INFO] IPv6 uniquement détectées : {len(subs['ipv6_map'])}")
-
-            ipv4_map = subs["ipv4_map"]
-            ipv6_map = subs["ipv6_map"]
-
-            # On ajoute aussi le domaine principal dans la map IPv4
-            for ip in resolved_ips:
-                if ip in ipv4_map:
-                    if target not in ipv4_map[ip]:
-                        ipv4_map[ip].append(target)
-                else:
-                    ipv4_map[ip] = [target]
+            if not resolved_ips:
+                print("[ERREUR] Aucune IP valide résolue pour le domaine principal.")
+            else:
+                print(f"[INFO] IPs valides résolues pour le domaine principal : {', '.join(resolved_ips)}")
+                for ip in resolved_ips:
+                    # Ajoute le domaine dans ip_to_names (mappage IP → noms)
+                    if ip in ip_to_names:
+                        if target not in ip_to_names[ip]:
+                            ip_to_names[ip].append(target)
+                    else:
+                        ip_to_names[ip] = [target]
 
-        # 3. WHOIS 
-        print(f"[INFO] Récupération des informations WHOIS pour {target}...")
-        whois_data = get_whois_info(target)
-        if "Erreur" in whois_data:
-            print("[ERREUR WHOIS] " + whois_data["Erreur"])
-        else:
-            print("[INFO] Données WHOIS récupérées :")
-            for key, value in whois_data.items():
-                print(f"  {key}: {value}")
-
-        # 4. Enregistrements DNS
-        dns_data = get_dns_records(target)
-        if not dns_data.get("_success"):
-            print("[ERREUR] Échec partiel ou total dans la récupération des DNS.")
-            print("Détails des erreurs :", dns_data["_errors"])
-        else:
-            print("[INFO] Enregistrements DNS récupérés avec succès.")
-
-        for rtype in ["A", "AAAA", "MX", "NS", "TXT", "CNAME"]:
-            print(f"{rtype}: {dns_data.get(rtype, [])}")
-
-        # 5. Analyse des IP IPv4 (en mettant le domaine principal en premier)
-        full_report = []
-        # Construction ordonnée : domaine principal d'abord
-        all_items = list(ipv4_map.items())
-
-        # Trie : place les IP liées au domaine cible tout en haut
-        ordered_items = sorted(all_items, key=lambda x: target not in x[1])
-        full_report = []
-
-        for ip, noms in ordered_items:
-            print(f"\n Scan IP : {ip} - associés à : {', '.join(noms)}")
-            results, log, history = phase1_initiale(ip)
-            max_iterations = 0
-            Results, log, history = phase2(ip, results, history, log, max_iterations)
-
-            # Construction des CVE détectées
-            cve_recos = []
-            for entry in Results:
-                if entry.get("vulnerable") and entry.get("cve") and entry["cve"] != "—":
-                    for cve in [c.strip() for c in entry["cve"].split(",") if c.strip()]:
-                        cve_recos.append({
-                            "cve": cve,
-                            "tech": entry.get("technologie", "Service inconnu"),
-                            "port": entry.get("port", "N/A")
-                        })
-
-            cve_lines = []
-
-            if cve_recos:
-                #  Cas CVE → description + recommandation
-                cve_prompt_block = "\n".join(
-                    f"- CVE : {item['cve']} | Service : {item['tech']} | Port : {item['port']}"
-                    for item in cve_recos
-                )
-
-                cve_prompt = f"""
+                    # Ajoute le domaine dans ipv4_map (pour usage dans le rapport)
+                    if ip in ipv4_map:
+                        if target not in ipv4_map[ip]:
+                            ipv4_map[ip].append(target)
+                    else:
+                        ipv4_map[ip] = [target]
+
+            # 2. Recherche des sous-domaines avec filtrage IPv4/IPv6
+            subs = enumerate_subdomains(target)
+            if not subs["success"]:
+                print("[ERREUR] Énumération échouée :", subs["errors"])
+                ipv4_map = {}
+                ipv6_map = {}
+            else:
+                print(f"[INFO] {len(subs['resolved'])} sous-domaines résolus activement.")
+                print(f"[INFO] IPv4 uniques à scanner : {len(subs['ipv4_map'])}")
+                print(f"[INFO] IPv6 uniquement détectées : {len(subs['ipv6_map'])}")
+
+                ipv4_map = subs["ipv4_map"]
+                ipv6_map = subs["ipv6_map"]
+
+                # On ajoute aussi le domaine principal dans la map IPv4
+                for ip in resolved_ips:
+                    if ip in ipv4_map:
+                        if target not in ipv4_map[ip]:
+                            ipv4_map[ip].append(target)
+                    else:
+                        ipv4_map[ip] = [target]
+
+            # 3. WHOIS 
+            print(f"[INFO] Récupération des informations WHOIS pour {target}...")
+            whois_data = get_whois_info(target)
+            if "Erreur" in whois_data:
+                print("[ERREUR WHOIS] " + whois_data["Erreur"])
+            else:
+                print("[INFO] Données WHOIS récupérées :")
+                for key, value in whois_data.items():
+                    print(f"  {key}: {value}")
+
+            # 4. Enregistrements DNS
+            dns_data = get_dns_records(target)
+            if not dns_data.get("_success"):
+                print("[ERREUR] Échec partiel ou total dans la récupération des DNS.")
+                print("Détails des erreurs :", dns_data["_errors"])
+            else:
+                print("[INFO] Enregistrements DNS récupérés avec succès.")
+
+            for rtype in ["A", "AAAA", "MX", "NS", "TXT", "CNAME"]:
+                print(f"{rtype}: {dns_data.get(rtype, [])}")
+
+            # 5. Analyse des IP IPv4 (en mettant le domaine principal en premier)
+            full_report = []
+            # Construction ordonnée : domaine principal d'abord
+            all_items = list(ipv4_map.items())
+
+            # Trie : place les IP liées au domaine cible tout en haut
+            ordered_items = sorted(all_items, key=lambda x: target not in x[1])
+            full_report = []
+
+            ip_scans = []
+            for ip, noms in ordered_items:
+                check_cancelled()
+                print(f"\n Scan IP : {ip} - associés à : {', '.join(noms)}")
+                results, log, history = phase1_initiale(ip)
+                max_iterations = 0
+                Results, log, history = phase2(ip, results, history, log, max_iterations)
+
+                # Construction des CVE détectées
+                cve_recos = []
+                for entry in Results:
+                    if entry.get("vulnerable") and entry.get("cve") and entry["cve"] != "—":
+                        for cve in [c.strip() for c in entry["cve"].split(",") if c.strip()]:
+                            cve_recos.append({
+                                "cve": cve,
+                                "tech": entry.get("technologie", "Service inconnu"),
+                                "port": entry.get("port", "N/A")
+                            })
+
+                reco_prompt = None
+                reco_tokens = 800
+                reco_type = "cve_reco"
+                if cve_recos:
+                    #  Cas CVE → description + recommandation
+                    cve_prompt_block = build_list_context([
+                        f"- CVE : {item['cve']} | Service : {item['tech']} | Port : {item['port']}"
+                        for item in cve_recos
+                    ], label="CVE")
+
+                    reco_prompt = f"""
                 <s>[INST]
                 Tu es un expert en sécurité offensive.
 
@@ -3394,27 +3746,15 @@ def main(cible, iteration):
                 - Pas de HTML ou Markdown
                 [/INST]</s>
                 """
-                cve_response = query_llm(cve_prompt, max_tokens_override=800)
-                current = []
-                for line in cve_response.strip().splitlines():
-                    if line.strip() == "":
-                        if current:
-                            cve_lines.append("\n".join(current).strip())
-                            current = []
-                    else:
-                        current.append(line)
-                if current:
-                    cve_lines.append("\n".join(current).strip())
-
-            else:
-                # ✅ Cas sans CVE → fallback général uniquement si services détectés
-                services_detectes = "\n".join(
-                    f"- Port {entry.get('port', '??')} : {entry.get('technologie', '??')} {entry.get('version', '')}"
-                    for entry in Results if isinstance(entry, dict)
-                )
-
-                if services_detectes.strip():
-                    fallback_prompt = f"""
+                else:
+                    # ✅ Cas sans CVE → fallback général uniquement si services détectés
+                    services_detectes = build_list_context([
+                        f"- Port {entry.get('port', '??')} : {entry.get('technologie', '??')} {entry.get('version', '')}"
+                        for entry in Results if isinstance(entry, dict)
+                    ], label="services")
+
+                    if services_detectes.strip():
+                        reco_prompt = f"""
                     <s>[INST]
                     Tu es un expert en cybersécurité.
 
@@ -3435,66 +3775,117 @@ def main(cible, iteration):
                     - Respectes le format de sortie
                     [/INST]</s>
                     """
-                    fallback_reco = query_llm(fallback_prompt, max_tokens_override=400)
-                    print("résultat du llm : \n",fallback_reco)
-                    if fallback_reco:
-                        cve_lines = [fallback_reco.strip()]
-
-            # Résultats aplatis
-            results_flat = []
-            for r in Results:
-                if isinstance(r, dict):
-                    results_flat.append(r)
-                elif isinstance(r, list):
-                    results_flat.extend(entry for entry in r if isinstance(entry, dict))
-
-            # Ajout à full_report
-            full_report.append({
-                "ip": ip,
-                "noms": noms,
-                "results": results_flat,
-                "cve_recommendations": cve_lines
-            })
-
-
-        print("\n🧾 Résumé des résultats par IP résolue :\n")
-        for entry in full_report:
-            ip = entry["ip"]
-            noms = ", ".join(entry["noms"])
-            print(f"🌐 IP : {ip}")
-            print(f"🔗 Liée à : {noms}")
-            if entry.get("cve_recommendations"):
-                print(f"💬 Recommandations : {len(entry['cve_recommendations'])} ligne(s) générée(s)")
-                for reco in entry["cve_recommendations"]:
-                    print(reco)
-            else:
-                print(f"💬 Recommandation : Aucune\n")
+                        reco_tokens = 400
+                        reco_type = "fallback_reco"
+
+                ip_scans.append({
+                    "ip": ip,
+                    "noms": noms,
+                    "results": Results,
+                    "has_cve": bool(cve_recos),
+                    "prompt": reco_prompt,
+                    "tokens": reco_tokens,
+                    "type": reco_type
+                })
+
+            # Les recommandations des différentes IP sont indépendantes :
+            # elles sont générées en parallèle, dans la limite des slots llama.cpp.
+            pending = [scan for scan in ip_scans if scan["prompt"]]
+            reco_responses = query_llm_batch(
+                [scan["prompt"] for scan in pending],
+                max_tokens_overrides=[scan["tokens"] for scan in pending],
+                prompt_types=[scan["type"] for scan in pending]
+            )
+            for scan, reco_response in zip(pending, reco_responses):
+                scan["response"] = reco_response
+
+            for scan in ip_scans:
+                ip, noms, Results = scan["ip"], scan["noms"], scan["results"]
+                reco_response = scan.get("response")
+                cve_lines = []
+
+                if scan["has_cve"] and reco_response:
+                    current = []
+                    for line in reco_response.strip().splitlines():
+                        if line.strip() == "":
+                            if current:
+                                cve_lines.append("\n".join(current).strip())
+                                current = []
+                        else:
+                            current.append(line)
+                    if current:
+                        cve_lines.append("\n".join(current).strip())
+                elif reco_response:
+                    print("résultat du llm : \n",reco_response)
+                    cve_lines = [reco_response.strip()]
+
+                # Résultats aplatis
+                results_flat = []
+                for r in Results:
+                    if isinstance(r, dict):
+                        results_flat.append(r)
+                    elif isinstance(r, list):
+                        results_flat.extend(entry for entry in r if isinstance(entry, dict))
+
+                # Ajout à full_report
+                full_report.append({
+                    "ip": ip,
+                    "noms": noms,
+                    "results": results_flat,
+                    "cve_recommendations": cve_lines
+                })
+
+
+            print("\n🧾 Résumé des résultats par IP résolue :\n")
+            for entry in full_report:
+                ip = entry["ip"]
+                noms = ", ".join(entry["noms"])
+                print(f"🌐 IP : {ip}")
+                print(f"🔗 Liée à : {noms}")
+                if entry.get("cve_recommendations"):
+                    print(f"💬 Recommandations : {len(entry['cve_recommendations'])} ligne(s) générée(s)")
+                    for reco in entry["cve_recommendations"]:
+                        print(reco)
+                else:
+                    print(f"💬 Recommandation : Aucune\n")
 
-        for ip_entry in full_report:
-            print(f"📊 IP : {ip_entry['ip']} - {len(ip_entry['results'])} services trouvés")
+            for ip_entry in full_report:
+                print(f"📊 IP : {ip_entry['ip']} - {len(ip_entry['results'])} services trouvés")
 
-        # 6. Rapport final
-        reports_dir = os.path.abspath('/root/Pentral/backend/app/static/reports')
-        os.makedirs(reports_dir, exist_ok=True)
+            # 6. Rapport final
+            reports_dir = os.path.abspath('/root/Pentral/backend/app/static/reports')
+            os.makedirs(reports_dir, exist_ok=True)
 
-        filename = f"test.pdf"
-        file_path = os.path.join(reports_dir, filename)
+            filename = f"test.pdf"
+            file_path = os.path.join(reports_dir, filename)
 
-        # URL relative pour stocker dans la DB
-        relative_url = f"/static/reports/{filename}"
-        output_path = os.path.join(reports_dir, filename)
+            # URL relative pour stocker dans la DB
+            relative_url = f"/static/reports/{filename}"
+            output_path = os.path.join(reports_dir, filename)
         
-        output = generate_domain_report(
-            domain_name=target,
-            whois_data=whois_data,
-            dns_data=dns_data,
-            subdomains=subs["resolved"],
-            ip_results=full_report,
-            ipv6_map=ipv6_map,
-            remarks="",
-            output_path=output_path
-        )
-    return output
+            output = generate_domain_report(
+                domain_name=target,
+                whois_data=whois_data,
+                dns_data=dns_data,
+                subdomains=subs["resolved"],
+                ip_results=full_report,
+                ipv6_map=ipv6_map,
+                remarks="",
+                output_path=output_path
+            )
+        print("[INFO] Connexions LLM (pool partagé) :", get_async_llm_client().get_stats())
+        print("[INFO] Tokens générés par type de prompt :", get_token_budgets().get_stats())
+        print("[INFO] Taille des prompts par type :", get_prompt_stats().get_stats())
+        print("[INFO] Prefill llama.cpp (cache de prompt) :", get_prefill_stats().get_stats())
+        if get_command_cache():
+            print("[INFO] Cache des résultats de commandes :", get_command_cache().get_stats())
+        print("[INFO] Politesse par hôte cible :", get_target_limiter().get_stats())
+        return output
+    finally:
+        # Aussi après une erreur ou une annulation du scan
+        release_scan_container()
+        close_shell_sessions()
+        release_scan_slot()
 
 
 
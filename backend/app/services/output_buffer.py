@@ -0,0 +1,170 @@
+import heapq
+import mmap
+import os
+import re
+import tempfile
+from typing import Iterator, List, Tuple, Union
+
+# Taille gardée en mémoire par flux de sortie ; au-delà, la sortie est écrite dans un fichier temporaire
+OUTPUT_MEMORY_BYTES = int(os.environ.get("OUTPUT_MEMORY_BYTES", str(256 * 1024)))
+# Budget (octets) de l'extrait transmis au LLM pour l'analyse d'un résultat
+EXCERPT_BYTE_BUDGET = int(os.environ.get("EXCERPT_BYTE_BUDGET", "6000"))
+# Longueur maximale d'une ligne dans l'extrait
+EXCERPT_MAX_LINE = 300
+# Lignes de début et de fin toujours candidates (contexte de la commande, résumé final)
+EXCERPT_HEAD_LINES = 5
+EXCERPT_TAIL_LINES = 3
+# Nombre maximal de lignes candidates retenues pendant le parcours (sorties de plusieurs Mo)
+EXCERPT_MAX_CANDIDATES = 2000
+READ_BLOCK_SIZE = 1024 * 1024
+OMITTED_MARKER_BYTES = 36
+
+# Lignes utiles à l'identification des services, par ordre d'importance
+EXCERPT_PATTERNS = [
+    (re.compile(r"cpe:(/|2\.3:)", re.IGNORECASE), 10),
+    (re.compile(r"CVE-\d{4}-\d{4,}", re.IGNORECASE), 9),
+    (re.compile(r"^\s*\d+/(tcp|udp)\s+open", re.IGNORECASE), 8),
+    (re.compile(r"\bvulnerable\b", re.IGNORECASE), 7),
+    (re.compile(r"\b(version|server|banner|x-powered-by|running|os details|service info)\b", re.IGNORECASE), 6),
+    # Produit suivi d'une version : OpenSSH 8.2p1, Apache/2.4.41, nginx 1.18.0
+    (re.compile(r"\b[a-z][\w\-]*[/ _]v?\d+\.\d+(\.\d+)*[a-z0-9\-]*\b", re.IGNORECASE), 5),
+    (re.compile(r"\b(error|failed|not found|usage:|denied|timed out)\b", re.IGNORECASE), 4),
+]
+
+
+class OutputBuffer:
+    """
+    Sortie d'une commande bornée en mémoire : les OUTPUT_MEMORY_BYTES premiers octets restent en mémoire,
+    la suite est écrite dans un fichier temporaire (supprimé à la fermeture), relu via mmap.
+    """
+
+    def __init__(self, memory_limit: int = OUTPUT_MEMORY_BYTES):
+        self.memory_limit = memory_limit
+        self._memory = bytearray()
+        self._file = None
+        self.size = 0
+        self.spilled = False
+
+    @classmethod
+    def from_text(cls, text: str) -> "OutputBuffer":
+        buffer = cls()
+        buffer.write(text.encode("utf-8"))
+        return buffer
+
+    def write(self, data: bytes) -> None:
+        if not data:
+            return
+        room = self.memory_limit - len(self._memory)
+        if room > 0:
+            self._memory += data[:room]
+            data = data[room:]
+        if data:
+            if self._file is None:
+                self._file = tempfile.TemporaryFile(prefix="pentral-output-")
+                self.spilled = True
+            self._file.write(data)
+        self.size = len(self._memory) + (self._file.tell() if self._file else 0)
+
+    def _blocks(self) -> Iterator[bytes]:
+        yield bytes(self._memory)
+        if self._file is not None:
+            self._file.flush()
+            if self._file.tell() == 0:
+                return
+            with mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                for offset in range(0, len(mapped), READ_BLOCK_SIZE):
+                    yield mapped[offset:offset + READ_BLOCK_SIZE]
+
+    def iter_lines(self) -> Iterator[str]:
+        """Parcourt la sortie ligne par ligne sans la charger entièrement."""
+        pending = b""
+        for block in self._blocks():
+            pending += block
+            *lines, pending = pending.split(b"\n")
+            for line in lines:
+                yield line.decode("utf-8", errors="replace").rstrip("\r")
+        if pending:
+            yield pending.decode("utf-8", errors="replace").rstrip("\r")
+
+    def text(self) -> str:
+        """Sortie complète (à réserver aux sorties de taille raisonnable)."""
+        return b"".join(self._blocks()).decode("utf-8", errors="replace")
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def score_line(line: str) -> int:
+    return sum(weight for pattern, weight in EXCERPT_PATTERNS if pattern.search(line))
+
+
+def build_excerpt(source: Union[str, OutputBuffer], budget: int = EXCERPT_BYTE_BUDGET) -> str:
+    """
+    Extrait d'une sortie dans la limite de `budget` octets : les lignes les plus utiles
+    (CPE, CVE, ports ouverts, bannières et versions, erreurs) sont retenues en priorité,
+    avec les premières et dernières lignes ; elles sont rendues dans leur ordre d'origine,
+    les passages omis étant signalés. Une sortie qui tient dans le budget est renvoyée telle quelle.
+    """
+    if isinstance(source, str):
+        if len(source.encode("utf-8")) <= budget:
+            return source
+        lines: Iterator[str] = iter(source.splitlines())
+    else:
+        if source.size <= budget:
+            return source.text()
+        lines = source.iter_lines()
+
+    # Tas des meilleures lignes : (score, -index, index, ligne) ; les doublons exacts sont ignorés
+    heap: List[Tuple[int, int, int, str]] = []
+    tail: List[Tuple[int, str]] = []
+    seen = set()
+    total = 0
+    for index, line in enumerate(lines):
+        total += 1
+        stripped = line.strip()
+        if not stripped:
+            continue
+        tail.append((index, line))
+        if len(tail) > EXCERPT_TAIL_LINES:
+            tail.pop(0)
+        if stripped in seen:
+            continue
+        score = score_line(line)
+        if index < EXCERPT_HEAD_LINES:
+            score += 3
+        if score <= 0:
+            continue
+        seen.add(stripped)
+        item = (score, -index, index, line)
+        if len(heap) < EXCERPT_MAX_CANDIDATES:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+    for index, line in tail:
+        if line.strip() not in seen:
+            heap.append((2, -index, index, line))
+
+    selected = {}
+    used = 0
+    for score, _, index, line in sorted(heap, reverse=True):
+        if len(line) > EXCERPT_MAX_LINE:
+            line = line[:EXCERPT_MAX_LINE] + " [...]"
+        # Chaque ligne retenue peut introduire un marqueur "[... n ligne(s) omise(s) ...]"
+        cost = len(line.encode("utf-8")) + 1 + OMITTED_MARKER_BYTES
+        if used + cost > budget:
+            continue
+        selected[index] = line
+        used += cost
+
+    parts = []
+    previous = -1
+    for index in sorted(selected):
+        if index - previous > 1:
+            parts.append(f"[... {index - previous - 1} ligne(s) omise(s) ...]")
+        parts.append(selected[index])
+        previous = index
+    if total - 1 > previous:
+        parts.append(f"[... {total - 1 - previous} ligne(s) omise(s) ...]")
+    return "\n".join(parts)
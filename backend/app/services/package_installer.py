@@ -0,0 +1,153 @@
+import os
+import re
+import shlex
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from app.services.command_executor import run_command
+
+# Délai maximal d'une transaction apt groupée
+TOOL_INSTALL_TIMEOUT = float(os.environ.get("TOOL_INSTALL_TIMEOUT", "900"))
+# Fenêtre (secondes) pendant laquelle les demandes d'installation sont regroupées avant la transaction
+INSTALL_BATCH_WINDOW = float(os.environ.get("INSTALL_BATCH_WINDOW", "0.5"))
+# Durée de conservation du résultat d'une installation (succès, puis échec)
+INSTALL_RESULT_TTL = float(os.environ.get("INSTALL_RESULT_TTL", "3600"))
+INSTALL_FAILURE_TTL = 60
+
+APT_INSTALL_RE = re.compile(r"^(?:sudo\s+)?(?:DEBIAN_FRONTEND=\S+\s+)?apt(?:-get)?\s+install\s+(.*)$")
+# Paquets rejetés par apt : la transaction est relancée sans eux
+APT_UNKNOWN_RE = re.compile(r"Unable to locate package (\S+)|Package '?([\w.+\-]+)'? has no installation candidate")
+
+
+def parse_install_command(command: str) -> Optional[List[str]]:
+    """
+    Noms des paquets d'une commande `apt(-get) install` (options retirées), ou None si la commande
+    n'est pas une installation apt simple (pip, script, enchaînement de commandes).
+    """
+    command = command.replace("`", "").strip()
+    if any(sep in command for sep in ("&&", "||", ";", "|")):
+        return None
+    match = APT_INSTALL_RE.match(command)
+    if not match:
+        return None
+    try:
+        args = shlex.split(match.group(1))
+    except ValueError:
+        return None
+    packages = [arg for arg in args if not arg.startswith("-") and re.fullmatch(r"[\w.+\-:=]+", arg)]
+    return packages or None
+
+
+class PackageInstallQueue:
+    """
+    File d'installation partagée par tous les scans : les paquets demandés pendant INSTALL_BATCH_WINDOW
+    sont installés en une seule transaction apt (un seul verrou, un seul chargement d'index, un seul
+    passage des triggers dpkg). Le résultat est mis en cache : les scans qui attendent les mêmes paquets
+    sont débloqués ensemble, et une demande déjà satisfaite ne relance pas apt.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending: Dict[str, Future] = {}
+        self._results: Dict[str, Tuple[bool, float]] = {}
+        self._worker: Optional[threading.Thread] = None
+        self.transactions = 0
+
+    def _cached(self, package: str) -> Optional[bool]:
+        entry = self._results.get(package)
+        if entry is None:
+            return None
+        ok, stored_at = entry
+        ttl = INSTALL_RESULT_TTL if ok else INSTALL_FAILURE_TTL
+        return ok if time.monotonic() - stored_at < ttl else None
+
+    def request(self, packages: Iterable[str]) -> Dict[str, Future]:
+        """Ajoute les paquets à la file et renvoie un Future par paquet (True si installé)."""
+        futures: Dict[str, Future] = {}
+        with self._lock:
+            for package in dict.fromkeys(packages):
+                cached = self._cached(package)
+                if cached is not None:
+                    future = Future()
+                    future.set_result(cached)
+                elif package in self._pending:
+                    future = self._pending[package]
+                else:
+                    future = Future()
+                    self._pending[package] = future
+                futures[package] = future
+            if self._pending and self._worker is None:
+                self._worker = threading.Thread(target=self._drain, name="apt-install-queue", daemon=True)
+                self._worker.start()
+        return futures
+
+    def install(self, packages: Iterable[str]) -> Dict[str, bool]:
+        """Installe les paquets (en les regroupant avec les demandes concurrentes) et attend le résultat."""
+        futures = self.request(packages)
+        return {package: future.result() for package, future in futures.items()}
+
+    def invalidate(self, packages: Optional[Iterable[str]] = None) -> None:
+        with self._lock:
+            for package in (list(self._results) if packages is None else packages):
+                self._results.pop(package, None)
+
+    def _drain(self) -> None:
+        while True:
+            time.sleep(INSTALL_BATCH_WINDOW)
+            with self._lock:
+                batch = dict(self._pending)
+                if not batch:
+                    self._worker = None
+                    return
+            try:
+                status = self._run_transaction(sorted(batch))
+            except Exception as e:
+                print(f"[ERREUR] Transaction apt impossible : {e}")
+                status = {package: False for package in batch}
+            now = time.monotonic()
+            with self._lock:
+                for package, future in batch.items():
+                    self._results[package] = (status.get(package, False), now)
+                    self._pending.pop(package, None)
+                    future.set_result(status.get(package, False))
+
+    def _run_transaction(self, packages: List[str]) -> Dict[str, bool]:
+        """Une transaction apt pour tous les paquets ; les paquets inconnus sont retirés puis la transaction relancée."""
+        status = {}
+        remaining = list(packages)
+        while remaining:
+            self.transactions += 1
+            print(f"[INFO] Installation groupée ({len(remaining)} paquet(s)) : {', '.join(remaining)}")
+            execution = run_command(
+                "DEBIAN_FRONTEND=noninteractive apt-get install -y --no-install-recommends "
+                + " ".join(shlex.quote(package) for package in remaining),
+                timeout=TOOL_INSTALL_TIMEOUT
+            )
+            ok = execution.ok
+            errors = execution.stderr
+            execution.close()
+            if ok:
+                status.update({package: True for package in remaining})
+                break
+            unknown = {a or b for a, b in APT_UNKNOWN_RE.findall(errors)} & set(remaining)
+            if not unknown:
+                print(f"[ERREUR] Échec de l'installation groupée (code {execution.exit_code}) : {errors.strip()[-500:]}")
+                status.update({package: False for package in remaining})
+                break
+            print(f"[AVERTISSEMENT] Paquets introuvables, retirés de la transaction : {', '.join(sorted(unknown))}")
+            status.update({package: False for package in unknown})
+            remaining = [package for package in remaining if package not in unknown]
+        return status
+
+
+_install_queue = PackageInstallQueue()
+
+
+def get_install_queue() -> PackageInstallQueue:
+    return _install_queue
+
+
+def install_packages(packages: Iterable[str]) -> Dict[str, bool]:
+    return _install_queue.install(packages)
@@ -12,6 +12,7 @@ from jinja2 import Environment, FileSystemLoader
 import pdfkit
 from datetime import datetime
 import smtplib
+from app.services.llm_client import get_llm_client
 import requests
 
 # Base de données locale pour suivre les commandes déjà exécutées
@@ -359,19 +360,9 @@ def query_llm(prompt, api_url="http://host.docker.internal:8080/v1/chat/completi
         # batch_size = vitesse 
         # repeat_penalty # penaliter pour les reponses repetitives
         
-        # En-têtes nécessaires
-        headers = {
-            "Content-Type": "application/json",
-            "Accept": "application/json"
-        }
-
         print("[QUERY] Envoi de la requête à l'API...")
-        response = requests.post(api_url, json=payload, headers=headers)
-        response.raise_for_status()
-
         # Récupère la réponse (format OpenAI)
-        data = response.json()
-        llm_response = data["choices"][0]["message"]["content"].strip()
+        llm_response = get_llm_client().chat(payload, api_url)
         
         # Pour les réponses de commandes, vérifier si le format YAML est respecté
         if "tool_name:" in prompt and "enumerate_command:" in prompt:
@@ -12,6 +12,7 @@ from jinja2 import Environment, FileSystemLoader
 import pdfkit
 from datetime import datetime
 import smtplib
+from app.services.llm_client import get_llm_client
 import requests
 
 def send_pause_request(command):
@@ -473,41 +474,12 @@ def query_llm(prompt, api_url="http://host.docker.internal:8080/v1/chat/completi
             "echo": False
         }
         
-        # En-têtes nécessaires
-        headers = {
-            "Content-Type": "application/json",
-            "Accept": "application/json"
-        }
-
         print("[QUERY] Envoi de la requête à l'API...")
-        response = requests.post(api_url, json=payload, headers=headers, stream=True)
-        response.raise_for_status()        
-        
         buffer = ""
-        for line in response.iter_lines():
-            if line:
-                if line.startswith(b"data: "):
-                    raw = line[6:]
-                else:
-                    raw = line
-
-                if raw.strip() == b"[DONE]":
-                    break
-                try:
-                    data = json.loads(raw)
-                    delta = data["choices"][0]["delta"].get("content", "")
-                    buffer += delta
-                    callback_to_use(delta)  # Utilise le callback approprié
-                except Exception as e:
-                    print(f"[ERREUR] Parsing stream : {e} - raw={raw}")
-                    continue
-        
-        if buffer:
-            llm_response = buffer
-        else:
-            # Récupère la réponse (format OpenAI)
-            data = response.json()
-            llm_response = data["choices"][0]["message"]["content"].strip()
+        for delta in get_llm_client().stream_chat(payload, api_url):
+            buffer += delta
+            callback_to_use(delta)  # Utilise le callback approprié
+        llm_response = buffer
         
         print("fin de reponse version complete", llm_response)
         
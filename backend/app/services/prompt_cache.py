@@ -0,0 +1,131 @@
+import contextvars
+import os
+import threading
+from typing import Dict, List, Optional
+
+from app.services.llm_client import DEFAULT_API_URL, LLM_SLOTS
+from app.services.llm_router import LLM_ENDPOINTS
+
+# Réutilisation du cache KV de llama.cpp pour le préfixe commun des prompts (cache_prompt)
+LLM_CACHE_PROMPT = os.environ.get("LLM_CACHE_PROMPT", "1") == "1"
+
+
+class SlotPinner:
+    """
+    Attribue à chaque scan un serveur llama.cpp et un slot fixes (id_slot) : les appels successifs
+    du scan retombent sur le même cache KV et ne re-calculent que la partie variable du prompt.
+    Le couple (serveur, slot) le moins utilisé est choisi ; l'attribution est mémorisée dans le
+    contexte du scan et suit donc ses threads de sonde.
+    """
+
+    def __init__(self, slots: int = LLM_SLOTS, endpoints: Optional[List[str]] = None):
+        self.slots = max(slots, 1)
+        self.endpoints = endpoints or LLM_ENDPOINTS or [DEFAULT_API_URL]
+        self._lock = threading.Lock()
+        self._load = {(endpoint, slot): 0 for endpoint in self.endpoints for slot in range(self.slots)}
+        # Slot du scan courant ; propagé aux threads de sonde avec le contexte du scan
+        self._pin: contextvars.ContextVar = contextvars.ContextVar("scan_llm_slot", default=None)
+
+    def pin(self, scan_key: str) -> int:
+        self.release()
+        with self._lock:
+            # À charge égale, les slots de même rang sont répartis sur les serveurs
+            endpoint, slot = min(self._load, key=lambda pin: (self._load[pin], pin[1]))
+            self._load[(endpoint, slot)] += 1
+        self._pin.set((endpoint, slot))
+        print(f"[INFO] Scan {scan_key} : slot llama.cpp {slot} de {endpoint} réservé pour le cache de prompt")
+        return slot
+
+    def current(self) -> Optional[int]:
+        pin = self._pin.get()
+        return pin[1] if pin else None
+
+    def current_endpoint(self) -> Optional[str]:
+        pin = self._pin.get()
+        return pin[0] if pin else None
+
+    def release(self) -> None:
+        pin = self._pin.get()
+        if pin is None:
+            return
+        with self._lock:
+            if pin in self._load:
+                self._load[pin] = max(self._load[pin] - 1, 0)
+        self._pin.set(None)
+
+
+class PrefillStats:
+    """Temps de prefill mesuré par llama.cpp (timings) et temps économisé grâce au cache de prompt."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.evaluated_tokens = 0
+        self.cached_tokens = 0
+        self.prefill_ms = 0.0
+        self.saved_ms = 0.0
+
+    def record(self, timings: Dict, prompt_tokens: int) -> Dict:
+        """
+        timings : bloc "timings" renvoyé par llama.cpp en fin de flux.
+        prompt_tokens : taille estimée du prompt, utilisée si le serveur ne renvoie pas cache_n.
+        """
+        evaluated = int(timings.get("prompt_n", 0))
+        prompt_ms = float(timings.get("prompt_ms", 0.0))
+        cached = timings.get("cache_n")
+        cached = int(cached) if cached is not None else max(prompt_tokens - evaluated, 0)
+        per_token = prompt_ms / evaluated if evaluated else 0.0
+        saved = cached * per_token
+        with self._lock:
+            self.calls += 1
+            self.evaluated_tokens += evaluated
+            self.cached_tokens += cached
+            self.prefill_ms += prompt_ms
+            self.saved_ms += saved
+        return {"evaluated": evaluated, "cached": cached, "prefill_ms": round(prompt_ms, 1),
+                "saved_ms": round(saved, 1)}
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "evaluated_tokens": self.evaluated_tokens,
+                "cached_tokens": self.cached_tokens,
+                "prefill_ms": round(self.prefill_ms, 1),
+                "saved_ms": round(self.saved_ms, 1)
+            }
+
+
+_pinner = SlotPinner()
+_prefill_stats = PrefillStats()
+
+
+def pin_scan_slot(scan_key: str) -> int:
+    """Réserve un slot llama.cpp pour le scan exécuté dans le contexte courant."""
+    return _pinner.pin(scan_key)
+
+
+def release_scan_slot() -> None:
+    _pinner.release()
+
+
+def current_scan_slot() -> Optional[int]:
+    return _pinner.current()
+
+
+def current_scan_endpoint() -> Optional[str]:
+    """Serveur llama.cpp du slot réservé : les requêtes du scan y restent tant qu'il répond."""
+    return _pinner.current_endpoint()
+
+
+def apply_prompt_cache(payload: Dict, id_slot: Optional[int]) -> Dict:
+    """Active cache_prompt et, si un slot est réservé, épingle la requête sur ce slot."""
+    if LLM_CACHE_PROMPT:
+        payload["cache_prompt"] = True
+        if id_slot is not None:
+            payload["id_slot"] = id_slot
+    return payload
+
+
+def get_prefill_stats() -> PrefillStats:
+    return _prefill_stats
@@ -0,0 +1,149 @@
+import math
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, List
+
+# Budget (en tokens) du bloc "commandes déjà testées" des prompts de phase 2
+HISTORY_TOKEN_BUDGET = 600
+# Nombre de commandes les plus récentes conservées telles quelles
+HISTORY_RECENT_VERBATIM = 5
+# Budget des listes (services, CVE) injectées dans les prompts de recommandation
+LIST_TOKEN_BUDGET = 800
+
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+HISTORY_SUMMARY_HEADER = "Commandes plus anciennes (résumé) :"
+HISTORY_RECENT_HEADER = "Dernières commandes :"
+
+
+def count_tokens(text: str) -> int:
+    """
+    Estimation locale du nombre de tokens (sans appel au serveur) :
+    un token par ponctuation, un token par tranche de 4 caractères pour les mots,
+    proche du découpage SentencePiece de Mistral sur du texte français/technique.
+    """
+    if not text:
+        return 0
+    return sum(math.ceil(len(piece) / 4) for piece in _TOKEN_RE.findall(text))
+
+
+def extract_ports(command: str) -> str:
+    """Ports visés par une commande (valeur de l'option -p), chaîne vide si absente."""
+    if "-p" not in command:
+        return ""
+    try:
+        index = command.index("-p")
+        return command[index:].split()[1]
+    except Exception:
+        return ""
+
+
+def _format_command(cmd: Dict) -> str:
+    ports = extract_ports(cmd["enumerate_command"])
+    port_info = f" (Ports: {ports})" if ports else ""
+    return f"- {cmd['tool_name']}{port_info} : {cmd['status']}\n  → {cmd['enumerate_command']}"
+
+
+def build_history_context(commands: List[Dict], budget: int = HISTORY_TOKEN_BUDGET,
+                          recent: int = HISTORY_RECENT_VERBATIM) -> str:
+    """
+    Vue bornée de l'historique des commandes pour les prompts :
+    les `recent` dernières commandes sont reprises telles quelles, les plus anciennes
+    sont regroupées par outil et par port (nombre d'essais et statuts).
+    Le résultat ne dépasse jamais `budget` tokens ; les entrées les plus récentes sont prioritaires.
+    """
+    if not commands:
+        return "Aucune commande exécutée."
+
+    recent_cmds = commands[-recent:] if recent > 0 else []
+    older_cmds = commands[:-recent] if recent > 0 else list(commands)
+
+    groups: "OrderedDict[tuple, Dict]" = OrderedDict()
+    for cmd in older_cmds:
+        key = (cmd["tool_name"], extract_ports(cmd["enumerate_command"]))
+        group = groups.setdefault(key, {"count": 0, "status": {}})
+        group["count"] += 1
+        group["status"][cmd["status"]] = group["status"].get(cmd["status"], 0) + 1
+
+    summaries = []
+    for (tool, ports), group in groups.items():
+        port_info = f" (Ports: {ports})" if ports else ""
+        statuts = ", ".join(f"{n} {s}" for s, n in group["status"].items())
+        summaries.append(f"- {tool}{port_info} : {group['count']} commande(s) déjà testée(s) ({statuts})")
+
+    # Priorité : commandes récentes (de la plus récente à la plus ancienne), puis les résumés
+    candidates = [(_format_command(c), "recent", i) for i, c in reversed(list(enumerate(recent_cmds)))]
+    candidates += [(line, "summary", i) for i, line in enumerate(summaries)]
+
+    kept_recent, kept_summary = {}, {}
+    # Place réservée aux titres et à la ligne "omises" pour ne jamais dépasser le budget
+    used = (count_tokens(HISTORY_SUMMARY_HEADER) + count_tokens(HISTORY_RECENT_HEADER)
+            + count_tokens(f"- ... {len(candidates)} entrée(s) plus ancienne(s) omise(s)") + 3)
+    omitted = 0
+    for text, kind, index in candidates:
+        cost = count_tokens(text) + 1
+        if used + cost > budget:
+            omitted += 1
+            continue
+        used += cost
+        (kept_recent if kind == "recent" else kept_summary)[index] = text
+
+    lines = []
+    if kept_summary:
+        lines.append(HISTORY_SUMMARY_HEADER)
+        lines.extend(kept_summary[i] for i in sorted(kept_summary))
+    if kept_recent:
+        lines.append(HISTORY_RECENT_HEADER)
+        lines.extend(kept_recent[i] for i in sorted(kept_recent))
+    if omitted:
+        lines.append(f"- ... {omitted} entrée(s) plus ancienne(s) omise(s)")
+    return "\n".join(lines) if lines else "Aucune commande exécutée."
+
+
+def build_list_context(lines: List[str], budget: int = LIST_TOKEN_BUDGET, label: str = "éléments") -> str:
+    """Garde les premières lignes (déjà triées par priorité par l'appelant) dans la limite du budget."""
+    kept = []
+    used = count_tokens(f"- ... {len(lines)} autres {label} omis") + 1
+    for line in lines:
+        cost = count_tokens(line) + 1
+        if used + cost > budget:
+            break
+        kept.append(line)
+        used += cost
+    if len(kept) < len(lines):
+        kept.append(f"- ... {len(lines) - len(kept)} autres {label} omis")
+    return "\n".join(kept)
+
+
+class PromptSizeStats:
+    """Taille (tokens estimés) des prompts envoyés, par type de prompt."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sizes: Dict[str, List[int]] = {}
+
+    def record(self, prompt_type: str, prompt: str) -> int:
+        size = count_tokens(prompt)
+        with self._lock:
+            self._sizes.setdefault(prompt_type, []).append(size)
+        return size
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return {
+                prompt_type: {
+                    "count": len(sizes),
+                    "avg": round(sum(sizes) / len(sizes)),
+                    "max": max(sizes),
+                    "last": sizes[-1]
+                }
+                for prompt_type, sizes in self._sizes.items() if sizes
+            }
+
+
+_prompt_stats = PromptSizeStats()
+
+
+def get_prompt_stats() -> PromptSizeStats:
+    return _prompt_stats
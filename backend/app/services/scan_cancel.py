@@ -0,0 +1,141 @@
+import concurrent.futures
+import contextvars
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+
+class ScanCancelled(BaseException):
+    """
+    Levée dans le scan annulé. Dérive de BaseException (comme asyncio.CancelledError) pour traverser
+    les `except Exception` des moteurs de scan jusqu'au gestionnaire de la route.
+    """
+
+
+class CancelToken:
+    """
+    Jeton d'annulation d'un scan. Les attentes longues (commandes, flux LLM) y inscrivent un rappel
+    qui les interrompt ; le moteur vérifie le jeton entre deux étapes (check).
+    """
+
+    def __init__(self, scan_id: str):
+        self.scan_id = scan_id
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._callbacks: Dict[int, Callable[[], Any]] = {}
+        self._next_id = 0
+        self.reason: Optional[str] = None
+        self.cancelled_at: Optional[float] = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self, reason: str = "annulé par l'utilisateur") -> bool:
+        """Annule le scan et interrompt les attentes en cours ; False s'il était déjà annulé."""
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self.reason = reason
+            self.cancelled_at = time.time()
+            self._event.set()
+            callbacks: List[Callable[[], Any]] = list(self._callbacks.values())
+            self._callbacks.clear()
+        print(f"[INFO] Annulation du scan {self.scan_id} ({reason}) : {len(callbacks)} opération(s) interrompue(s)")
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"[ERREUR] Interruption d'une opération du scan {self.scan_id} : {e}")
+        return True
+
+    def add_callback(self, callback: Callable[[], Any]) -> Callable[[], None]:
+        """Inscrit un rappel d'interruption (appelé tout de suite si le scan est déjà annulé) ; renvoie sa désinscription."""
+        with self._lock:
+            if not self._event.is_set():
+                callback_id = self._next_id
+                self._next_id += 1
+                self._callbacks[callback_id] = callback
+                return lambda: self._remove(callback_id)
+        callback()
+        return lambda: None
+
+    def _remove(self, callback_id: int) -> None:
+        with self._lock:
+            self._callbacks.pop(callback_id, None)
+
+    def check(self) -> None:
+        if self._event.is_set():
+            raise ScanCancelled(self.scan_id)
+
+
+# Jeton du scan en cours ; propagé aux threads de sonde avec le contexte du scan
+_current: contextvars.ContextVar = contextvars.ContextVar("scan_cancel_token", default=None)
+_active: Dict[str, CancelToken] = {}
+_active_lock = threading.Lock()
+
+
+def start_scan_cancellation(scan_id: str) -> CancelToken:
+    """Ouvre le jeton d'annulation du scan ; les opérations lancées ensuite depuis ce contexte y sont rattachées."""
+    token = CancelToken(scan_id)
+    with _active_lock:
+        _active[scan_id] = token
+    _current.set(token)
+    return token
+
+
+def finish_scan_cancellation(scan_id: str) -> None:
+    with _active_lock:
+        token = _active.pop(scan_id, None)
+    if _current.get() is token:
+        _current.set(None)
+
+
+def run_cancellable(scan_id: str, fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """
+    Exécute fn (main() d'un moteur de scan) avec le jeton d'annulation de scan_id, refermé dans tous
+    les cas : une annulation pendant fn lève ScanCancelled chez l'appelant.
+    """
+    start_scan_cancellation(scan_id)
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        finish_scan_cancellation(scan_id)
+
+
+def cancel_scan(scan_id: str, reason: str = "annulé par l'utilisateur") -> bool:
+    """Annule un scan en cours dans ce processus ; False s'il n'est pas en cours ou déjà annulé."""
+    with _active_lock:
+        token = _active.get(scan_id)
+    return token is not None and token.cancel(reason)
+
+
+def current_cancel_token() -> Optional[CancelToken]:
+    return _current.get()
+
+
+def check_cancelled() -> None:
+    """Point d'arrêt entre deux étapes du scan : lève ScanCancelled si le scan courant est annulé."""
+    token = _current.get()
+    if token is not None:
+        token.check()
+
+
+def wait_cancellable(future: concurrent.futures.Future) -> Any:
+    """
+    Attend le résultat d'une coroutine soumise à la boucle partagée (run_coroutine_threadsafe).
+    Si le scan courant est annulé, le futur est annulé, ce qui annule la tâche asyncio : les
+    coroutines arrêtent alors leur groupe de processus ou ferment leur connexion.
+    """
+    token = _current.get()
+    if token is None:
+        return future.result()
+    remove = token.add_callback(future.cancel)
+    try:
+        return future.result()
+    except concurrent.futures.CancelledError:
+        if token.cancelled:
+            raise ScanCancelled(token.scan_id) from None
+        raise
+    finally:
+        remove()
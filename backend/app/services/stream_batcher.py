@@ -0,0 +1,100 @@
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+# Fenêtre de regroupement des tokens avant envoi au client (millisecondes)
+STREAM_WINDOW_MS = float(os.environ.get("STREAM_WINDOW_MS", "50"))
+# Taille maximale du tampon avant envoi immédiat (octets)
+STREAM_MAX_BYTES = int(os.environ.get("STREAM_MAX_BYTES", "512"))
+
+
+class TokenBatcher:
+    """
+    Regroupe les tokens du LLM avant de les envoyer au client Socket.IO.
+    Le tampon est vidé lorsque la fenêtre de temps est écoulée ou que le seuil d'octets
+    est atteint, et une dernière fois en fin de flux (flush), pour éviter une trame par token.
+    S'utilise directement comme streaming_callback : batcher(token).
+    Un tampon n'est retiré et envoyé que sous _emit_lock : les trames partent dans l'ordre des tokens,
+    même quand le timer et un appel à push vident le tampon en même temps.
+    """
+
+    def __init__(self, emit_fn: Callable[[str], None], window_ms: float = STREAM_WINDOW_MS,
+                 max_bytes: int = STREAM_MAX_BYTES, name: str = ""):
+        self.emit_fn = emit_fn
+        self.window = max(window_ms, 0) / 1000.0
+        self.max_bytes = max_bytes
+        self.name = name
+        self._buffer: List[str] = []
+        self._buffer_bytes = 0
+        self._lock = threading.Lock()
+        self._emit_lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
+        self._started_at = time.monotonic()
+        self._tokens = 0
+        self._emits = 0
+        self._bytes = 0
+
+    def __call__(self, token: str) -> None:
+        self.push(token)
+
+    def push(self, token: str) -> None:
+        if not token:
+            return
+        with self._lock:
+            self._buffer.append(token)
+            self._buffer_bytes += len(token.encode("utf-8"))
+            self._tokens += 1
+            full = self.window == 0 or self._buffer_bytes >= self.max_bytes
+            if not full and self._timer is None:
+                self._timer = threading.Timer(self.window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if full:
+            self.flush()
+
+    def _take(self) -> str:
+        """Vide le tampon (à appeler sous verrou) et annule le timer en attente."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        chunk = "".join(self._buffer)
+        self._buffer = []
+        self._buffer_bytes = 0
+        return chunk
+
+    def flush(self) -> None:
+        """Envoie immédiatement le contenu du tampon (fin de fenêtre ou fin de flux [DONE])."""
+        with self._emit_lock:
+            with self._lock:
+                chunk = self._take()
+            if chunk:
+                self._emits += 1
+                self._bytes += len(chunk.encode("utf-8"))
+                self.emit_fn(chunk)
+
+    def close(self) -> Dict:
+        """Dernier envoi puis rapport de débit."""
+        self.flush()
+        stats = self.get_stats()
+        print(f"[INFO] Streaming LLM {self.name} : {stats}")
+        return stats
+
+    def get_stats(self) -> Dict:
+        elapsed = max(time.monotonic() - self._started_at, 1e-6)
+        return {
+            "tokens": self._tokens,
+            "emits": self._emits,
+            "bytes": self._bytes,
+            "emits_per_sec": round(self._emits / elapsed, 2),
+            "tokens_per_emit": round(self._tokens / self._emits, 2) if self._emits else 0,
+            "window_ms": self.window * 1000,
+            "max_bytes": self.max_bytes,
+        }
+
+
+def flush_stream(callback) -> None:
+    """Vide le tampon d'un callback de streaming s'il en a un (fin de réponse LLM)."""
+    flush = getattr(callback, "flush", None)
+    if callable(flush):
+        flush()
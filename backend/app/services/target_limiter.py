@@ -0,0 +1,275 @@
+import ipaddress
+import os
+import re
+import shlex
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+from urllib.parse import urlparse
+
+from app.services.command_executor import COMMAND_POOL_PER_TARGET, CommandResult, command_tool
+from app.services.scan_cancel import check_cancelled
+from app.services.tool_inventory import command_tools
+
+# Limitation par hôte cible des commandes de scan, tous scans et agents confondus (TARGET_LIMITER=0 pour la couper)
+TARGET_LIMITER_ENABLED = os.environ.get("TARGET_LIMITER", "1") == "1"
+# Seau à jetons par hôte : commandes lancées par seconde et rafale autorisée
+TARGET_RATE = float(os.environ.get("TARGET_RATE", "1"))
+TARGET_BURST = int(os.environ.get("TARGET_BURST", "3"))
+# Commandes simultanées sur un même hôte
+TARGET_CONCURRENCY = int(os.environ.get("TARGET_CONCURRENCY", str(COMMAND_POOL_PER_TARGET)))
+# Réduction adaptative : facteur divisé par deux à chaque signe de saturation (délai dépassé,
+# connexion réinitialisée), remonté par pas après chaque commande sans incident
+TARGET_MIN_FACTOR = 0.25
+TARGET_RECOVERY_STEP = 0.1
+TARGET_WAIT_POLL = 0.5
+
+# Commandes simultanées par protocole sur un même hôte : les services fragiles (SMB, SNMP, SSH)
+# ne reçoivent qu'une sonde à la fois
+PROTOCOL_CONCURRENCY = {
+    "portscan": 1,
+    "smb": 1,
+    "snmp": 1,
+    "ssh": 1,
+    "ftp": 1,
+    "rpc": 1,
+    "http": 2,
+    "dns": 2,
+}
+DEFAULT_PROTOCOL_CONCURRENCY = 2
+
+TOOL_PROTOCOLS = {
+    "enum4linux": "smb",
+    "smbclient": "smb",
+    "rpcclient": "smb",
+    "snmpwalk": "snmp",
+    "snmp-check": "snmp",
+    "ssh": "ssh",
+    "rpcinfo": "rpc",
+    "rusers": "rpc",
+    "whatweb": "http",
+    "curl": "http",
+    "wget": "http",
+    "nikto": "http",
+    "gobuster": "http",
+    "dirb": "http",
+    "ffuf": "http",
+    "wpscan": "http",
+    "sslscan": "http",
+    "dig": "dns",
+    "host": "dns",
+    "nslookup": "dns",
+    "dnsx": "dns",
+    "subfinder": "dns",
+    "masscan": "portscan",
+}
+# Préfixe des scripts NSE → protocole (nmap --script smb-os-discovery → smb)
+NSE_PROTOCOLS = {"ms-sql": "mssql", "smb2": "smb", "https": "http", "ssl": "http", "snmp": "snmp"}
+
+# Signes de saturation de la cible dans la sortie d'une commande (phrases complètes : "timeout" seul
+# apparaît dans des en-têtes ordinaires comme Keep-Alive: timeout=5)
+THROTTLE_RE = re.compile(
+    r"connection reset|reset by peer|\btimed out\b|retransmission cap hit|host seems down|"
+    r"too many (?:connections|requests)|rate limit|503 service unavailable|no route to host",
+    re.IGNORECASE
+)
+THROTTLE_SCAN_BYTES = 8192
+
+# Extensions de fichiers à ne pas confondre avec un nom de domaine (-oX scan.xml, -w liste.txt)
+FILE_EXTENSIONS = {"txt", "xml", "json", "lst", "csv", "nse", "log", "html", "gnmap", "nmap", "conf", "py", "sh"}
+DOMAIN_RE = re.compile(r"(?=.{1,253}$)(?:[a-z0-9](?:[a-z0-9\-]{0,61}[a-z0-9])?\.)+[a-z]{2,63}", re.IGNORECASE)
+
+
+def command_protocol(command: str) -> str:
+    """Protocole sollicité par une commande, d'après son outil (et ses scripts NSE pour nmap)."""
+    tools = command_tools(command) or [command_tool(command)]
+    tool = tools[0] if tools else ""
+    if tool == "nmap":
+        match = re.search(r"--script[=\s]+['\"]?([\w\-]+)", command)
+        if not match:
+            return "portscan"
+        prefix = match.group(1).split("-")[0].lower()
+        for key, protocol in NSE_PROTOCOLS.items():
+            if match.group(1).lower().startswith(key):
+                return protocol
+        return prefix
+    return TOOL_PROTOCOLS.get(tool, tool or "other")
+
+
+def command_host(command: str) -> Optional[str]:
+    """Premier hôte (IP, domaine ou URL) cité dans la commande, pour les appels sans cible explicite."""
+    try:
+        tokens = shlex.split(command)
+    except ValueError:
+        tokens = command.split()
+    for token in tokens[1:]:
+        if token.startswith("-"):
+            continue
+        if "://" in token:
+            host = urlparse(token).hostname
+            if host:
+                return host.lower()
+            continue
+        if "/" in token:
+            continue
+        candidate = token.rsplit(":", 1)[0] if token.count(":") == 1 else token
+        try:
+            return str(ipaddress.ip_address(candidate))
+        except ValueError:
+            pass
+        if DOMAIN_RE.fullmatch(candidate) and candidate.rsplit(".", 1)[-1].lower() not in FILE_EXTENSIONS:
+            return candidate.lower()
+    return None
+
+
+def is_throttle_sign(execution: CommandResult) -> bool:
+    if execution.timed_out:
+        return True
+    if execution.exit_code is None:
+        return False
+    text = execution.stderr_excerpt(THROTTLE_SCAN_BYTES) + execution.stdout_excerpt(THROTTLE_SCAN_BYTES)
+    return bool(THROTTLE_RE.search(text))
+
+
+class HostBudget:
+    """État d'un hôte : jetons disponibles, commandes en cours (total et par protocole), facteur adaptatif."""
+
+    def __init__(self, host: str):
+        self.host = host
+        self.tokens = float(TARGET_BURST)
+        self.refilled_at = time.monotonic()
+        self.active = 0
+        self.protocols: Dict[str, int] = {}
+        self.factor = 1.0
+        self.commands = 0
+        self.throttled = 0
+        self.waited = 0.0
+
+    @property
+    def rate(self) -> float:
+        return TARGET_RATE * self.factor
+
+    @property
+    def concurrency(self) -> int:
+        return max(1, int(TARGET_CONCURRENCY * self.factor))
+
+    def protocol_concurrency(self, protocol: str) -> int:
+        return max(1, int(PROTOCOL_CONCURRENCY.get(protocol, DEFAULT_PROTOCOL_CONCURRENCY) * self.factor))
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(float(TARGET_BURST), self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+
+    def delay(self, protocol: str) -> Optional[float]:
+        """0 si la commande peut partir, sinon l'attente avant le prochain jeton (None : limite de concurrence)."""
+        if self.active >= self.concurrency or self.protocols.get(protocol, 0) >= self.protocol_concurrency(protocol):
+            return None
+        self.refill()
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def to_dict(self) -> Dict:
+        return {
+            "host": self.host,
+            "active": self.active,
+            "protocols": {p: n for p, n in self.protocols.items() if n},
+            "factor": round(self.factor, 2),
+            "rate": round(self.rate, 2),
+            "concurrency": self.concurrency,
+            "commands": self.commands,
+            "throttled": self.throttled,
+            "waited": round(self.waited, 1),
+        }
+
+
+class TargetLimiter:
+    """
+    Politesse envers les cibles : chaque commande de scan prend un jeton du seau de son hôte et une
+    place parmi les commandes simultanées de l'hôte et de son protocole. Quand une commande montre des
+    signes de saturation (délai dépassé, connexions réinitialisées), débit et concurrence de l'hôte
+    sont divisés par deux (jusqu'à TARGET_MIN_FACTOR), puis remontent progressivement.
+    Seules les commandes de scan (run_scan_command) passent par le limiteur : la sonde des outils,
+    les installations de paquets et la lecture du man (validate_command) s'exécutent dans le conteneur
+    de scan sans contacter la cible, elles n'ont pas d'hôte à ménager.
+    """
+
+    def __init__(self):
+        self._lock = threading.Condition()
+        self._hosts: Dict[str, HostBudget] = {}
+
+    def _budget(self, host: str) -> HostBudget:
+        budget = self._hosts.get(host)
+        if budget is None:
+            budget = self._hosts[host] = HostBudget(host)
+        return budget
+
+    def acquire(self, host: str, protocol: str) -> float:
+        """Attend que la commande puisse partir vers l'hôte ; renvoie le temps d'attente."""
+        started = time.monotonic()
+        with self._lock:
+            budget = self._budget(host)
+            while True:
+                delay = budget.delay(protocol)
+                if delay == 0:
+                    break
+                self._lock.wait(TARGET_WAIT_POLL if delay is None else min(delay, TARGET_WAIT_POLL))
+                check_cancelled()
+            budget.tokens -= 1
+            budget.active += 1
+            budget.protocols[protocol] = budget.protocols.get(protocol, 0) + 1
+            waited = time.monotonic() - started
+            budget.waited += waited
+        return waited
+
+    def release(self, host: str, protocol: str, execution: Optional[CommandResult]) -> None:
+        throttled = execution is not None and is_throttle_sign(execution)
+        with self._lock:
+            budget = self._budget(host)
+            budget.active = max(budget.active - 1, 0)
+            budget.protocols[protocol] = max(budget.protocols.get(protocol, 0) - 1, 0)
+            budget.commands += 1
+            if throttled:
+                budget.throttled += 1
+                budget.factor = max(budget.factor / 2, TARGET_MIN_FACTOR)
+            elif execution is not None:
+                budget.factor = min(budget.factor + TARGET_RECOVERY_STEP, 1.0)
+            factor = budget.factor
+            self._lock.notify_all()
+        if throttled:
+            print(f"[AVERTISSEMENT] Saturation de {host} détectée ({protocol}) : débit et concurrence "
+                  f"réduits à {factor:.0%}")
+
+    @contextmanager
+    def slot(self, host: Optional[str], command: str) -> Iterator[Dict]:
+        """
+        Encadre l'exécution d'une commande vers l'hôte. L'appelant dépose le résultat dans
+        outcome["execution"] pour l'ajustement adaptatif. Sans hôte identifiable (ou TARGET_LIMITER=0),
+        aucune limite.
+        """
+        outcome: Dict = {"execution": None}
+        if not host or not TARGET_LIMITER_ENABLED:
+            yield outcome
+            return
+        host = host.lower()
+        protocol = command_protocol(command)
+        waited = self.acquire(host, protocol)
+        if waited >= 1:
+            print(f"[DEBUG] Commande retardée de {waited:.1f}s (politesse envers {host}, {protocol}) : {command}")
+        try:
+            yield outcome
+        finally:
+            self.release(host, protocol, outcome["execution"])
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return {host: budget.to_dict() for host, budget in self._hosts.items()}
+
+
+_limiter = TargetLimiter()
+
+
+def get_target_limiter() -> TargetLimiter:
+    return _limiter
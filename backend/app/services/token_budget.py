@@ -0,0 +1,133 @@
+import atexit
+import json
+import math
+import os
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+# Historique des tokens générés par type de prompt (persisté entre les scans)
+TOKEN_BUDGET_FILE = os.environ.get("TOKEN_BUDGET_FILE", "token_budgets.json")
+# Nombre d'observations conservées par type
+TOKEN_BUDGET_WINDOW = 200
+# Nombre minimal d'observations avant d'utiliser le budget appris
+TOKEN_BUDGET_MIN_SAMPLES = 20
+# Marge ajoutée au p99 observé (proportionnelle puis absolue)
+TOKEN_BUDGET_HEADROOM = 0.25
+TOKEN_BUDGET_MARGIN = 32
+# Bornes du budget appris
+TOKEN_BUDGET_FLOOR = 64
+TOKEN_BUDGET_MAX = 2048
+# Intervalle (secondes) entre deux sauvegardes du fichier, faites par un thread de fond
+TOKEN_BUDGET_SAVE_INTERVAL = float(os.environ.get("TOKEN_BUDGET_SAVE_INTERVAL", "30"))
+
+
+def percentile(values: List[int], pct: float) -> int:
+    """Percentile par rang le plus proche (pct entre 0 et 100)."""
+    ordered = sorted(values)
+    rank = max(math.ceil(pct / 100 * len(ordered)) - 1, 0)
+    return ordered[rank]
+
+
+class TokenBudgets:
+    """
+    Apprend le nombre de tokens réellement produits par type de prompt
+    ("command", "analysis", "report"...) et en déduit max_tokens = p99 + marge.
+    Tant qu'il n'y a pas assez d'observations, la valeur par défaut de l'appelant est utilisée.
+    record() est appelé depuis la boucle LLM : il ne touche pas au disque, le fichier est réécrit
+    au plus toutes les save_interval secondes par un thread de fond (et à l'arrêt, via save()).
+    """
+
+    def __init__(self, path: str = TOKEN_BUDGET_FILE, window: int = TOKEN_BUDGET_WINDOW,
+                 save_interval: float = TOKEN_BUDGET_SAVE_INTERVAL):
+        self.path = path
+        self.window = window
+        self.save_interval = save_interval
+        self._lock = threading.Lock()
+        self._samples: Dict[str, deque] = {}
+        self._dirty = False
+        self._saver: Optional[threading.Thread] = None
+        self._load()
+
+    def _load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            for prompt_type, values in data.items():
+                self._samples[prompt_type] = deque(values, maxlen=self.window)
+        except (json.JSONDecodeError, OSError) as e:
+            print(f"[AVERTISSEMENT] Budgets de tokens illisibles ({e}), réinitialisation.")
+
+    def save(self) -> None:
+        """Écrit les observations sur disque si elles ont changé depuis la dernière sauvegarde."""
+        with self._lock:
+            if not self._dirty:
+                return
+            snapshot = {k: list(v) for k, v in self._samples.items()}
+            self._dirty = False
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(snapshot, f, indent=2)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"[AVERTISSEMENT] Sauvegarde des budgets de tokens impossible : {e}")
+            with self._lock:
+                self._dirty = True
+
+    def _save_periodically(self) -> None:
+        while True:
+            time.sleep(self.save_interval)
+            self.save()
+
+    def record(self, prompt_type: str, completion_tokens: int) -> None:
+        """Enregistre le nombre de tokens produits par une réponse (en mémoire, sauvegardé plus tard)."""
+        if completion_tokens <= 0:
+            return
+        with self._lock:
+            self._samples.setdefault(prompt_type, deque(maxlen=self.window)).append(completion_tokens)
+            self._dirty = True
+            if self._saver is None:
+                self._saver = threading.Thread(target=self._save_periodically, name="token-budget-saver",
+                                               daemon=True)
+                self._saver.start()
+
+    def budget(self, prompt_type: str, default: int, cap: int = TOKEN_BUDGET_MAX) -> int:
+        """max_tokens à utiliser pour ce type : p99 observé + marge, sinon la valeur par défaut."""
+        with self._lock:
+            values = list(self._samples.get(prompt_type, ()))
+        if len(values) < TOKEN_BUDGET_MIN_SAMPLES:
+            return int(min(default, cap))
+        learned = percentile(values, 99) * (1 + TOKEN_BUDGET_HEADROOM) + TOKEN_BUDGET_MARGIN
+        return int(min(max(learned, TOKEN_BUDGET_FLOOR), cap))
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            snapshot = {k: list(v) for k, v in self._samples.items()}
+        return {
+            prompt_type: {
+                "samples": len(values),
+                "p50": percentile(values, 50),
+                "p99": percentile(values, 99),
+                "max": max(values)
+            }
+            for prompt_type, values in snapshot.items() if values
+        }
+
+
+_budgets = None
+_budgets_lock = threading.Lock()
+
+
+def get_token_budgets() -> TokenBudgets:
+    """Retourne le registre partagé des budgets de tokens."""
+    global _budgets
+    if _budgets is None:
+        with _budgets_lock:
+            if _budgets is None:
+                _budgets = TokenBudgets()
+                atexit.register(_budgets.save)
+    return _budgets
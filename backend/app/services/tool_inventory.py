@@ -0,0 +1,137 @@
+import os
+import re
+import shlex
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+
+from app.services.command_executor import command_tool, run_command
+from app.services.package_installer import install_packages
+
+# Durée de validité (secondes) de l'inventaire des outils d'un conteneur
+TOOL_INVENTORY_TTL = float(os.environ.get("TOOL_INVENTORY_TTL", "600"))
+
+# Paquet apt fournissant chaque binaire, quand son nom diffère de celui de l'outil
+TOOL_PACKAGES = {
+    "nc": "netcat-traditional",
+    "ssh": "openssh-client",
+    "dig": "dnsutils",
+    "nslookup": "dnsutils",
+    "host": "dnsutils",
+    "rpcclient": "smbclient",
+    "snmpwalk": "snmp",
+    "snmp-check": "snmpcheck",
+    "rpcinfo": "rpcbind",
+    "rusers": "rusers",
+}
+
+# Commandes internes du shell, jamais à installer
+SHELL_BUILTINS = {"echo", "printf", "cd", "test", "true", "false", "export", "read", "timeout", "sudo"}
+
+
+def command_tools(command: str) -> List[str]:
+    """Outils lancés par une commande, y compris après un tube ou un enchaînement (`echo | nc ...`)."""
+    tools = []
+    for segment in re.split(r"\|\|?|&&|;", command):
+        tool = command_tool(segment.strip())
+        if tool and tool not in SHELL_BUILTINS and re.fullmatch(r"[\w.+\-]+", tool) and tool not in tools:
+            tools.append(tool)
+    return tools
+
+
+def tool_package(tool: str) -> str:
+    return TOOL_PACKAGES.get(tool, tool)
+
+
+class ToolInventory:
+    """
+    Outils disponibles dans un conteneur, sondés en une seule commande (`command -v`) puis gardés
+    en cache TOOL_INVENTORY_TTL secondes. Un outil inconnu du dernier sondage déclenche un nouveau
+    sondage limité à cet outil.
+    """
+
+    def __init__(self, container_name: str, ttl: float = TOOL_INVENTORY_TTL):
+        self.container_name = container_name
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._tools: Dict[str, bool] = {}
+        self._probed_at: Dict[str, float] = {}
+
+    def _fresh(self, tool: str) -> bool:
+        return tool in self._tools and time.monotonic() - self._probed_at[tool] < self.ttl
+
+    def probe(self, tools: Iterable[str]) -> Dict[str, bool]:
+        """Sonde la présence des outils en une seule commande et met à jour le cache."""
+        tools = sorted(set(tools))
+        if not tools:
+            return {}
+        quoted = " ".join(shlex.quote(tool) for tool in tools)
+        probe_command = f'for t in {quoted}; do command -v "$t" >/dev/null 2>&1 && echo "$t"; done'
+        found = set(run_command(probe_command, timeout=30).stdout.split())
+        now = time.monotonic()
+        status = {tool: tool in found for tool in tools}
+        with self._lock:
+            self._tools.update(status)
+            self._probed_at.update({tool: now for tool in tools})
+        print(f"[DEBUG] Inventaire des outils ({self.container_name}) : "
+              f"{len(found)}/{len(tools)} présents, absents : {', '.join(t for t in tools if t not in found) or 'aucun'}")
+        return status
+
+    def availability(self, tools: Iterable[str]) -> Dict[str, bool]:
+        """Disponibilité des outils, depuis le cache quand il est encore valide."""
+        tools = list(dict.fromkeys(tools))
+        with self._lock:
+            stale = [tool for tool in tools if not self._fresh(tool)]
+        if stale:
+            self.probe(stale)
+        with self._lock:
+            return {tool: self._tools.get(tool, False) for tool in tools}
+
+    def is_available(self, tool: str) -> bool:
+        return self.availability([tool])[tool]
+
+    def missing(self, tools: Iterable[str]) -> List[str]:
+        return [tool for tool, present in self.availability(tools).items() if not present]
+
+    def invalidate(self, tools: Optional[Iterable[str]] = None) -> None:
+        """Oublie l'état des outils (tous par défaut), par exemple après une installation."""
+        with self._lock:
+            for tool in (list(self._tools) if tools is None else tools):
+                self._tools.pop(tool, None)
+                self._probed_at.pop(tool, None)
+
+    def plan_installs(self, tools: Iterable[str]) -> Dict[str, List[str]]:
+        """Paquets à installer pour les outils absents : {paquet: [outils]}."""
+        plan: Dict[str, List[str]] = {}
+        for tool in self.missing(tools):
+            plan.setdefault(tool_package(tool), []).append(tool)
+        return plan
+
+    def ensure(self, tools: Iterable[str]) -> List[str]:
+        """
+        Installe les outils absents via la file d'installation groupée, puis les sonde à nouveau.
+        Renvoie les outils toujours absents après installation.
+        """
+        tools = list(dict.fromkeys(tools))
+        plan = self.plan_installs(tools)
+        if not plan:
+            return []
+        print(f"[INFO] Installation préalable des outils manquants : {', '.join(sorted(plan))}")
+        install_packages(plan)
+        wanted = [tool for tools_of_package in plan.values() for tool in tools_of_package]
+        status = self.probe(wanted)
+        still_missing = [tool for tool, present in status.items() if not present]
+        if still_missing:
+            print(f"[AVERTISSEMENT] Outils toujours absents après installation : {', '.join(still_missing)}")
+        return still_missing
+
+
+_inventories: Dict[str, ToolInventory] = {}
+_inventories_lock = threading.Lock()
+
+
+def get_tool_inventory(container_name: str = "kali-pentest") -> ToolInventory:
+    with _inventories_lock:
+        if container_name not in _inventories:
+            _inventories[container_name] = ToolInventory(container_name)
+        return _inventories[container_name]
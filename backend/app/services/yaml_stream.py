@@ -0,0 +1,139 @@
+import json
+import re
+from typing import Callable, Dict, List, Optional
+
+import yaml
+
+FENCE_RE = re.compile(r"^\s*```")
+# Ligne YAML "clé: valeur" (pas d'espace avant les deux-points, contrairement au texte en français)
+KEY_LINE_RE = re.compile(r"^\s*-?\s*[A-Za-z_][\w\-]*:(\s|$)")
+
+
+def _safe_yaml(text: str) -> Optional[Dict]:
+    try:
+        data = yaml.safe_load(text)
+    except yaml.YAMLError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+class YamlBlockDetector:
+    """
+    Analyse incrémentale du flux de tokens : détecte le moment où la réponse contient
+    un bloc YAML complet avec les clés requises, pour pouvoir couper le flux sans attendre
+    le commentaire que le modèle ajoute souvent jusqu'à max_tokens.
+
+    Un bloc est complet :
+    - entre ```yaml et la clôture ``` si toutes les clés requises y figurent ;
+    - sans clôture, quand toutes les clés ont été vues et qu'arrive une ligne de texte libre
+      (ni clé, ni élément de liste, ni indentée) ; les lignes vides ne suffisent pas,
+      elles peuvent séparer des éléments d'une liste.
+
+    Une réponse JSON (décodage contraint par output_schema) est complète dès que l'objet de premier
+    niveau est refermé et contient les clés requises, sans attendre de fin de ligne.
+    """
+
+    def __init__(self, required_keys: List[str], parser: Optional[Callable[[str], Optional[Dict]]] = None):
+        self.required_keys = required_keys
+        self.parser = parser or _safe_yaml
+        self._key_patterns = [re.compile(rf"^\s*-?\s*{re.escape(k)}:", re.MULTILINE) for k in required_keys]
+        self._pending = ""
+        self._lines: List[str] = []
+        self._in_fence = False
+        # Réponse JSON : décidé au premier caractère non blanc du flux
+        self._json: Optional[bool] = None
+        self._object: List[str] = []
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self.block: Optional[str] = None
+        self.parsed: Optional[Dict] = None
+
+    def _has_keys(self, lines: List[str]) -> bool:
+        text = "\n".join(lines)
+        return all(p.search(text) for p in self._key_patterns)
+
+    def _complete(self, lines: List[str]) -> bool:
+        self.block = "\n".join(lines).strip()
+        try:
+            self.parsed = self.parser(self.block)
+        except Exception:
+            self.parsed = None
+        return True
+
+    def _complete_json(self, text: str) -> bool:
+        try:
+            data = json.loads(text)
+        except ValueError:
+            return False
+        if not isinstance(data, dict) or not all(k in data for k in self.required_keys):
+            return False
+        self.block = text
+        self.parsed = data
+        return True
+
+    def _feed_json(self, delta: str) -> bool:
+        for char in delta:
+            if self._depth == 0:
+                if char != "{":
+                    continue
+                self._object = []
+            self._object.append(char)
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == "{":
+                self._depth += 1
+            elif char == "}":
+                self._depth -= 1
+                # Objet refermé sans les clés requises : on attend l'objet suivant
+                if self._depth == 0 and self._complete_json("".join(self._object)):
+                    return True
+        return False
+
+    def feed(self, delta: str) -> bool:
+        """Ajoute un fragment du flux ; renvoie True dès que le bloc est complet."""
+        if self.block is not None:
+            return True
+        if self._json is None:
+            head = (self._pending + delta).lstrip()
+            if head:
+                self._json = head.startswith("{")
+        if self._json:
+            return self._feed_json(delta)
+        self._pending += delta
+        while "\n" in self._pending:
+            line, self._pending = self._pending.split("\n", 1)
+            if self._on_line(line):
+                return True
+        return False
+
+    def _on_line(self, line: str) -> bool:
+        if FENCE_RE.match(line):
+            if self._in_fence:
+                self._in_fence = False
+                if self._has_keys(self._lines):
+                    return self._complete(self._lines)
+                if self._complete_json("\n".join(self._lines).strip()):
+                    return True
+                # Bloc d'exemple ou incomplet : on continue à chercher
+            else:
+                self._in_fence = True
+            self._lines = []
+            return False
+
+        stripped = line.strip()
+        if not self._in_fence and stripped and self._lines and self._has_keys(self._lines):
+            is_yaml_line = stripped.startswith("-") or KEY_LINE_RE.match(line) or line[:1].isspace()
+            if not is_yaml_line:
+                return self._complete(self._lines)
+
+        if stripped or self._in_fence:
+            self._lines.append(line)
+        return False
@@ -0,0 +1,304 @@
+"""
+Serveur LLM factice compatible OpenAI / llama.cpp, pour mesurer le pipeline mistest_*.main sans GPU.
+
+Les réponses sont déterministes : réponses enregistrées (--replay) si un motif correspond au prompt,
+sinon réponses construites par règles selon le type de prompt émis par les moteurs
+(génération de commande, analyse de résultat, recommandations).
+La latence avant le premier token et le débit de tokens sont configurables.
+Comme llama.cpp avec cache_prompt, chaque slot garde le dernier prompt traité : seul le suffixe
+qui diffère est "évalué" (prompt_n) et le préfixe commun est rapporté dans timings.cache_n.
+
+Exemple :
+    python mock_llm_server.py --port 8081 --latency-ms 300 --tokens-per-sec 40 --slots 2
+    LLM_ENDPOINTS=http://127.0.0.1:8081 python run.py
+
+Format de --replay (JSONL) : {"match": "<expression régulière>", "response": "<texte>"}
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+CHAT_PATH = "/v1/chat/completions"
+# Découpage en "tokens" : un mot ou une ponctuation, avec l'espace qui le précède
+TOKEN_RE = re.compile(r"\s*(?:\w+|[^\w\s])|\s+", re.UNICODE)
+NMAP_PORT_RE = re.compile(r"^(\d+)/(tcp|udp)\s+open\s+(\S+)\s*(.*)$", re.MULTILINE)
+IP_RE = re.compile(r"\b(?:\d{1,3}\.){3}\d{1,3}\b")
+
+# Commandes proposées par technologie, dans l'ordre (la suivante si la précédente est déjà dans l'historique)
+COMMAND_RULES = {
+    "http": [
+        ("whatweb", "whatweb -a 3 http://{target}:{port}", "sudo apt-get install -y whatweb"),
+        ("nmap", "nmap -sV -p {port} --script http-headers,http-server-header {target}", "sudo apt-get install -y nmap"),
+        ("nikto", "nikto -h http://{target}:{port} -Tuning b", "sudo apt-get install -y nikto"),
+    ],
+    "ssh": [
+        ("nmap", "nmap -sV -p {port} --script ssh2-enum-algos {target}", "sudo apt-get install -y nmap"),
+        ("ssh-audit", "ssh-audit -p {port} {target}", "sudo apt-get install -y ssh-audit"),
+    ],
+    "ftp": [
+        ("nmap", "nmap -sV -p {port} --script ftp-syst,ftp-anon {target}", "sudo apt-get install -y nmap"),
+    ],
+    "default": [
+        ("nmap", "nmap -sV --version-intensity 9 -p {port} {target}", "sudo apt-get install -y nmap"),
+        ("nmap", "nmap -sV -sC -p {port} {target}", "sudo apt-get install -y nmap"),
+    ],
+}
+
+
+def detect_prompt_type(prompt: str, payload: Dict) -> str:
+    """Même classement que les moteurs (detect_prompt_type), à partir du contenu du prompt."""
+    lowered = prompt.lower()
+    if payload.get("json_schema") or "enumerate_command" in lowered:
+        return "command"
+    if "analyse de résultats" in lowered or "analyse des resultats" in lowered:
+        return "analysis"
+    if "cve-xxxx-yyyy" in lowered:
+        return "cve_reco"
+    if "risques potentiels" in lowered:
+        return "fallback_reco"
+    if "rapport" in lowered:
+        return "report"
+    return "generic"
+
+
+def _field(prompt: str, label: str) -> Optional[str]:
+    match = re.search(rf"{label}\s*:\s*(\S+)", prompt)
+    return match.group(1) if match else None
+
+
+def build_command_answer(prompt: str, payload: Dict) -> str:
+    target = _field(prompt, "Adresse cible") or next(iter(IP_RE.findall(prompt)), "127.0.0.1")
+    port = _field(prompt, "Port") or "80"
+    tech = (_field(prompt, "Technologie") or "").lower()
+    rules = next((v for k, v in COMMAND_RULES.items() if k != "default" and k in tech), COMMAND_RULES["default"])
+    history = prompt.split("COMMANDES DÉJÀ TESTÉES", 1)[-1]
+    for tool, command, install in rules:
+        command = command.format(target=target, port=port)
+        if command not in history:
+            break
+    if payload.get("json_schema"):
+        return json.dumps({"tool_name": tool, "enumerate_command": command, "install_command": install})
+    return f"```yaml\ntool_name: {tool}\nenumerate_command: {command}\ninstall_command: {install}\n```"
+
+
+def build_analysis_answer(prompt: str) -> str:
+    section = prompt.split("RÉSULTATS À ANALYSER", 1)[-1]
+    match = re.search(r"Commande exécutée\s*:\s*(.+)", section)
+    command = match.group(1).strip() if match and match.group(1).strip() else "inconnue"
+    tool = command.split()[0]
+    status = "ERROR" if re.search(r"error|failed|not found", section, re.IGNORECASE) else "SUCCESS"
+    lines = [f"tool_name: {tool}", f"command_executed: {command}", f"status: {status}", "services_discovered:"]
+    for port, proto, name, version in NMAP_PORT_RE.findall(section):
+        lines += [f"- nom: {name}", f"  version: {version.strip() or 'N/A'}", f"  port: {port}",
+                  f"  protocole: {proto.upper()}", "  cpe: N/A"]
+    return "```yaml\n" + "\n".join(lines) + "\n```"
+
+
+def build_rule_answer(prompt: str, payload: Dict, prompt_type: str) -> str:
+    if prompt_type == "command":
+        return build_command_answer(prompt, payload)
+    if prompt_type == "analysis":
+        return build_analysis_answer(prompt)
+    if prompt_type == "cve_reco":
+        sections = [f"{cve} :\n- Description : Vulnérabilité référencée.\n- Recommandation : Appliquer le correctif de l'éditeur."
+                    for cve in dict.fromkeys(re.findall(r"CVE-\d{4}-\d{4,}", prompt))]
+        return "\n\n".join(sections) or "Aucune CVE à traiter."
+    if prompt_type == "fallback_reco":
+        return ("1 - Risques potentiels :\n- Service exposé sans filtrage\n"
+                "2 - Mesures de sécurité préventives :\n- Restreindre l'accès au service par pare-feu")
+    return "Réponse factice du serveur de test."
+
+
+class MockLLM:
+    """Choix de la réponse (enregistrée ou par règles) et compteurs de requêtes."""
+
+    def __init__(self, replay: List[Tuple[re.Pattern, str]], latency_ms: float, tokens_per_sec: float,
+                 prefill_tokens_per_sec: float, slots: int):
+        self.replay = replay
+        self.latency_ms = latency_ms
+        self.tokens_per_sec = tokens_per_sec
+        self.prefill_tokens_per_sec = prefill_tokens_per_sec
+        self.slots = threading.BoundedSemaphore(max(slots, 1))
+        self._lock = threading.Lock()
+        # Dernier prompt traité par slot (cache KV simulé)
+        self.slot_prompts = [""] * max(slots, 1)
+        self.stats = {"requests": 0, "tokens": 0, "prompt_tokens": 0, "cached_tokens": 0, "by_prompt_type": {}}
+
+    def answer(self, payload: Dict) -> Tuple[str, str]:
+        prompt = "\n".join(str(m.get("content", "")) for m in payload.get("messages", []) if m.get("role") == "user")
+        prompt_type = detect_prompt_type(prompt, payload)
+        for pattern, response in self.replay:
+            if pattern.search(prompt):
+                return prompt_type, response
+        return prompt_type, build_rule_answer(prompt, payload, prompt_type)
+
+    def prefill(self, payload: Dict) -> Tuple[int, int]:
+        """
+        (prompt_n, cache_n) : tokens du prompt à évaluer et tokens repris du cache KV du slot.
+        Le slot est id_slot s'il est fourni, sinon celui dont le dernier prompt partage le plus long
+        préfixe (comme llama.cpp) ; comme llama.cpp, au moins le dernier token est ré-évalué.
+        """
+        text = "\n".join(str(m.get("content", "")) for m in payload.get("messages", []))
+        total = len(text) // 4
+        if not payload.get("cache_prompt"):
+            return total, 0
+        with self._lock:
+            slot = payload.get("id_slot")
+            if not isinstance(slot, int) or not 0 <= slot < len(self.slot_prompts):
+                slot = max(range(len(self.slot_prompts)),
+                           key=lambda i: len(os.path.commonprefix([self.slot_prompts[i], text])))
+            common = os.path.commonprefix([self.slot_prompts[slot], text])
+            self.slot_prompts[slot] = text
+        cache_n = min(len(common) // 4, max(total - 1, 0))
+        return total - cache_n, cache_n
+
+    def record(self, prompt_type: str, tokens: int, prompt_n: int = 0, cache_n: int = 0) -> None:
+        with self._lock:
+            self.stats["requests"] += 1
+            self.stats["tokens"] += tokens
+            self.stats["prompt_tokens"] += prompt_n
+            self.stats["cached_tokens"] += cache_n
+            by_type = self.stats["by_prompt_type"]
+            by_type[prompt_type] = by_type.get(prompt_type, 0) + 1
+
+
+def load_replay(path: Optional[str]) -> List[Tuple[re.Pattern, str]]:
+    if not path:
+        return []
+    entries = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                entries.append((re.compile(entry["match"]), entry["response"]))
+    print(f"[INFO] {len(entries)} réponses enregistrées chargées depuis {path}")
+    return entries
+
+
+def make_handler(mock: MockLLM):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            return
+
+        def _send_json(self, status: int, body: Dict) -> None:
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self._send_json(200, {"status": "ok"})
+            elif self.path == "/stats":
+                self._send_json(200, mock.stats)
+            elif self.path == "/v1/models":
+                self._send_json(200, {"object": "list", "data": [{"id": "mock", "object": "model"}]})
+            else:
+                self._send_json(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path != CHAT_PATH:
+                self._send_json(404, {"error": "not found"})
+                return
+            payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            prompt_type, text = mock.answer(payload)
+            tokens = TOKEN_RE.findall(text)
+            max_tokens = int(payload.get("max_tokens") or len(tokens))
+            finish_reason = "length" if len(tokens) > max_tokens else "stop"
+            tokens = tokens[:max_tokens]
+            prompt_n, cache_n = mock.prefill(payload)
+            seed = int(hashlib.md5(text.encode()).hexdigest(), 16) % 1000
+
+            with mock.slots:
+                prefill_s = mock.latency_ms / 1000
+                if mock.prefill_tokens_per_sec > 0:
+                    prefill_s += prompt_n / mock.prefill_tokens_per_sec
+                time.sleep(prefill_s)
+                timings = {"prompt_n": prompt_n, "prompt_ms": round(prefill_s * 1000, 1), "cache_n": cache_n}
+                if payload.get("stream"):
+                    self._stream(tokens, finish_reason, timings, seed)
+                else:
+                    self._sleep_tokens(len(tokens))
+                    self._send_json(200, {
+                        "id": f"mock-{seed}", "object": "chat.completion", "model": "mock",
+                        "choices": [{"index": 0, "finish_reason": finish_reason,
+                                     "message": {"role": "assistant", "content": "".join(tokens)}}],
+                        "usage": {"prompt_tokens": prompt_n + cache_n, "completion_tokens": len(tokens)},
+                        "timings": timings
+                    })
+            mock.record(prompt_type, len(tokens), prompt_n, cache_n)
+
+        def _sleep_tokens(self, count: int) -> None:
+            if mock.tokens_per_sec > 0:
+                time.sleep(count / mock.tokens_per_sec)
+
+        def _write_chunk(self, data: bytes) -> None:
+            """Un morceau de Transfer-Encoding: chunked (un morceau vide termine la réponse)."""
+            self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        def _stream(self, tokens: List[str], finish_reason: str, timings: Dict, seed: int) -> None:
+            # Réponse en morceaux sur une connexion conservée, comme llama.cpp : le client réutilise
+            # la connexion pour la requête suivante au lieu d'en ouvrir une par flux
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            started = time.perf_counter()
+            try:
+                for token in tokens:
+                    self._sleep_tokens(1)
+                    chunk = {"id": f"mock-{seed}", "object": "chat.completion.chunk", "model": "mock",
+                             "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]}
+                    self._write_chunk(f"data: {json.dumps(chunk)}\n\n".encode())
+                final = {"id": f"mock-{seed}", "object": "chat.completion.chunk", "model": "mock",
+                         "choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}],
+                         "timings": dict(timings, predicted_n=len(tokens),
+                                         predicted_ms=round((time.perf_counter() - started) * 1000, 1))}
+                self._write_chunk(f"data: {json.dumps(final, separators=(',', ':'))}\n\ndata: [DONE]\n\n".encode())
+                self._write_chunk(b"")
+            except (BrokenPipeError, ConnectionResetError):
+                # Flux coupé par le client (réponse structurée complète) : comme llama.cpp, on arrête
+                self.close_connection = True
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serveur LLM factice compatible OpenAI (llama.cpp)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=200.0, help="délai fixe avant le premier token")
+    parser.add_argument("--tokens-per-sec", type=float, default=50.0, help="débit de génération (0 = instantané)")
+    parser.add_argument("--prefill-tokens-per-sec", type=float, default=0.0,
+                        help="débit de traitement du prompt, ajouté à la latence (0 = ignoré)")
+    parser.add_argument("--slots", type=int, default=2, help="requêtes traitées simultanément (slots llama.cpp)")
+    parser.add_argument("--replay", help="fichier JSONL de réponses enregistrées")
+    args = parser.parse_args()
+
+    mock = MockLLM(load_replay(args.replay), args.latency_ms, args.tokens_per_sec,
+                   args.prefill_tokens_per_sec, args.slots)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(mock))
+    print(f"[INFO] Serveur LLM factice sur http://{args.host}:{args.port}{CHAT_PATH} "
+          f"({args.latency_ms} ms, {args.tokens_per_sec} tokens/s, {args.slots} slots)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+"""
+Agent d'exécution des commandes de scan, à lancer dans chaque conteneur Kali (ou en local pour
+simuler plusieurs conteneurs). L'agent s'inscrit auprès du backend puis renouvelle son inscription
+(battement de cœur) avec sa capacité, sa charge et les outils présents ; le backend lui confie
+les commandes des scans et reçoit leur sortie au fil de l'eau.
+
+Protocole :
+    POST /run     {"command": ..., "timeout": ...}  (en-tête X-Agent-Token)
+                  → NDJSON : {"type": "output", "stream": "stdout"|"stderr", "data": ...}*
+                             puis {"type": "exit", "exit_code", "duration", "timed_out", "cpu_time", "max_rss_kb"}
+    GET /health   → {"status", "name", "capacity", "active", "tools"}
+
+Exemple :
+    AGENT_TOKEN=secret python scan_agent.py --name kali-1 --port 8701 \\
+        --backend http://127.0.0.1:5000 --advertise http://127.0.0.1:8701 --capacity 4
+"""
+import argparse
+import codecs
+import hmac
+import json
+import os
+import queue
+import resource
+import select
+import shutil
+import signal
+import socket
+import subprocess
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+# Outils recherchés dans le PATH et annoncés au backend (complétés par --tools)
+DEFAULT_TOOLS = [
+    "nmap", "whatweb", "curl", "nc", "openssl", "ssh", "dig", "nslookup", "host", "whois",
+    "smbclient", "rpcclient", "enum4linux", "snmpwalk", "snmp-check", "rpcinfo", "rusers", "finger",
+    "nikto", "gobuster", "ffuf", "wpscan", "sslscan", "subfinder", "dnsx", "masscan",
+]
+HEARTBEAT_INTERVAL = 15
+KILL_GRACE = 3
+READ_SIZE = 8192
+
+# Limites des commandes, comme côté backend (0 = sans limite)
+COMMAND_CPU_LIMIT = int(os.environ.get("COMMAND_CPU_LIMIT", "900"))
+COMMAND_MEMORY_LIMIT_MB = int(os.environ.get("COMMAND_MEMORY_LIMIT_MB", "0"))
+COMMAND_NOFILE_LIMIT = int(os.environ.get("COMMAND_NOFILE_LIMIT", "4096"))
+
+
+def _apply_limits() -> None:
+    os.setsid()
+    if COMMAND_CPU_LIMIT > 0:
+        resource.setrlimit(resource.RLIMIT_CPU, (COMMAND_CPU_LIMIT, COMMAND_CPU_LIMIT))
+    if COMMAND_MEMORY_LIMIT_MB > 0:
+        limit = COMMAND_MEMORY_LIMIT_MB * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    if COMMAND_NOFILE_LIMIT > 0:
+        hard = resource.getrlimit(resource.RLIMIT_NOFILE)[1]
+        soft = COMMAND_NOFILE_LIMIT if hard == resource.RLIM_INFINITY else min(COMMAND_NOFILE_LIMIT, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+
+class ScanAgent:
+    def __init__(self, name: str, capacity: int, tools: List[str], token: str):
+        self.name = name
+        self.capacity = max(capacity, 1)
+        self.tool_names = tools
+        self.token = token
+        self._slots = threading.BoundedSemaphore(self.capacity)
+        self._lock = threading.Lock()
+        self.active = 0
+        self.commands = 0
+
+    def tools(self) -> List[str]:
+        return [tool for tool in self.tool_names if shutil.which(tool)]
+
+    def status(self) -> Dict:
+        return {"status": "ok", "name": self.name, "capacity": self.capacity,
+                "active": self.active, "commands": self.commands, "tools": self.tools()}
+
+    def authorized(self, token: Optional[str]) -> bool:
+        return bool(self.token) and hmac.compare_digest(token or "", self.token)
+
+    def try_acquire(self) -> bool:
+        if not self._slots.acquire(blocking=False):
+            return False
+        with self._lock:
+            self.active += 1
+        return True
+
+    def release(self) -> None:
+        with self._lock:
+            self.active -= 1
+            self.commands += 1
+        self._slots.release()
+
+    def run(self, command: str, timeout: float, emit, disconnected=None) -> Dict:
+        """
+        Exécute la commande dans son propre groupe de processus et transmet sa sortie par blocs via emit.
+        disconnected() est consulté à chaque tour (au plus une seconde d'intervalle, même si la commande
+        écrit sans arrêt) : si le backend a fermé la connexion (scan annulé), la commande est arrêtée.
+        """
+        started = time.monotonic()
+        proc = subprocess.Popen(
+            command, shell=True, executable="/bin/bash",
+            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            preexec_fn=_apply_limits
+        )
+        chunks: "queue.Queue" = queue.Queue()
+
+        def pump(stream, name):
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+            while True:
+                data = os.read(stream.fileno(), READ_SIZE)
+                if not data:
+                    break
+                chunks.put((name, decoder.decode(data)))
+            rest = decoder.decode(b"", final=True)
+            if rest:
+                chunks.put((name, rest))
+            chunks.put((name, None))
+
+        for stream, name in ((proc.stdout, "stdout"), (proc.stderr, "stderr")):
+            threading.Thread(target=pump, args=(stream, name), daemon=True).start()
+
+        timed_out = False
+        open_streams = 2
+        deadline = started + timeout
+        try:
+            while open_streams:
+                # Vérifiés à chaque tour : une commande bavarde ne doit pas échapper au délai ni à l'annulation
+                if disconnected is not None and disconnected():
+                    raise ConnectionResetError("connexion fermée par le backend")
+                if time.monotonic() >= deadline:
+                    timed_out = True
+                    self._kill(proc)
+                    break
+                try:
+                    name, data = chunks.get(timeout=min(max(deadline - time.monotonic(), 0.05), 1.0))
+                except queue.Empty:
+                    continue
+                if data is None:
+                    open_streams -= 1
+                else:
+                    emit({"type": "output", "stream": name, "data": data})
+        except (BrokenPipeError, ConnectionResetError):
+            # Connexion fermée par le backend (scan annulé) : la commande est arrêtée avec son groupe
+            self._kill(proc)
+            os.wait4(proc.pid, 0)
+            raise
+
+        # wait4 : code retour et consommation de ce processus et de ses enfants attendus
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        # Sortie restante des tubes après arrêt du groupe
+        while True:
+            try:
+                name, data = chunks.get_nowait()
+            except queue.Empty:
+                break
+            if data is not None:
+                emit({"type": "output", "stream": name, "data": data})
+        return {
+            "type": "exit",
+            "exit_code": proc.returncode,
+            "duration": round(time.monotonic() - started, 3),
+            "timed_out": timed_out,
+            "cpu_time": round(usage.ru_utime + usage.ru_stime, 3),
+            "max_rss_kb": usage.ru_maxrss
+        }
+
+    @staticmethod
+    def _kill(proc: subprocess.Popen) -> None:
+        for sig, wait in ((signal.SIGTERM, KILL_GRACE), (signal.SIGKILL, 0)):
+            try:
+                os.killpg(proc.pid, sig)
+            except (ProcessLookupError, PermissionError):
+                return
+            deadline = time.monotonic() + wait
+            while time.monotonic() < deadline:
+                if os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT):
+                    return
+                time.sleep(0.1)
+
+
+def make_handler(agent: ScanAgent):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            return
+
+        def _send_json(self, status: int, body: Dict) -> None:
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self._send_json(200, agent.status())
+            else:
+                self._send_json(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path != "/run":
+                self._send_json(404, {"error": "not found"})
+                return
+            if not agent.authorized(self.headers.get("X-Agent-Token")):
+                self._send_json(401, {"error": "jeton invalide"})
+                return
+            payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            command = payload.get("command")
+            if not command:
+                self._send_json(400, {"error": "command requis"})
+                return
+            if not agent.try_acquire():
+                self._send_json(503, {"error": "agent saturé"})
+                return
+            try:
+                # Réponse en morceaux : la connexion reste ouverte pour les commandes suivantes du backend
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+
+                def emit(message: Dict) -> None:
+                    data = (json.dumps(message) + "\n").encode()
+                    self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+                    self.wfile.flush()
+
+                def disconnected() -> bool:
+                    # Le corps de la requête est déjà lu : une lecture possible signifie une fermeture
+                    readable, _, _ = select.select([self.connection], [], [], 0)
+                    return bool(readable) and not self.connection.recv(1, socket.MSG_PEEK)
+
+                print(f"[INFO] Exécution : {command}")
+                try:
+                    emit(agent.run(command, float(payload.get("timeout") or 300), emit, disconnected))
+                    self.wfile.write(b"0\r\n\r\n")
+                    self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    print(f"[AVERTISSEMENT] Backend déconnecté pendant : {command}")
+                    self.close_connection = True
+            finally:
+                agent.release()
+
+    return Handler
+
+
+def heartbeat(agent: ScanAgent, backend: str, advertise: str) -> None:
+    """Inscription puis renouvellement périodique auprès du backend."""
+    while True:
+        body = dict(agent.status(), url=advertise)
+        request = urllib.request.Request(
+            f"{backend.rstrip('/')}/api/agents/register",
+            data=json.dumps(body).encode(),
+            headers={"Content-Type": "application/json", "X-Agent-Token": agent.token},
+            method="POST"
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=10) as resp:
+                resp.read()
+        except Exception as e:
+            print(f"[AVERTISSEMENT] Inscription auprès de {backend} impossible : {e}")
+        time.sleep(HEARTBEAT_INTERVAL)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Agent d'exécution des commandes de scan")
+    parser.add_argument("--name", default=os.environ.get("AGENT_NAME", "kali-pentest"))
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8701)
+    parser.add_argument("--backend", default=os.environ.get("AGENT_BACKEND", "http://127.0.0.1:5000"))
+    parser.add_argument("--advertise", help="adresse de l'agent vue du backend (défaut : http://<host>:<port>)")
+    parser.add_argument("--capacity", type=int, default=4, help="commandes exécutées simultanément")
+    parser.add_argument("--tools", default="", help="outils supplémentaires à annoncer, séparés par des virgules")
+    args = parser.parse_args()
+
+    token = os.environ.get("AGENT_TOKEN", "")
+    if not token:
+        parser.error("AGENT_TOKEN doit être défini (même valeur que pour le backend)")
+    tools = DEFAULT_TOOLS + [tool.strip() for tool in args.tools.split(",") if tool.strip()]
+    agent = ScanAgent(args.name, args.capacity, tools, token)
+    advertise = args.advertise or f"http://{args.host}:{args.port}"
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(agent))
+    threading.Thread(target=heartbeat, args=(agent, args.backend, advertise), daemon=True).start()
+    print(f"[INFO] Agent {args.name} sur {advertise} (capacité {agent.capacity}, "
+          f"{len(agent.tools())} outils), backend {args.backend}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
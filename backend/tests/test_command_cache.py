@@ -0,0 +1,47 @@
+from app.services import command_cache
+from app.services.command_cache import CommandResultCache, make_command_key, normalize_command
+from app.services.command_executor import CommandResult
+
+
+def _result(stdout="22/tcp open ssh\n", exit_code=0, timed_out=False):
+    return CommandResult("nmap 10.0.0.1", stdout, "", exit_code, 1.0, 60, timed_out=timed_out)
+
+
+def test_normalized_keys():
+    assert normalize_command("sudo  `nmap   -sV 'host'`") == "nmap -sV host"
+    assert make_command_key("nmap -sV 10.0.0.1", "10.0.0.1") == make_command_key("sudo nmap  -sV 10.0.0.1", " 10.0.0.1 ")
+    assert make_command_key("nmap -sV 10.0.0.1", "10.0.0.1") != make_command_key("nmap -sV 10.0.0.1", "10.0.0.2")
+
+
+def test_only_successful_results_are_cached():
+    cache = CommandResultCache()
+    assert not cache.put("nmap 10.0.0.1", "t", _result(exit_code=1))
+    assert not cache.put("nmap 10.0.0.1", "t", _result(timed_out=True))
+    assert cache.put("nmap 10.0.0.1", "t", _result())
+    hit = cache.get("sudo nmap 10.0.0.1", "t")
+    assert hit.cached and hit.stdout == "22/tcp open ssh\n" and hit.exit_code == 0
+    assert not cache.put("nmap 10.0.0.1", "t", hit)
+
+
+def test_entries_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(command_cache.time, "time", lambda: now[0])
+    cache = CommandResultCache(ttl=300)
+    cache.put("whatweb http://t", "t", _result())
+    now[0] += 299
+    assert cache.get("whatweb http://t", "t").cached_age == 299
+    now[0] += 2
+    assert cache.get("whatweb http://t", "t") is None
+    assert cache.get_stats() == {"entries": 0, "bytes": 0, "hits": 1, "misses": 1}
+
+
+def test_lru_eviction_by_size():
+    cache = CommandResultCache(max_bytes=25, max_entry_bytes=20)
+    assert not cache.put("big", "t", _result("x" * 21))
+    cache.put("a", "t", _result("a" * 10))
+    cache.put("b", "t", _result("b" * 10))
+    cache.get("a", "t")
+    cache.put("c", "t", _result("c" * 10))
+    assert cache.get("b", "t") is None
+    assert cache.get("a", "t") is not None and cache.get("c", "t") is not None
+    assert cache.size == 20
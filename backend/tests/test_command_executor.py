@@ -0,0 +1,49 @@
+import subprocess
+import sys
+
+from app.services import command_executor
+from app.services.command_executor import _read_usage, command_limits, limited_script, run_command
+
+
+def test_limits_leave_virtual_memory_unbounded_by_default():
+    assert not any(limit.startswith("ulimit -v") for limit in command_limits())
+
+
+def test_usage_file_is_written_and_exit_code_kept(tmp_path):
+    script = limited_script("false", str(tmp_path / "usage"))
+    completed = subprocess.run(["bash", "-c", script])
+    assert completed.returncode == 1
+    cpu_time, shell_rss = _read_usage(str(tmp_path / "usage"))
+    assert cpu_time is not None and shell_rss > 0
+
+
+def test_read_usage_sums_shell_and_children_times(tmp_path):
+    path = tmp_path / "usage"
+    path.write_text("0m0.010s 0m0.020s\n1m2.500s 0m0.250s\nrss 2048\n")
+    assert _read_usage(str(path)) == (62.78, 2048)
+    assert not path.exists()
+    assert _read_usage(None) == (None, None)
+
+
+def test_command_keeps_exit_code_and_reports_cpu_time(monkeypatch):
+    monkeypatch.setattr(command_executor, "COMMAND_ACCOUNTING", True)
+    busy = "i=0; while [ $i -lt 20000 ]; do i=$((i+1)); done; exit 4"
+    execution = run_command(f"sh -c '{busy}'", timeout=30)
+    assert execution.exit_code == 4
+    assert execution.cpu_time is not None and execution.cpu_time > 0
+
+
+def test_local_command_records_peak_rss(monkeypatch):
+    monkeypatch.setattr(command_executor, "COMMAND_ACCOUNTING", True)
+    execution = run_command("true", timeout=30)
+    assert execution.max_rss_kb is not None and execution.max_rss_kb > 0
+    assert execution.summary()["max_rss_kb"] == execution.max_rss_kb
+
+
+def test_peak_rss_follows_the_largest_process(monkeypatch):
+    monkeypatch.setattr(command_executor, "COMMAND_ACCOUNTING", True)
+    monkeypatch.setattr(command_executor, "COMMAND_RSS_SAMPLE_INTERVAL", 0.05)
+    hungry = "import time; block = b'x' * (64 * 1024 * 1024); time.sleep(0.5)"
+    execution = run_command(f'{sys.executable} -c "{hungry}"', timeout=30)
+    assert execution.exit_code == 0
+    assert execution.max_rss_kb >= 64 * 1024
@@ -0,0 +1,56 @@
+from app.services.container_pool import ContainerPool, WarmContainer
+
+
+class FakePool(ContainerPool):
+    """Pool sans Docker : démarrage, suppression et réinitialisation simulés."""
+
+    def __init__(self, size, burst):
+        super().__init__([], size=size, burst=burst)
+        self.image = "pentral-scanner:test"
+        self.removed = []
+        self.reset = []
+
+    def _start_container(self):
+        container = WarmContainer(f"c{len(self._containers) + len(self.removed)}")
+        self._containers[container.name] = container
+        return container
+
+    def _remove_container(self, name):
+        self._containers.pop(name, None)
+        self.removed.append(name)
+
+    def _reset_container(self, container):
+        container.leased_by = None
+        self.reset.append(container.name)
+
+
+def _lease_all(pool):
+    for container in pool._containers.values():
+        container.leased_by = "scan"
+
+
+def test_refill_is_capped_at_size_plus_burst():
+    pool = FakePool(size=2, burst=1)
+    pool._refill()
+    assert len(pool._containers) == 2
+    _lease_all(pool)
+    pool._refill()
+    assert len(pool._containers) == 3
+    _lease_all(pool)
+    pool._refill()
+    assert len(pool._containers) == 3
+
+
+def test_surplus_containers_are_removed_on_release():
+    pool = FakePool(size=1, burst=1)
+    pool._refill()
+    _lease_all(pool)
+    pool._refill()
+    first, second = pool._containers.values()
+    second.leased_by = "autre scan"
+    first.uses = second.uses = 1
+    pool._recycle(first)
+    assert pool.reset == [first.name]
+    pool._recycle(second)
+    assert pool.removed == [second.name]
+    assert list(pool._containers) == [first.name]
@@ -0,0 +1,96 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip("eventlet")
+
+BACKEND = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# Exécuté dans un processus à part : monkey_patch doit précéder tous les imports, comme dans run.py
+SCRIPT = r"""
+import eventlet
+eventlet.monkey_patch()
+
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer
+
+sys.path.insert(0, sys.argv[1])
+from app.services.command_executor import close_shell_sessions, open_shell_sessions, run_command
+from app.services.llm_client import AsyncLLMClient, run_llm_batch, run_llm_coroutine
+from app.services.scan_cancel import ScanCancelled, cancel_scan, finish_scan_cancellation, start_scan_cancellation
+from mock_llm_server import MockLLM, make_handler
+
+server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(MockLLM([], 50, 200, 0, slots=2)))
+threading.Thread(target=server.serve_forever, daemon=True).start()
+client = AsyncLLMClient(endpoints=[f"http://127.0.0.1:{server.server_address[1]}"])
+
+# Un greenlet du serveur Socket.IO ne doit jamais attendre derrière la boucle asyncio
+ticks = []
+
+def ticker():
+    while True:
+        ticks.append(time.monotonic())
+        eventlet.sleep(0.02)
+
+eventlet.spawn(ticker)
+report = {}
+
+
+async def streamed(question):
+    parts = []
+    async for token in client.stream_chat({"model": "mock", "stream": True,
+                                           "messages": [{"role": "user", "content": question}]},
+                                          use_cache=False):
+        # Comme socketio.emit sous eventlet : le rappel peut céder la main au hub
+        eventlet.sleep(0)
+        parts.append(token)
+    return "".join(parts)
+
+report["llm"] = len(run_llm_coroutine(streamed("Analyse de résultats : port 80 ouvert")))
+report["batch"] = [len(text) for text in run_llm_batch([streamed("Port 22 ?"), streamed("Port 80 ?")])]
+
+lines = []
+report["command"] = run_command("echo un; sleep 0.3; echo deux", 10,
+                                on_line=lambda stream, line: lines.append(line)).stdout.split()
+report["lines"] = len(lines)
+
+start_scan_cancellation("scan-eventlet")
+open_shell_sessions("scan-eventlet")
+with ThreadPoolExecutor(max_workers=3) as pool:
+    report["parallel"] = sorted(r.stdout.strip() for r in pool.map(
+        lambda i: run_command(f"sleep 0.3; echo {i}", 10), range(3)))
+
+eventlet.spawn_after(0.3, cancel_scan, "scan-eventlet")
+started = time.monotonic()
+try:
+    run_command("sleep 30", 60)
+    report["cancelled"] = False
+except ScanCancelled:
+    report["cancelled"] = True
+report["cancel_delay"] = time.monotonic() - started
+close_shell_sessions()
+finish_scan_cancellation("scan-eventlet")
+
+report["max_gap"] = max(b - a for a, b in zip(ticks, ticks[1:]))
+print(json.dumps(report))
+"""
+
+
+def test_llm_loop_and_commands_under_eventlet():
+    completed = subprocess.run([sys.executable, "-c", SCRIPT, BACKEND], capture_output=True, text=True,
+                               timeout=90, cwd=BACKEND)
+    assert completed.returncode == 0, completed.stderr
+    report = json.loads(completed.stdout.strip().splitlines()[-1])
+    assert report["llm"] > 0 and all(report["batch"])
+    assert report["command"] == ["un", "deux"] and report["lines"] == 2
+    assert report["parallel"] == ["0", "1", "2"]
+    assert report["cancelled"] and report["cancel_delay"] < 10
+    # Le hub eventlet a continué à tourner pendant les flux, les commandes et l'annulation
+    assert report["max_gap"] < 0.5
@@ -0,0 +1,54 @@
+import time
+
+from app.services.llm_cache import CompletionCache, make_cache_key, split_tokens
+
+
+def _payload(**overrides):
+    payload = {
+        "model": "local",
+        "temperature": 0.2,
+        "max_tokens": 256,
+        "messages": [{"role": "user", "content": "Scan  la cible\n    10.0.0.1"}],
+    }
+    payload.update(overrides)
+    return payload
+
+
+def test_key_ignores_whitespace_and_max_tokens():
+    base = make_cache_key(_payload())
+    assert make_cache_key(_payload(messages=[{"role": "user", "content": "Scan la cible 10.0.0.1"}])) == base
+    assert make_cache_key(_payload(max_tokens=1024)) == base
+
+
+def test_key_depends_on_sampling_parameters():
+    assert make_cache_key(_payload(temperature=0.9)) != make_cache_key(_payload())
+    assert make_cache_key(_payload(stream=True)) == make_cache_key(_payload())
+
+
+def test_get_put_and_ttl(tmp_path):
+    cache = CompletionCache(path=str(tmp_path / "cache.sqlite3"), ttl=1)
+    key = make_cache_key(_payload())
+    assert cache.get(key) is None
+    cache.put(key, "nmap -sV 10.0.0.1")
+    assert cache.get(key) == "nmap -sV 10.0.0.1"
+    cache.ttl = 0
+    time.sleep(0.01)
+    assert cache.get(key) is None
+    assert cache.get_stats() == {"hits": 1, "misses": 2}
+
+
+def test_lru_eviction_keeps_recent_entries(tmp_path):
+    cache = CompletionCache(path=str(tmp_path / "cache.sqlite3"), max_bytes=10)
+    cache.put("a", "12345")
+    time.sleep(0.01)
+    cache.put("b", "67890")
+    time.sleep(0.01)
+    cache.get("a")
+    cache.put("c", "abcde")
+    assert cache.get("b") is None
+    assert cache.get("a") == "12345"
+
+
+def test_replay_rebuilds_response():
+    text = "commande:\n  nmap -sV  10.0.0.1\n"
+    assert "".join(split_tokens(text)) == text
@@ -0,0 +1,214 @@
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import aiohttp
+import pytest
+import requests
+from aiohttp import web
+
+from app.services import llm_client
+from app.services.llm_cache import CompletionCache, make_cache_key
+
+TOKENS = ["tool_name: nmap\n", "enumerate_command: nmap 10.0.0.1\n", "Commentaire\n", " superflu"]
+
+
+def _sse(content):
+    return ("data: " + json.dumps({"choices": [{"delta": {"content": content}}]}) + "\n\n").encode()
+
+
+async def _health(request):
+    return web.json_response({"status": "ok"})
+
+
+async def _serve(handler):
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", handler)
+    app.router.add_get("/health", _health)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}/v1/chat/completions"
+
+
+async def _stream(request):
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+    await response.prepare(request)
+    for token in TOKENS:
+        await response.write(_sse(token))
+        await asyncio.sleep(0.01)
+    await response.write(b"data: [DONE]\n\n")
+    return response
+
+
+def test_early_stop_on_complete_block_is_cached(tmp_path, monkeypatch):
+    cache = CompletionCache(path=str(tmp_path / "cache.sqlite3"))
+    monkeypatch.setattr(llm_client, "get_completion_cache", lambda: cache)
+    payload = {"model": "local", "messages": [{"role": "user", "content": "outil ?"}], "stream": True}
+
+    async def scenario():
+        runner, url = await _serve(_stream)
+        client = llm_client.AsyncLLMClient(endpoints=[url])
+        try:
+            meta = {}
+            stream = client.stream_chat(payload, meta=meta)
+            received = []
+            async for delta in stream:
+                received.append(delta)
+                if len(received) == 2:
+                    meta["block_complete"] = True
+                    break
+            await stream.aclose()
+            return meta, received, client.router.endpoints[0]
+        finally:
+            await client.close()
+            await runner.cleanup()
+
+    meta, received, endpoint = asyncio.run(scenario())
+    assert meta["stop_reason"] == "early_stop"
+    assert endpoint.healthy
+    assert cache.get(make_cache_key(payload)) == "".join(received)
+
+
+def test_early_stop_without_complete_block_is_not_cached(tmp_path, monkeypatch):
+    cache = CompletionCache(path=str(tmp_path / "cache.sqlite3"))
+    monkeypatch.setattr(llm_client, "get_completion_cache", lambda: cache)
+    payload = {"model": "local", "messages": [{"role": "user", "content": "autre"}], "stream": True}
+
+    async def scenario():
+        runner, url = await _serve(_stream)
+        client = llm_client.AsyncLLMClient(endpoints=[url])
+        try:
+            stream = client.stream_chat(payload)
+            async for _ in stream:
+                break
+            await stream.aclose()
+        finally:
+            await client.close()
+            await runner.cleanup()
+
+    asyncio.run(scenario())
+    assert cache.get(make_cache_key(payload)) is None
+
+
+async def _reject(request):
+    return web.json_response({"error": "json_schema invalide"}, status=400)
+
+
+def test_rejected_request_keeps_endpoint_healthy(monkeypatch):
+    monkeypatch.setattr(llm_client, "get_completion_cache", lambda: None)
+    payload = {"model": "local", "messages": [{"role": "user", "content": "x"}], "stream": True}
+
+    async def scenario():
+        runner, url = await _serve(_reject)
+        client = llm_client.AsyncLLMClient(endpoints=[url, "http://127.0.0.1:9/v1/chat/completions"])
+        try:
+            try:
+                async for _ in client.stream_chat(payload, prefer=url):
+                    pass
+            except aiohttp.ClientResponseError as e:
+                pinned, other = client.router.endpoints
+                return e.status, (pinned.healthy, pinned.failures), other.requests
+        finally:
+            await client.close()
+            await runner.cleanup()
+
+    status, pinned, other_requests = asyncio.run(scenario())
+    assert status == 400
+    assert pinned == (True, 0)
+    assert other_requests == 0
+
+
+class _KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    statuses = [200, 200, 500]
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        status = self.statuses.pop(0)
+        body = json.dumps({"choices": [{"message": {"content": "ok"}, "finish_reason": "stop"}]}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_failed_request_is_not_counted_as_reused(monkeypatch):
+    monkeypatch.setattr(llm_client, "get_completion_cache", lambda: None)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _KeepAliveHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = llm_client.LLMClient(api_url=f"http://127.0.0.1:{server.server_address[1]}/v1/chat/completions")
+    try:
+        payload = {"model": "local", "messages": [{"role": "user", "content": "x"}]}
+        assert client.chat(payload) == "ok" and client.chat(payload) == "ok"
+        # Même connexion keep-alive, mais réponse en erreur
+        with pytest.raises(requests.exceptions.HTTPError):
+            client.chat(payload)
+        stats = client.get_stats()
+    finally:
+        client.close()
+        server.shutdown()
+    assert stats == {"requests": 3, "errors": 1, "connections_opened": 1, "connections_reused": 1}
+
+
+def test_failover_to_another_server_before_the_first_token(monkeypatch):
+    monkeypatch.setattr(llm_client, "get_completion_cache", lambda: None)
+    payload = {"model": "local", "messages": [{"role": "user", "content": "bascule"}], "stream": True}
+    dead = "http://127.0.0.1:9/v1/chat/completions"
+
+    async def scenario():
+        runner, url = await _serve(_stream)
+        client = llm_client.AsyncLLMClient(endpoints=[dead, url])
+        try:
+            meta = {}
+            # Serveur épinglé par le scan injoignable : la requête part sur l'autre serveur
+            received = [delta async for delta in client.stream_chat(payload, meta=meta, prefer=dead)]
+            pinned, other = client.router.endpoints
+            return received, meta["stop_reason"], (pinned.healthy, other.healthy, other.requests)
+        finally:
+            await client.close()
+            await runner.cleanup()
+
+    received, stop_reason, state = asyncio.run(scenario())
+    assert received == TOKENS and stop_reason == "done"
+    assert state == (False, True, 1)
+
+
+async def _broken_stream(request):
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+    await response.prepare(request)
+    await response.write(_sse(TOKENS[0]))
+    await asyncio.sleep(0.05)
+    request.transport.close()
+    return response
+
+
+def test_no_failover_once_tokens_were_sent(monkeypatch):
+    monkeypatch.setattr(llm_client, "get_completion_cache", lambda: None)
+    payload = {"model": "local", "messages": [{"role": "user", "content": "coupure"}], "stream": True}
+
+    async def scenario():
+        broken_runner, broken = await _serve(_broken_stream)
+        runner, url = await _serve(_stream)
+        client = llm_client.AsyncLLMClient(endpoints=[broken, url])
+        received = []
+        try:
+            with pytest.raises(aiohttp.ClientError):
+                async for delta in client.stream_chat(payload, prefer=broken):
+                    received.append(delta)
+            return received, client.router.endpoints[1].requests
+        finally:
+            await client.close()
+            await runner.cleanup()
+            await broken_runner.cleanup()
+
+    received, other_requests = asyncio.run(scenario())
+    # La réponse partielle déjà transmise ne peut pas être rejouée ailleurs
+    assert received == TOKENS[:1] and other_requests == 0
@@ -0,0 +1,39 @@
+import aiohttp
+
+from app.services.llm_router import LLMRouter, is_request_error
+
+
+def _router():
+    return LLMRouter(["http://llm1:8080", "http://llm2:8080/v1/chat/completions"], slots=2, health_interval=0)
+
+
+def test_pick_least_outstanding():
+    router = _router()
+    router.endpoints[0].outstanding = 2
+    assert router.pick() is router.endpoints[1]
+
+
+def test_pick_keeps_pinned_endpoint_while_healthy():
+    router = _router()
+    pinned, other = router.endpoints
+    pinned.outstanding = 2
+    assert router.pick(prefer="http://llm1:8080/v1/chat/completions") is pinned
+    pinned.healthy = False
+    assert router.pick(prefer="http://llm1:8080") is other
+
+
+def test_pick_falls_back_when_pinned_already_tried():
+    router = _router()
+    pinned, other = router.endpoints
+    assert router.pick({pinned}, prefer="http://llm1:8080") is other
+
+
+def test_request_errors_are_4xx_except_429():
+    def error(status):
+        return aiohttp.ClientResponseError(None, (), status=status)
+
+    assert is_request_error(error(400))
+    assert is_request_error(error(422))
+    assert not is_request_error(error(429))
+    assert not is_request_error(error(503))
+    assert not is_request_error(aiohttp.ClientConnectionError())
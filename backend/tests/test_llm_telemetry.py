@@ -0,0 +1,61 @@
+import contextvars
+
+from app.services import llm_telemetry
+from app.services.llm_client import run_llm_coroutine
+from app.services.llm_telemetry import (ScanTelemetry, finish_scan_telemetry, get_scan_telemetry,
+                                        record_llm_call, start_scan_telemetry)
+
+
+def _call(prompt_type="command", **values):
+    call = {"prompt_type": prompt_type, "prompt_tokens": 100, "completion_tokens": 50,
+            "ttft_ms": 200.0, "latency_ms": 1200.0, "retry_depth": 0, "cache_hit": False}
+    call.update(values)
+    return call
+
+
+def test_summary_aggregates_calls_by_prompt_type():
+    telemetry = ScanTelemetry("scan")
+    # 50 tokens générés en 1000 ms après le premier token
+    assert telemetry.record(_call())["tokens_per_sec"] == 50.0
+    telemetry.record(_call(ttft_ms=400.0, latency_ms=2400.0, retry_depth=2, error="timeout"))
+    telemetry.record(_call("analysis", completion_tokens=0, ttft_ms=None, latency_ms=5.0, cache_hit=True))
+    summary = telemetry.summary()
+    assert summary["calls"] == 3 and summary["llm_time_ms"] == 3605.0
+    command = summary["by_prompt_type"]["command"]
+    assert (command["calls"], command["errors"], command["retries"], command["max_retry_depth"]) == (2, 1, 1, 2)
+    assert command["completion_tokens"] == 100 and command["ttft_ms_avg"] == 300.0
+    assert command["ttft_ms_p95"] == 400.0 and command["latency_ms_avg"] == 1800.0
+    # 100 tokens en 1000 + 2000 ms de génération
+    assert command["tokens_per_sec"] == 33.3
+    analysis = summary["by_prompt_type"]["analysis"]
+    assert analysis["cache_hits"] == 1 and analysis["ttft_ms_avg"] == 0.0 and analysis["tokens_per_sec"] == 0.0
+
+
+def test_detailed_calls_are_capped_but_summary_counts_all(monkeypatch):
+    monkeypatch.setattr(llm_telemetry, "TELEMETRY_MAX_CALLS", 3)
+    telemetry = ScanTelemetry("scan")
+    for index in range(5):
+        telemetry.record(_call(prompt_tokens=index))
+    document = telemetry.to_document()
+    assert [call["prompt_tokens"] for call in document["calls"]] == [2, 3, 4]
+    assert document["summary"]["calls"] == 5 and document["summary"]["by_prompt_type"]["command"]["calls"] == 5
+
+
+def test_calls_follow_the_scan_context_into_the_llm_loop():
+    async def llm_call():
+        # Exécuté dans la boucle partagée, comme aquery_llm
+        record_llm_call(**_call())
+
+    def scan():
+        telemetry = start_scan_telemetry("scan-telemetry")
+        assert get_scan_telemetry("scan-telemetry") is telemetry
+        run_llm_coroutine(llm_call())
+        return telemetry, finish_scan_telemetry("scan-telemetry")
+
+    telemetry, document = contextvars.copy_context().run(scan)
+    assert document["summary"]["calls"] == 1
+    assert get_scan_telemetry("scan-telemetry") is None
+    assert finish_scan_telemetry("scan-telemetry") is None
+    # Hors du contexte du scan, l'appel n'est rattaché à rien
+    run_llm_coroutine(llm_call())
+    assert telemetry.total_calls == 1
@@ -0,0 +1,214 @@
+import contextvars
+import re
+import threading
+import time
+from concurrent.futures import ALL_COMPLETED, ThreadPoolExecutor
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+from app.services import llm_client
+from app.services.command_executor import run_command
+from app.services.llm_client import AsyncLLMClient, run_llm_coroutine
+from app.services.prompt_cache import current_scan_slot, pin_scan_slot, release_scan_slot
+from app.services.scan_cancel import ScanCancelled, finish_scan_cancellation, start_scan_cancellation
+from app.services.token_budget import TokenBudgets
+from mock_llm_server import MockLLM, make_handler
+
+engine = pytest.importorskip("app.services.mistest_no_user")
+
+
+@pytest.fixture
+def mock_llm(monkeypatch, tmp_path):
+    """Démarre un serveur LLM factice et fait passer les appels du moteur par un client dédié."""
+    monkeypatch.setattr(llm_client, "get_completion_cache", lambda: None)
+    # Budgets appris à part : le fichier du répertoire courant n'est ni lu ni réécrit
+    budgets = TokenBudgets(path=str(tmp_path / "token_budgets.json"))
+    monkeypatch.setattr(engine, "get_token_budgets", lambda: budgets)
+    started = []
+
+    def start(replay=(), tokens_per_sec=0.0, slots=2):
+        mock = MockLLM([(re.compile(pattern), response) for pattern, response in replay], 0, tokens_per_sec, 0,
+                       slots=slots)
+        server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(mock))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        client = AsyncLLMClient(endpoints=[f"http://127.0.0.1:{server.server_address[1]}"], slots=slots)
+        monkeypatch.setattr(engine, "get_async_llm_client", lambda: client)
+        started.append((server, client))
+        return mock, client
+
+    yield start
+    for server, client in started:
+        run_llm_coroutine(client.close())
+        server.shutdown()
+        server.server_close()
+
+
+def test_query_llm_streams_through_the_shared_loop(mock_llm):
+    mock, client = mock_llm([("Port 22", "Le port 22 est ouvert.")])
+    threads = []
+
+    def on_token(token):
+        threads.append(threading.current_thread().name)
+
+    assert engine.query_llm("Port 22 ?", emit_callback=on_token) == "Le port 22 est ouvert."
+    # Appelant synchrone, mais les tokens arrivent un par un depuis la boucle partagée
+    assert len(threads) > 1 and set(threads) == {"llm-loop"}
+    assert mock.stats["requests"] == 1
+
+
+def test_query_llm_from_parallel_threads_is_bounded_by_slots(mock_llm):
+    mock, client = mock_llm([("Port", "Réponse courte du serveur.")], tokens_per_sec=20, slots=2)
+    results = []
+    peak = []
+
+    def watch():
+        while len(results) < 4:
+            peak.append(client.get_stats()["in_flight"])
+            time.sleep(0.01)
+
+    threading.Thread(target=watch, daemon=True).start()
+    threads = [threading.Thread(target=lambda p=port: results.append(engine.query_llm(f"Port {p} ?",
+                                                                                      emit_callback=str)))
+               for port in (21, 22, 80, 443)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == ["Réponse courte du serveur."] * 4
+    assert max(peak) == 2 and mock.stats["requests"] == 4
+
+
+def test_cancelled_scan_interrupts_query_llm(mock_llm):
+    mock, client = mock_llm([("Rapport", "mot " * 500)], tokens_per_sec=20)
+
+    def scan():
+        token = start_scan_cancellation("scan-llm")
+        threading.Timer(0.3, token.cancel).start()
+        started = time.monotonic()
+        try:
+            with pytest.raises(ScanCancelled):
+                engine.query_llm("Rapport ?", emit_callback=str)
+        finally:
+            finish_scan_cancellation("scan-llm")
+        return time.monotonic() - started
+
+    assert contextvars.copy_context().run(scan) < 5
+    # Le flux a été fermé côté client : la requête ne compte pas comme terminée
+    time.sleep(0.2)
+    assert client.get_stats()["in_flight"] == 0
+
+
+COMMENTARY = " Cette commande permet d'identifier la version exacte du service." * 20
+
+
+def test_query_llm_stops_once_the_yaml_block_is_complete(mock_llm):
+    block = "```yaml\ntool_name: nmap\nenumerate_command: nmap -sV -p 22 10.0.0.1\n```"
+    mock, client = mock_llm([("Port 22", block + "\n" + COMMENTARY)], tokens_per_sec=100)
+    meta = {}
+    started = time.monotonic()
+    response = engine.query_llm("Port 22 ?", emit_callback=str, stop_on_keys=engine.COMMAND_REQUIRED_KEYS,
+                                result_meta=meta)
+    assert meta["stop_reason"] == "early_stop"
+    assert meta["parsed"] == {"tool_name": "nmap", "enumerate_command": "nmap -sV -p 22 10.0.0.1"}
+    assert "Cette commande" not in response
+    # Le commentaire (plus de 200 tokens à 100 tokens/s) n'a pas été attendu
+    assert time.monotonic() - started < 1.5
+
+
+def test_query_llm_stops_once_the_schema_object_is_complete(mock_llm):
+    answer = '{"tool_name": "nmap", "enumerate_command": "nmap -sV -p 22 10.0.0.1", "install_command": ""}'
+    mock, client = mock_llm([("Port 22", answer + COMMENTARY)], tokens_per_sec=100)
+    meta = {}
+    response = engine.query_llm("Port 22 ?", emit_callback=str, output_schema=engine.TOOL_COMMAND_SCHEMA,
+                                stop_on_keys=engine.COMMAND_REQUIRED_KEYS, result_meta=meta)
+    assert meta["stop_reason"] == "early_stop"
+    assert meta["parsed"]["enumerate_command"] == "nmap -sV -p 22 10.0.0.1"
+    assert engine.is_valid_tool_yaml(response) and "Cette commande" not in response
+
+
+def _tool_yaml(command):
+    return f"tool_name: {command.split()[0]}\nenumerate_command: {command}"
+
+
+def test_select_command_candidate_keeps_the_first_acceptable_one():
+    history = [{"command": _tool_yaml("ls -l /var")}]
+    candidates = [
+        None,
+        "[ERREUR] Délai dépassé",
+        "tool_name: ls",                                  # enumerate_command manquant
+        _tool_yaml("ls -l /var"),                         # déjà exécutée
+        _tool_yaml("ls --option-inexistante /tmp"),       # option absente du manuel
+        _tool_yaml("ls -la /etc"),
+        _tool_yaml("ls -R /opt"),
+    ]
+    assert engine.select_command_candidate(candidates, history) == _tool_yaml("ls -la /etc")
+    assert engine.select_command_candidate(candidates[:5], history) is None
+
+
+def test_query_llm_candidates_samples_each_candidate_differently(mock_llm):
+    mock, client = mock_llm(slots=3)
+    payloads = []
+    answer = mock.answer
+    mock.answer = lambda payload: (payloads.append(payload), answer(payload))[1]
+    prompt = "Adresse cible : 10.0.0.1\nPort : 22\nTechnologie : ssh\nenumerate_command attendu"
+
+    def scan():
+        slot = pin_scan_slot("scan-candidates")
+        try:
+            return slot, engine.query_llm_candidates(prompt, 3)
+        finally:
+            release_scan_slot()
+
+    slot, candidates = contextvars.copy_context().run(scan)
+    assert len(candidates) == 3 and all(engine.is_valid_tool_yaml(c) for c in candidates)
+    assert "ssh2-enum-algos" in candidates[0]
+    # Une requête par candidate (llama.cpp ne gère pas n > 1)
+    assert mock.stats["requests"] == 3
+    by_temperature = sorted(payloads, key=lambda p: (p["temperature"], p.get("seed", 0)))
+    assert [(p["temperature"], p.get("seed")) for p in by_temperature] == \
+        [(0.2, None), (engine.CANDIDATE_TEMPERATURE, 1), (engine.CANDIDATE_TEMPERATURE, 2)]
+    # Seule la première candidate reprend le slot (et le cache KV) du scan
+    assert by_temperature[0]["id_slot"] == slot
+    assert all("id_slot" not in p for p in by_temperature[1:])
+
+
+def test_phase2_probes_run_in_parallel_and_stop_with_the_scan(monkeypatch):
+    started, finished = [], []
+
+    def probe(name, seconds):
+        started.append((name, current_scan_slot()))
+        run_command(f"sleep {seconds}", 60)
+        finished.append(name)
+
+    monkeypatch.setattr(engine, "probe_service", probe)
+
+    def scan():
+        token = start_scan_cancellation("scan-probes")
+        slot = pin_scan_slot("scan-probes")
+        pool = ThreadPoolExecutor(max_workers=2)
+        in_flight = {}
+        try:
+            before = time.monotonic()
+            for name in ("ssh", "http"):
+                in_flight[engine.submit_probe(pool, name, 0.5)] = (name, "22")
+            engine.wait_for_probes(in_flight, ALL_COMPLETED)
+            parallel = time.monotonic() - before
+            # Deux sondes longues occupent le pool, la troisième attend une place libre
+            for name in ("ftp", "smb", "rdp"):
+                in_flight[engine.submit_probe(pool, name, 30)] = (name, "21")
+            threading.Timer(0.5, token.cancel).start()
+            before = time.monotonic()
+            with pytest.raises(ScanCancelled):
+                engine.wait_for_probes(in_flight, ALL_COMPLETED)
+            return slot, parallel, time.monotonic() - before
+        finally:
+            pool.shutdown(cancel_futures=True)
+            release_scan_slot()
+            finish_scan_cancellation("scan-probes")
+
+    slot, parallel, cancel_delay = contextvars.copy_context().run(scan)
+    assert parallel < 0.9 and cancel_delay < 5
+    # Les sondes voient le slot du scan ; celle restée en file n'a jamais démarré
+    assert sorted(started) == sorted((name, slot) for name in ("ssh", "http", "ftp", "smb"))
+    assert sorted(finished) == ["http", "ssh"]
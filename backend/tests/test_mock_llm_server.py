@@ -0,0 +1,53 @@
+import asyncio
+import threading
+from http.server import ThreadingHTTPServer
+
+from app.services.llm_client import AsyncLLMClient
+from mock_llm_server import MockLLM, make_handler
+
+PREFIX = "Contexte commun du scan. " * 40
+
+
+def _payload(question, id_slot=0):
+    return {"model": "mock", "stream": True, "cache_prompt": True, "id_slot": id_slot,
+            "messages": [{"role": "user", "content": PREFIX + question}]}
+
+
+def test_prefill_reuses_slot_prefix():
+    mock = MockLLM([], 0, 0, 0, slots=2)
+    evaluated, cached = mock.prefill(_payload("Port 22 ?"))
+    assert cached == 0
+    evaluated, cached = mock.prefill(_payload("Port 80 ?"))
+    assert cached >= len(PREFIX) // 4 - 1 and evaluated >= 1
+    assert mock.prefill(_payload("Port 80 ?", id_slot=1))[1] == 0
+    assert mock.prefill(dict(_payload("Port 80 ?"), cache_prompt=False))[1] == 0
+
+
+def test_streams_reuse_the_connection():
+    mock = MockLLM([], 0, 0, 0, slots=2)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(mock))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/v1/chat/completions"
+
+    async def scenario():
+        client = AsyncLLMClient(endpoints=[url], pool_size=1)
+        try:
+            metas = []
+            for question in ("Port 22 ?", "Port 80 ?"):
+                meta = {}
+                async for _ in client.stream_chat(_payload(question), use_cache=False, meta=meta):
+                    pass
+                metas.append(meta)
+            return metas, client.get_stats()
+        finally:
+            await client.close()
+
+    try:
+        metas, stats = asyncio.run(scenario())
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert [m["stop_reason"] for m in metas] == ["done", "done"]
+    assert metas[0]["timings"]["cache_n"] == 0
+    assert metas[1]["timings"]["cache_n"] > 0
+    assert stats["connections_opened"] == 1 and stats["connections_reused"] >= 1
@@ -0,0 +1,41 @@
+from app.services.output_buffer import OutputBuffer, build_excerpt
+
+
+def test_buffer_spills_to_disk_and_reads_back_lines():
+    buffer = OutputBuffer(memory_limit=16)
+    for i in range(100):
+        buffer.write(f"ligne {i}\r\n".encode())
+    try:
+        assert buffer.spilled
+        lines = list(buffer.iter_lines())
+        assert lines[0] == "ligne 0" and lines[-1] == "ligne 99" and len(lines) == 100
+        assert buffer.size == len(buffer.text().encode())
+    finally:
+        buffer.close()
+
+
+def test_small_output_is_returned_unchanged():
+    assert build_excerpt("22/tcp open ssh\n", budget=100) == "22/tcp open ssh\n"
+
+
+def test_excerpt_keeps_useful_lines_in_order_within_budget():
+    noise = [f"Tentative {i} sans intérêt" for i in range(500)]
+    lines = ["Starting Nmap"] + noise[:250] + ["80/tcp open http Apache httpd 2.4.41"] + noise[250:] + \
+            ["| cpe:/a:apache:http_server:2.4.41", "Nmap done"]
+    text = "\n".join(lines)
+    excerpt = build_excerpt(text, budget=600)
+    assert len(excerpt.encode()) <= 600
+    kept = [line for line in excerpt.splitlines() if not line.startswith("[...")]
+    assert kept.index("80/tcp open http Apache httpd 2.4.41") < kept.index("| cpe:/a:apache:http_server:2.4.41")
+    assert kept[0] == "Starting Nmap" and kept[-1] == "Nmap done"
+    assert "ligne(s) omise(s)" in excerpt
+
+
+def test_excerpt_from_spilled_buffer_matches_text():
+    text = "\n".join(["bruit"] * 2000 + ["443/tcp open https nginx 1.18.0"])
+    buffer = OutputBuffer(memory_limit=1024)
+    buffer.write(text.encode())
+    try:
+        assert build_excerpt(buffer, budget=200) == build_excerpt(text, budget=200)
+    finally:
+        buffer.close()
@@ -0,0 +1,36 @@
+import threading
+
+from app.services import package_installer
+from app.services.package_installer import PackageInstallQueue, parse_install_command
+
+
+def test_parse_install_command():
+    assert parse_install_command("sudo apt-get install -y nikto whatweb") == ["nikto", "whatweb"]
+    assert parse_install_command("`apt install --no-install-recommends ssh-audit`") == ["ssh-audit"]
+    assert parse_install_command("DEBIAN_FRONTEND=noninteractive apt-get install -y nmap") == ["nmap"]
+    assert parse_install_command("apt-get update && apt-get install -y nmap") is None
+    assert parse_install_command("pip install impacket") is None
+    assert parse_install_command("apt-get install -y") is None
+
+
+def test_concurrent_requests_share_one_transaction(monkeypatch):
+    monkeypatch.setattr(package_installer, "INSTALL_BATCH_WINDOW", 0.2)
+    queue = PackageInstallQueue()
+    batches = []
+    monkeypatch.setattr(queue, "_run_transaction",
+                        lambda packages: batches.append(packages) or {p: p != "inconnu" for p in packages})
+    results = {}
+
+    def scan(packages):
+        results.update(queue.install(packages))
+
+    threads = [threading.Thread(target=scan, args=(p,)) for p in (["nmap", "nikto"], ["nikto", "inconnu"])]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert batches == [["inconnu", "nikto", "nmap"]]
+    assert results == {"nmap": True, "nikto": True, "inconnu": False}
+    # Résultat en cache : pas de nouvelle transaction
+    assert queue.install(["nmap"]) == {"nmap": True}
+    assert len(batches) == 1
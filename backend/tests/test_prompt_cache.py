@@ -0,0 +1,48 @@
+import contextvars
+import threading
+
+from app.services.prompt_cache import PrefillStats, SlotPinner
+
+
+def test_pins_spread_over_endpoints_then_slots():
+    pins = []
+
+    def scan(name):
+        pinner_slot = pinner.pin(name)
+        pins.append((pinner.current_endpoint(), pinner_slot))
+
+    pinner = SlotPinner(slots=2, endpoints=["http://llm1", "http://llm2"])
+    for name in ("a", "b", "c"):
+        thread = threading.Thread(target=scan, args=(name,))
+        thread.start()
+        thread.join()
+    assert pins == [("http://llm1", 0), ("http://llm2", 0), ("http://llm1", 1)]
+
+
+def test_pin_follows_the_scan_context_into_probe_threads():
+    pinner = SlotPinner(slots=1, endpoints=["http://llm1"])
+    assert pinner.pin("scan") == 0
+    seen = []
+
+    def probe():
+        seen.append((pinner.current(), pinner.current_endpoint()))
+
+    context = contextvars.copy_context()
+    thread = threading.Thread(target=context.run, args=(probe,))
+    thread.start()
+    thread.join()
+    # Un thread lancé sans le contexte du scan n'hérite d'aucun slot
+    thread = threading.Thread(target=probe)
+    thread.start()
+    thread.join()
+    assert seen == [(0, "http://llm1"), (None, None)]
+    pinner.release()
+    assert pinner.current() is None and pinner.current_endpoint() is None
+    assert pinner.pin("suivant") == 0
+
+
+def test_prefill_uses_cache_n_when_reported():
+    stats = PrefillStats()
+    record = stats.record({"prompt_n": 10, "prompt_ms": 20.0, "cache_n": 90}, prompt_tokens=100)
+    assert record == {"evaluated": 10, "cached": 90, "prefill_ms": 20.0, "saved_ms": 180.0}
+    assert stats.record({"prompt_n": 40, "prompt_ms": 40.0}, prompt_tokens=100)["cached"] == 60
@@ -0,0 +1,57 @@
+from app.services.prompt_context import (HISTORY_RECENT_HEADER, HISTORY_SUMMARY_HEADER, build_history_context,
+                                         build_list_context, count_tokens, extract_ports)
+
+
+def _command(tool, command, status="SUCCESS"):
+    return {"tool_name": tool, "enumerate_command": command, "status": status}
+
+
+HISTORY = ([_command("nmap", f"nmap -sV -p {port} 10.0.0.1") for port in (22, 22, 80)]
+           + [_command("nikto", "nikto -h http://10.0.0.1", "ERROR")]
+           + [_command("whatweb", f"whatweb -a {level} http://10.0.0.1") for level in range(1, 6)])
+
+
+def test_count_tokens_and_ports():
+    assert count_tokens("") == 0
+    # "nmap", "-", "sV" et un mot de 12 caractères (3 tranches de 4)
+    assert count_tokens("nmap -sV abcdefghijkl") == 6
+    assert extract_ports("nmap -sV -p 22,80 10.0.0.1") == "22,80"
+    assert extract_ports("whatweb http://10.0.0.1") == ""
+
+
+def test_history_keeps_recent_commands_and_summarizes_older_ones():
+    context = build_history_context(HISTORY, budget=600, recent=5)
+    summary, recent = context.split(HISTORY_RECENT_HEADER)
+    assert summary.startswith(HISTORY_SUMMARY_HEADER)
+    assert "- nmap (Ports: 22) : 2 commande(s) déjà testée(s) (2 SUCCESS)" in summary
+    assert "- nmap (Ports: 80) : 1 commande(s)" in summary
+    assert "- nikto : 1 commande(s) déjà testée(s) (1 ERROR)" in summary
+    assert "nmap -sV -p 22" not in summary
+    # Les 5 dernières commandes, dans l'ordre d'exécution
+    assert [line for line in recent.splitlines() if line.startswith("  → ")] == \
+        [f"  → whatweb -a {level} http://10.0.0.1" for level in range(1, 6)]
+    assert "omise" not in context
+
+
+def test_history_never_exceeds_the_budget_and_drops_oldest_first():
+    history = [_command("nmap", f"nmap -sV -p {port} 10.0.0.1") for port in range(1, 200)]
+    for budget in (60, 120, 400, 600):
+        context = build_history_context(history, budget=budget, recent=5)
+        assert count_tokens(context) + len(context.splitlines()) <= budget
+    # Budget serré : seules les commandes les plus récentes restent
+    context = build_history_context(history, budget=120, recent=5)
+    assert "nmap -sV -p 199 10.0.0.1" in context and "nmap -sV -p 197 10.0.0.1" not in context
+    assert HISTORY_SUMMARY_HEADER not in context
+    assert context.endswith("- ... 197 entrée(s) plus ancienne(s) omise(s)")
+    # Budget plus large : les 5 récentes, puis les résumés des plus anciennes
+    context = build_history_context(history, budget=400, recent=5)
+    assert "nmap -sV -p 195 10.0.0.1" in context and "- nmap (Ports: 1) : 1 commande(s)" in context
+
+
+def test_list_context_keeps_leading_lines_within_budget():
+    lines = [f"- CVE-2024-{index:04d} : vulnérabilité du service web" for index in range(100)]
+    context = build_list_context(lines, budget=100, label="CVE")
+    kept = context.splitlines()
+    assert kept[0] == lines[0] and kept[-1].startswith("- ... ") and kept[-1].endswith("autres CVE omis")
+    assert count_tokens(context) + len(kept) <= 100
+    assert build_list_context(lines[:2], budget=100) == "\n".join(lines[:2])
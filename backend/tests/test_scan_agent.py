@@ -0,0 +1,89 @@
+import asyncio
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+from app.services import agent_registry, command_executor
+from app.services.llm_client import get_llm_loop
+from scan_agent import ScanAgent, make_handler
+
+TOKEN = "secret-de-test"
+
+
+def test_chatty_command_still_times_out():
+    agent = ScanAgent("test", 1, [], TOKEN)
+    result = agent.run("yes", 1, lambda message: None)
+    assert result["timed_out"]
+
+
+def test_chatty_command_stops_when_backend_disconnects():
+    agent = ScanAgent("test", 1, [], TOKEN)
+    calls = []
+
+    def disconnected():
+        calls.append(1)
+        return len(calls) > 3
+
+    with pytest.raises(ConnectionResetError):
+        agent.run("yes", 30, lambda message: None, disconnected)
+
+
+def test_commands_reuse_the_agent_connection(monkeypatch):
+    monkeypatch.setattr(agent_registry, "AGENT_TOKEN", TOKEN)
+    connections = []
+
+    class CountingHandler(make_handler(ScanAgent("test", 2, [], TOKEN))):
+        def setup(self):
+            connections.append(self.client_address)
+            super().setup()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), CountingHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    agent = agent_registry.ScanAgent("test", f"http://127.0.0.1:{server.server_address[1]}", 2, [])
+
+    async def run_two():
+        results = []
+        for command in ("echo un", "echo deux; exit 2"):
+            results.append(await agent_registry._run_on_agent(agent, command, 10, None))
+        return results
+
+    try:
+        first, second = asyncio.run_coroutine_threadsafe(run_two(), get_llm_loop()).result(30)
+    finally:
+        agent.close()
+        server.shutdown()
+        server.server_close()
+    assert (first.stdout, first.exit_code) == ("un\n", 0)
+    assert (second.stdout, second.exit_code) == ("deux\n", 2)
+    # Connexion rendue au pool après la première commande, réutilisée par la suivante
+    assert len(connections) == 1
+
+
+def test_agent_commands_share_the_global_command_limit(monkeypatch):
+    monkeypatch.setattr(agent_registry, "AGENT_TOKEN", TOKEN)
+    monkeypatch.setattr(command_executor, "_global_slots", threading.BoundedSemaphore(1))
+    registry = agent_registry.AgentRegistry()
+    monkeypatch.setattr(agent_registry, "_registry", registry)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(ScanAgent("test", 2, [], TOKEN)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    agent = registry.register({"name": "test", "url": f"http://127.0.0.1:{server.server_address[1]}",
+                               "capacity": 2, "tools": ["echo"]})
+    results = []
+    try:
+        # Une commande locale occupe la seule place : la commande confiée à l'agent attend
+        with command_executor.global_command_slots():
+            thread = threading.Thread(
+                target=lambda: results.append(agent_registry.dispatch_command("echo agent", ["echo"], 10)))
+            thread.start()
+            time.sleep(0.3)
+            assert not results and agent.active == 0
+        thread.join(30)
+    finally:
+        agent.close()
+        server.shutdown()
+        server.server_close()
+    assert results[0].stdout == "agent\n" and results[0].agent == "test"
+    # Sans agent capable, la commande n'attend pas de place et revient à l'exécution locale
+    assert agent_registry.dispatch_command("nmap 10.0.0.1", ["nmap"], 10) is None
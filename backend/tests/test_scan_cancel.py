@@ -0,0 +1,89 @@
+import asyncio
+import contextvars
+import threading
+import time
+
+import pytest
+
+from app.services.llm_client import get_llm_loop
+from app.services.scan_cancel import (CancelToken, ScanCancelled, cancel_scan, check_cancelled,
+                                      current_cancel_token, finish_scan_cancellation, run_cancellable,
+                                      start_scan_cancellation, wait_cancellable)
+
+
+def test_token_runs_callbacks_once_and_removes_them():
+    token = CancelToken("scan")
+    calls = []
+    remove = token.add_callback(lambda: calls.append("a"))
+    token.add_callback(lambda: calls.append("b"))
+    remove()
+    assert token.cancel("test")
+    assert not token.cancel("encore")
+    assert calls == ["b"] and token.reason == "test"
+    # Inscrit après l'annulation : appelé immédiatement
+    token.add_callback(lambda: calls.append("c"))
+    assert calls == ["b", "c"]
+    with pytest.raises(ScanCancelled):
+        token.check()
+
+
+def test_cancel_scan_only_reaches_running_scans():
+    def scan():
+        start_scan_cancellation("scan-1")
+        try:
+            assert cancel_scan("scan-1")
+            with pytest.raises(ScanCancelled):
+                check_cancelled()
+        finally:
+            finish_scan_cancellation("scan-1")
+        assert current_cancel_token() is None
+
+    contextvars.copy_context().run(scan)
+    assert not cancel_scan("scan-1")
+
+
+def test_wait_cancellable_cancels_the_coroutine():
+    stopped = threading.Event()
+
+    async def long_running():
+        try:
+            await asyncio.sleep(30)
+        except asyncio.CancelledError:
+            stopped.set()
+            raise
+
+    def scan():
+        token = start_scan_cancellation("scan-2")
+        threading.Timer(0.2, token.cancel).start()
+        try:
+            started = time.monotonic()
+            with pytest.raises(ScanCancelled):
+                wait_cancellable(asyncio.run_coroutine_threadsafe(long_running(), get_llm_loop()))
+            assert time.monotonic() - started < 5
+        finally:
+            finish_scan_cancellation("scan-2")
+
+    contextvars.copy_context().run(scan)
+    assert stopped.wait(5)
+
+
+def test_run_cancellable_closes_the_token_on_every_exit():
+    def engine_main(target):
+        assert current_cancel_token().scan_id == "run-1"
+        assert cancel_scan("run-1")
+        check_cancelled()
+        return target
+
+    def failing_main():
+        raise RuntimeError("échec du moteur")
+
+    def scan():
+        with pytest.raises(ScanCancelled):
+            run_cancellable("run-1", engine_main, "10.0.0.1")
+        assert current_cancel_token() is None
+        with pytest.raises(RuntimeError):
+            run_cancellable("run-2", failing_main)
+        assert run_cancellable("run-3", lambda: "ok") == "ok"
+
+    contextvars.copy_context().run(scan)
+    assert not cancel_scan("run-1") and not cancel_scan("run-2") and not cancel_scan("run-3")
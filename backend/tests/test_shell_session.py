@@ -0,0 +1,37 @@
+import os
+
+from app.services.command_executor import ShellSessionPool
+
+
+def test_session_frames_output_and_exit_codes():
+    pool = ShellSessionPool("test", size=1)
+    try:
+        first = pool.run("echo bonjour; echo erreur >&2; exit 3", 10)
+        assert (first.stdout, first.stderr, first.exit_code) == ("bonjour\n", "erreur\n", 3)
+        # Sortie sans saut de ligne final, puis erreur de syntaxe : la session reste synchronisée
+        assert pool.run("printf 'sans fin'", 10).stdout == "sans fin"
+        assert pool.run("if then", 10).exit_code != 0
+        assert pool.run("echo suite", 10).stdout == "suite\n"
+        assert pool.spawned == 1
+    finally:
+        pool.close()
+
+
+def test_commands_do_not_leak_state_between_runs():
+    pool = ShellSessionPool("test", size=1)
+    try:
+        pool.run("cd /tmp; export PENTRAL_TEST=1", 10)
+        assert pool.run("pwd; echo ${PENTRAL_TEST:-absent}", 10).stdout == os.getcwd() + "\nabsent\n"
+    finally:
+        pool.close()
+
+
+def test_timeout_kills_session_and_next_command_gets_a_new_shell():
+    pool = ShellSessionPool("test", size=1)
+    try:
+        result = pool.run("sleep 5", 0.5)
+        assert result.timed_out
+        assert pool.run("echo ok", 10).stdout == "ok\n"
+        assert pool.spawned == 2
+    finally:
+        pool.close()
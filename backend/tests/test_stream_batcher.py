@@ -0,0 +1,64 @@
+import random
+import threading
+import time
+
+from app.services.stream_batcher import TokenBatcher, flush_stream
+
+
+def test_tokens_are_grouped_until_threshold():
+    emitted = []
+    batcher = TokenBatcher(emitted.append, window_ms=10000, max_bytes=6)
+    for token in ["ab", "cd", "ef", "gh"]:
+        batcher(token)
+    assert emitted == ["abcdef"]
+    flush_stream(batcher)
+    assert emitted == ["abcdef", "gh"]
+    assert batcher.get_stats()["emits"] == 2
+
+
+def test_window_timer_flushes_pending_tokens():
+    emitted = []
+    batcher = TokenBatcher(emitted.append, window_ms=20, max_bytes=1024)
+    batcher("x")
+    time.sleep(0.2)
+    assert emitted == ["x"]
+
+
+def test_concurrent_flushes_keep_token_order():
+    emitted = []
+
+    def slow_emit(chunk):
+        # Émission lente : un flush concurrent ne doit pas doubler une trame déjà retirée
+        time.sleep(random.random() * 0.002)
+        emitted.append(chunk)
+
+    batcher = TokenBatcher(slow_emit, window_ms=1, max_bytes=8)
+    tokens = [f"{i:04d}" for i in range(400)]
+    lock = threading.Lock()
+    position = iter(tokens)
+
+    def producer():
+        while True:
+            with lock:
+                token = next(position, None)
+                if token is None:
+                    return
+                batcher(token)
+
+    done = threading.Event()
+
+    def flusher():
+        while not done.is_set():
+            batcher.flush()
+
+    threads = [threading.Thread(target=producer) for _ in range(4)]
+    flush_thread = threading.Thread(target=flusher)
+    for thread in threads + [flush_thread]:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    done.set()
+    flush_thread.join()
+    batcher.flush()
+    assert "".join(emitted) == "".join(tokens)
+    assert batcher.get_stats()["emits"] == len(emitted)
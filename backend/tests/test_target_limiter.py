@@ -0,0 +1,74 @@
+import threading
+import time
+
+from app.services import target_limiter
+from app.services.command_executor import CommandResult
+from app.services.target_limiter import (THROTTLE_RE, HostBudget, TargetLimiter, command_host, command_protocol,
+                                         is_throttle_sign)
+
+
+def _result(stdout="", exit_code=0, timed_out=False):
+    return CommandResult("curl", stdout, "", exit_code, 1.0, 60, timed_out=timed_out)
+
+
+def test_throttle_phrases():
+    assert THROTTLE_RE.search("connect to 10.0.0.1 port 22: Connection timed out")
+    assert THROTTLE_RE.search("read: Connection reset by peer")
+    assert THROTTLE_RE.search("Warning: 10.0.0.1 giving up on port because retransmission cap hit (10).")
+    assert not THROTTLE_RE.search("Keep-Alive: timeout=5, max=100")
+    assert not THROTTLE_RE.search("--script-timeout 30s; host-timeout reached 0 times")
+
+
+def test_throttle_sign_from_result():
+    assert is_throttle_sign(_result(timed_out=True, exit_code=None))
+    assert is_throttle_sign(_result("HTTP/1.1 503 Service Unavailable", exit_code=22))
+    assert not is_throttle_sign(_result("HTTP/1.1 200 OK\nKeep-Alive: timeout=5"))
+
+
+def test_command_host_and_protocol():
+    assert command_host("nmap -sV -oX scan.xml 10.0.0.5") == "10.0.0.5"
+    assert command_host("whatweb -a 3 http://Example.com:8080/login") == "example.com"
+    assert command_host("gobuster dir -w /usr/share/wordlists/common.txt -u https://site.fr") == "site.fr"
+    assert command_host("nikto -h 192.168.1.2:443") == "192.168.1.2"
+    assert command_host("ls -la") is None
+    assert command_protocol("nmap -p 445 --script smb-os-discovery 10.0.0.5") == "smb"
+    assert command_protocol("nmap -sV 10.0.0.5") == "portscan"
+    assert command_protocol("enum4linux -a 10.0.0.5") == "smb"
+
+
+def test_token_bucket_refills_at_rate(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(target_limiter.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(target_limiter, "TARGET_RATE", 2.0)
+    monkeypatch.setattr(target_limiter, "TARGET_BURST", 2)
+    budget = HostBudget("10.0.0.1")
+    budget.tokens = 0
+    assert budget.delay("http") == 0.5
+    now[0] += 0.5
+    assert budget.delay("http") == 0
+    now[0] += 10
+    budget.refill()
+    assert budget.tokens == 2
+
+
+def test_protocol_concurrency_and_adaptive_factor(monkeypatch):
+    monkeypatch.setattr(target_limiter, "TARGET_RATE", 1000.0)
+    limiter = TargetLimiter()
+    order = []
+    with limiter.slot("10.0.0.1", "enum4linux -a 10.0.0.1") as outcome:
+        def second():
+            with limiter.slot("10.0.0.1", "smbclient -L 10.0.0.1") as second_outcome:
+                order.append("second")
+                second_outcome["execution"] = _result("Sharename  Type  Comment")
+
+        thread = threading.Thread(target=second)
+        thread.start()
+        time.sleep(0.2)
+        # SMB : une seule sonde à la fois sur l'hôte
+        order.append("first")
+        outcome["execution"] = _result("NT_STATUS_CONNECTION_RESET: connection reset", exit_code=1)
+    thread.join(5)
+    assert order == ["first", "second"]
+    stats = limiter.get_stats()["10.0.0.1"]
+    assert stats["throttled"] == 1 and stats["commands"] == 2
+    assert stats["factor"] == 0.6  # divisé par deux, puis remonté d'un pas par la commande suivante
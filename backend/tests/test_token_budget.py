@@ -0,0 +1,29 @@
+import json
+import os
+
+from app.services.token_budget import TOKEN_BUDGET_MIN_SAMPLES, TokenBudgets, percentile
+
+
+def test_percentile_nearest_rank():
+    assert percentile([5, 1, 3, 2, 4], 50) == 3
+    assert percentile(list(range(1, 101)), 99) == 99
+    assert percentile([7], 99) == 7
+
+
+def test_budget_uses_default_until_enough_samples(tmp_path):
+    budgets = TokenBudgets(path=str(tmp_path / "budgets.json"), save_interval=3600)
+    for _ in range(TOKEN_BUDGET_MIN_SAMPLES - 1):
+        budgets.record("command", 100)
+    assert budgets.budget("command", default=512) == 512
+    budgets.record("command", 100)
+    assert budgets.budget("command", default=512) < 512
+
+
+def test_record_does_not_write_file_until_save(tmp_path):
+    path = tmp_path / "budgets.json"
+    budgets = TokenBudgets(path=str(path), save_interval=3600)
+    budgets.record("analysis", 42)
+    assert not os.path.exists(path)
+    budgets.save()
+    assert json.loads(path.read_text()) == {"analysis": [42]}
+    assert TokenBudgets(path=str(path)).get_stats()["analysis"]["samples"] == 1
@@ -0,0 +1,56 @@
+from app.services import tool_inventory
+from app.services.tool_inventory import ToolInventory, command_tools, tool_package
+
+ABSENT = "pentral-outil-absent"
+
+
+def _count_probes(monkeypatch):
+    probes = []
+    run_command = tool_inventory.run_command
+
+    def counting(command, timeout):
+        probes.append(command)
+        return run_command(command, timeout)
+
+    monkeypatch.setattr(tool_inventory, "run_command", counting)
+    return probes
+
+
+def test_command_tools_follow_pipes_and_chains():
+    command = "echo x | nc -w1 10.0.0.1 80 && sudo nmap -p 80 10.0.0.1; timeout 5 curl -s u || LANG=C whatweb u"
+    assert command_tools(command) == ["nc", "nmap", "curl", "whatweb"]
+    assert command_tools("true; printf '%s' x | grep x | grep y") == ["grep"]
+
+
+def test_availability_is_probed_once_per_ttl(monkeypatch):
+    probes = _count_probes(monkeypatch)
+    inventory = ToolInventory("local")
+    assert inventory.availability(["sh", ABSENT]) == {"sh": True, ABSENT: False}
+    assert inventory.is_available("sh") and inventory.missing([ABSENT, "sh"]) == [ABSENT]
+    assert len(probes) == 1
+    # Un outil encore inconnu est sondé seul
+    assert inventory.is_available("ls")
+    assert len(probes) == 2 and probes[1].startswith("for t in ls;")
+    inventory.invalidate(["sh"])
+    inventory.is_available("sh")
+    assert len(probes) == 3
+
+
+def test_expired_entries_are_probed_again(monkeypatch):
+    probes = _count_probes(monkeypatch)
+    inventory = ToolInventory("local", ttl=0)
+    inventory.is_available("sh")
+    inventory.is_available("sh")
+    assert len(probes) == 2
+
+
+def test_ensure_installs_missing_tools_by_package(monkeypatch):
+    installs = []
+    monkeypatch.setattr(tool_inventory, "install_packages", installs.append)
+    assert tool_package("dig") == "dnsutils" and tool_package("nmap") == "nmap"
+    inventory = ToolInventory("local")
+    assert inventory.plan_installs(["sh", ABSENT]) == {ABSENT: [ABSENT]}
+    assert inventory.ensure(["sh", ABSENT, ABSENT]) == [ABSENT]
+    assert installs == [{ABSENT: [ABSENT]}]
+    # Rien à installer quand tout est présent
+    assert inventory.ensure(["sh"]) == [] and len(installs) == 1
@@ -0,0 +1,59 @@
+from app.services.yaml_stream import YamlBlockDetector
+
+
+def _feed(detector, text, size=3):
+    for i in range(0, len(text), size):
+        if detector.feed(text[i:i + size]):
+            return True
+    return False
+
+
+def test_fenced_block_complete_on_closing_fence():
+    detector = YamlBlockDetector(["tool_name", "enumerate_command"])
+    text = "Voici :\n```yaml\ntool_name: nmap\nenumerate_command: nmap -sV 10.0.0.1\n```\nExplication inutile"
+    assert _feed(detector, text)
+    assert detector.parsed == {"tool_name": "nmap", "enumerate_command": "nmap -sV 10.0.0.1"}
+
+
+def test_fenced_example_without_keys_is_skipped():
+    detector = YamlBlockDetector(["tool_name"])
+    assert not _feed(detector, "```yaml\nexemple: 1\n```\n")
+    assert _feed(detector, "```yaml\ntool_name: nikto\n```\n")
+    assert detector.parsed == {"tool_name": "nikto"}
+
+
+def test_unfenced_block_ends_on_free_text_not_blank_line():
+    detector = YamlBlockDetector(["ports"])
+    assert not _feed(detector, "ports:\n  - 22\n\n  - 80\n")
+    assert _feed(detector, "Ces ports sont ouverts.\n")
+    assert detector.parsed == {"ports": [22, 80]}
+
+
+def test_incomplete_block_is_not_detected():
+    detector = YamlBlockDetector(["tool_name", "enumerate_command"])
+    assert not _feed(detector, "tool_name: nmap\nPas de commande ici.\n")
+    assert detector.block is None
+
+
+def test_json_object_complete_when_closed():
+    # Réponse contrainte par output_schema : les clés sont entre guillemets et tout tient sur une ligne
+    detector = YamlBlockDetector(["tool_name", "enumerate_command"])
+    text = '{"tool_name": "nmap", "enumerate_command": "nmap -p 80 \\"{x}\\" 10.0.0.1"}'
+    assert not _feed(detector, text[:-1])
+    # Coupé dès l'accolade fermante, sans attendre les blancs que la grammaire autorise ensuite
+    assert detector.feed("}")
+    assert detector.parsed == {"tool_name": "nmap", "enumerate_command": 'nmap -p 80 "{x}" 10.0.0.1'}
+    assert detector.block == text
+
+
+def test_json_object_without_required_keys_is_skipped():
+    detector = YamlBlockDetector(["tool_name"])
+    assert not _feed(detector, '{"exemple": {"tool_name": "nikto"}}\n')
+    assert _feed(detector, '{"tool_name": "nikto"}')
+    assert detector.parsed == {"tool_name": "nikto"}
+
+
+def test_fenced_json_block():
+    detector = YamlBlockDetector(["tool_name"])
+    assert _feed(detector, 'Voici :\n```json\n{"tool_name": "nikto"}\n```\nSuite')
+    assert detector.parsed == {"tool_name": "nikto"}